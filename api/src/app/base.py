@@ -1,4 +1,347 @@
+import os
 import json
+import threading
+from types import MappingProxyType
+
+import numpy as np
+
+_networks = {}
+_networks_lock = threading.Lock()
+_compile_lock = threading.Lock()
+
+
+def load_network(dataset='recon3D', file_type='.json'):
+    """
+    Getting the parsed network of the given dataset
+        - params:
+            dataset : string
+            file_type : string
+        - response:
+            read-only mapping with pathways, metabolites and reactions,
+            parsed once per process and shared by every caller. Nested
+            objects are read-only mappings too, and lists are tuples.
+    """
+    key = (dataset, file_type)
+    network = _networks.get(key)
+    if network is None:
+        with _networks_lock:
+            network = _networks.get(key)
+            if network is None:
+                network = _read_network(dataset, file_type)
+                _networks[key] = network
+    return network
+
+
+def get_network_version(dataset='recon3D', file_type='.json'):
+    """Getting a version tag of the network file, changing whenever the file does"""
+    stat = os.stat('../datasets/assets/' + str(dataset) + str(file_type))
+    return '%s:%d:%d' % (dataset, stat.st_mtime_ns, stat.st_size)
+
+
+def clear_networks():
+    """Dropping loaded networks so that the next access reads them again"""
+    with _networks_lock:
+        _networks.clear()
+
+
+def _freeze(value):
+    """Turning parsed json into read-only mappings and tuples, all the way down"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _read_network(dataset, file_type):
+    with open('../datasets/assets/' + str(dataset) + str(file_type)) as data:
+        if file_type == ".json":
+            json_str = data.read()  # Processing RECON Data
+            db = json.loads(json_str)  # Processing RECON Data
+            # Shared by every caller in the process, so no caller may change it
+            return _freeze(db)
+    return MappingProxyType({})
+
+
+class NetworkIndex:
+    """
+    Frozen lookup tables of a network, built once when it is loaded
+        - pathway_metabolites : pathway -> frozenset of metabolites
+        - metabolite_pathways : metabolite -> frozenset of pathways, the
+          inverse of pathway_metabolites
+        - reaction_subsystem : reaction -> subsystem, for reactions having one
+        - metabolite_reactions : metabolite -> frozenset of reactions
+        - reaction_metabolites : reaction -> frozenset of metabolites
+    """
+
+    def __init__(self, data):
+        self.reaction_metabolites = MappingProxyType({
+            reaction: frozenset(value['metabolites'])
+            for reaction, value in data['reactions'].items()})
+        self.metabolite_reactions = MappingProxyType({
+            metabolite: frozenset(value['reactions'])
+            for metabolite, value in data['metabolites'].items()})
+        self.reaction_subsystem = MappingProxyType({
+            reaction: value['subsystem']
+            for reaction, value in data['reactions'].items() if 'subsystem' in value})
+
+        pathway_metabolites = {}
+        metabolite_pathways = {}
+        for pathway, reactions in data['pathways'].items():
+            metabolites = set()
+            for reaction in reactions:
+                metabolites.update(self.reaction_metabolites[reaction])
+            pathway_metabolites[pathway] = frozenset(metabolites)
+            for metabolite in metabolites:
+                metabolite_pathways.setdefault(metabolite, set()).add(pathway)
+        self.pathway_metabolites = MappingProxyType(pathway_metabolites)
+        self.metabolite_pathways = MappingProxyType(
+            {k: frozenset(v) for k, v in metabolite_pathways.items()})
+
+
+def load_network_index(dataset='recon3D', file_type='.json'):
+    """Getting the NetworkIndex of the given dataset, built once per process"""
+    key = (dataset, file_type, 'index')
+    index = _networks.get(key)
+    if index is None:
+        data = load_network(dataset, file_type)
+        with _networks_lock:
+            index = _networks.get(key)
+            if index is None:
+                index = NetworkIndex(data)
+                _networks[key] = index
+    return index
+
+
+COMPILED_PATH = '../datasets/compiled'
+COMPILED_VERSION = 1
+COMPILED_ARRAYS = (
+    'strings', 'string_offsets',
+    'reaction_indptr', 'reaction_metabolites', 'reaction_coefficients',
+    'metabolite_indptr', 'metabolite_reactions',
+    'pathway_indptr', 'pathway_reactions',
+    'reaction_subsystem',
+)
+
+
+class CompiledNetwork:
+    """
+    Memory-mapped, integer-coded form of a network
+
+    Metabolites, reactions and pathways are numbered in the order of the
+    source json. Names live in one utf-8 string table: metabolites first,
+    then reactions, then pathways. Incidences are stored as CSR arrays:
+        - reaction -> metabolites (with stoichiometric coefficients)
+        - metabolite -> reactions
+        - pathway -> reactions
+    reaction_subsystem holds the pathway index of each reaction's
+    subsystem, -1 when the reaction has none.
+    """
+
+    def __init__(self, path, meta, arrays):
+        self.path = path
+        self.meta = meta
+        for name in COMPILED_ARRAYS:
+            setattr(self, name, arrays[name])
+        self._names = None
+
+    @classmethod
+    def load(cls, dataset='recon3D'):
+        """Memory-mapping a network compiled by compile_network"""
+        path = os.path.join(COMPILED_PATH, str(dataset))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != COMPILED_VERSION:
+            raise ValueError('Compiled network %s has version %s, expected %s'
+                             % (dataset, meta.get('version'), COMPILED_VERSION))
+        source = '../datasets/assets/' + str(dataset) + '.json'
+        if os.path.exists(source) and os.path.getmtime(source) != meta.get('source_mtime'):
+            raise ValueError('Compiled network %s is older than its source, run compile_network again' % dataset)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in COMPILED_ARRAYS}
+        return cls(path, meta, arrays)
+
+    def _incidence(self, indptr, indices, n_columns):
+        from scipy import sparse
+
+        indptr = np.asarray(indptr)
+        return sparse.csr_matrix(
+            (np.ones(indptr[-1]), np.asarray(indices), indptr),
+            shape=(len(indptr) - 1, n_columns))
+
+    def reaction_incidence(self):
+        """Reactions x metabolites, indices kept in network order"""
+        return self._incidence(self.reaction_indptr, self.reaction_metabolites, self.n_metabolites)
+
+    def metabolite_incidence(self):
+        """Metabolites x reactions, indices kept in network order"""
+        return self._incidence(self.metabolite_indptr, self.metabolite_reactions, self.n_reactions)
+
+    def pathway_incidence(self):
+        """Pathways x reactions, indices kept in network order"""
+        return self._incidence(self.pathway_indptr, self.pathway_reactions, self.n_reactions)
+
+    @property
+    def n_metabolites(self):
+        return self.meta['n_metabolites']
+
+    @property
+    def n_reactions(self):
+        return self.meta['n_reactions']
+
+    @property
+    def n_pathways(self):
+        return self.meta['n_pathways']
+
+    def _decode_names(self):
+        if self._names is None:
+            blob = self.strings.tobytes()
+            offsets = self.string_offsets
+            self._names = [blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                           for i in range(len(offsets) - 1)]
+        return self._names
+
+    @property
+    def metabolite_names(self):
+        return self._decode_names()[:self.n_metabolites]
+
+    @property
+    def reaction_names(self):
+        start = self.n_metabolites
+        return self._decode_names()[start:start + self.n_reactions]
+
+    @property
+    def pathway_names(self):
+        start = self.n_metabolites + self.n_reactions
+        return self._decode_names()[start:start + self.n_pathways]
+
+
+def _encode_network(dataset, file_type):
+    """Encoding a json network into the arrays and meta of CompiledNetwork"""
+    # Not kept in _networks, so a worker compiling on demand does not hold the json afterwards
+    data = _networks.get((dataset, file_type)) or _read_network(dataset, file_type)
+    metabolites = list(data['metabolites'])
+    reactions = list(data['reactions'])
+    pathways = list(data['pathways'])
+    metabolite_index = {m: i for i, m in enumerate(metabolites)}
+    reaction_index = {r: i for i, r in enumerate(reactions)}
+    pathway_index = {p: i for i, p in enumerate(pathways)}
+
+    encoded = [name.encode('utf-8') for name in metabolites + reactions + pathways]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    string_offsets[1:] = np.cumsum([len(e) for e in encoded])
+    strings = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    reaction_indptr, reaction_metabolites, reaction_coefficients = [0], [], []
+    reaction_subsystem = []
+    for reaction in reactions:
+        participants = data['reactions'][reaction]['metabolites']
+        for metabolite, coefficient in participants.items():
+            reaction_metabolites.append(metabolite_index[metabolite])
+            reaction_coefficients.append(coefficient)
+        reaction_indptr.append(len(reaction_metabolites))
+        subsystem = data['reactions'][reaction].get('subsystem')
+        reaction_subsystem.append(pathway_index.get(subsystem, -1) if subsystem is not None else -1)
+
+    metabolite_indptr, metabolite_reactions = [0], []
+    for metabolite in metabolites:
+        metabolite_reactions.extend(reaction_index[r] for r in data['metabolites'][metabolite]['reactions'])
+        metabolite_indptr.append(len(metabolite_reactions))
+
+    pathway_indptr, pathway_reactions = [0], []
+    for pathway in pathways:
+        pathway_reactions.extend(reaction_index[r] for r in data['pathways'][pathway])
+        pathway_indptr.append(len(pathway_reactions))
+
+    arrays = {
+        'strings': strings,
+        'string_offsets': string_offsets,
+        'reaction_indptr': np.array(reaction_indptr, dtype=np.int64),
+        'reaction_metabolites': np.array(reaction_metabolites, dtype=np.int32),
+        'reaction_coefficients': np.array(reaction_coefficients, dtype=np.float64),
+        'metabolite_indptr': np.array(metabolite_indptr, dtype=np.int64),
+        'metabolite_reactions': np.array(metabolite_reactions, dtype=np.int32),
+        'pathway_indptr': np.array(pathway_indptr, dtype=np.int64),
+        'pathway_reactions': np.array(pathway_reactions, dtype=np.int32),
+        'reaction_subsystem': np.array(reaction_subsystem, dtype=np.int32),
+    }
+    source = '../datasets/assets/' + str(dataset) + str(file_type)
+    meta = {
+        'version': COMPILED_VERSION,
+        'dataset': dataset,
+        'source_mtime': os.path.getmtime(source),
+        'n_metabolites': len(metabolites),
+        'n_reactions': len(reactions),
+        'n_pathways': len(pathways),
+    }
+    return arrays, meta
+
+
+def compile_network(dataset='recon3D', file_type='.json', path=None):
+    """
+    Compiling the given network into the binary layout read by CompiledNetwork
+        - params:
+            dataset : string
+            file_type : string
+            path : output folder, one sub-folder is written per dataset,
+                COMPILED_PATH where the loader reads by default
+        - response:
+            the output folder of the dataset
+    """
+    if path is None:
+        path = COMPILED_PATH
+    arrays, meta = _encode_network(dataset, file_type)
+    out = os.path.join(path, str(dataset))
+    os.makedirs(out, exist_ok=True)
+    # Files are replaced rather than rewritten, processes mapping the old ones keep them
+    for name, array in arrays.items():
+        with open(os.path.join(out, name + '.npy.tmp'), 'wb') as f:
+            np.save(f, array)
+        os.replace(os.path.join(out, name + '.npy.tmp'), os.path.join(out, name + '.npy'))
+    with open(os.path.join(out, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(os.path.join(out, 'meta.json.tmp'), os.path.join(out, 'meta.json'))
+    return out
+
+
+def load_compiled_network(dataset='recon3D'):
+    """
+    Getting the compiled network of the given dataset, memory-mapped once per
+    process. A missing, stale or unreadable artifact is compiled again, once
+    for all processes, and an error is raised when that fails.
+    """
+    key = (dataset, 'compiled')
+    network = _networks.get(key)
+    if network is None:
+        with _compile_lock:
+            network = _networks.get(key)
+            if network is None:
+                network = _load_or_compile(dataset)
+                with _networks_lock:
+                    _networks[key] = network
+    return network
+
+
+def _load_or_compile(dataset):
+    import fcntl
+
+    try:
+        return CompiledNetwork.load(dataset)
+    except (IOError, ValueError, EOFError) as e:
+        from .app import app
+
+        app.logger.warning('Compiled network %s cannot be used (%s), compiling it again', dataset, e)
+    os.makedirs(COMPILED_PATH, exist_ok=True)
+    with open(os.path.join(COMPILED_PATH, str(dataset) + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:  # another process may have compiled it meanwhile
+                return CompiledNetwork.load(dataset)
+            except (IOError, ValueError, EOFError):
+                compile_network(dataset)
+                return CompiledNetwork.load(dataset)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
 class MetaboliticsBase:
@@ -8,12 +351,13 @@ class MetaboliticsBase:
         self.dataset = dataset
         self.file_type = file_type
         self.data = {}
+        self.index = None
         self.fill_data()
 
     def get_reactions_by_metabolite(self, metabolite):
         """Getting reactions by metabolite name"""
         try:
-            return self.data['metabolites'][metabolite]['reactions']
+            return self.index.metabolite_reactions[metabolite]
         except:
             print("There is no key existing as " + metabolite)
             # raise KeyError
@@ -21,7 +365,7 @@ class MetaboliticsBase:
     def get_metabolites_by_reaction(self, reaction):
         """Getting metabolites by reaction name"""
         try:
-            return self.data['reactions'][reaction]['metabolites'].keys()
+            return self.index.reaction_metabolites[reaction]
         except:
             print("There is no key existing as " + reaction)
 
@@ -43,27 +387,37 @@ class MetaboliticsBase:
             - params:
                 pathway : string
             - response:
-                a list of metabolites belong to given pathway
+                a frozenset of metabolites belong to given pathway
         """
         try:
-            reactions = self.data['pathways'][pathway]
-            metabolites = []
-            for reaction in reactions:
-                metabolites_by_reaction = self.data['reactions'][reaction]['metabolites']
-                for metabolite in metabolites_by_reaction:
-                    if not metabolite in metabolites:
-                        metabolites.append(metabolite)
-            return metabolites
+            return self.index.pathway_metabolites[pathway]
         except:
             print("There is no key existing as " + pathway)
 
+    def get_pathways_by_metabolite(self, metabolite):
+        """
+        Getting pathways the given metabolite takes part in
+            - params:
+                metabolite : string
+            - response:
+                a frozenset of pathways
+        """
+        try:
+            return self.index.metabolite_pathways[metabolite]
+        except:
+            print("There is no key existing as " + metabolite)
+
+    def get_subsystem_by_reaction(self, reaction):
+        """Getting subsystem by reaction name, None if it has no subsystem"""
+        return self.index.reaction_subsystem.get(reaction)
+
     def get_reactions_by_pathway(self, pathway):
         """
         Getting reactions of the given pathway
          - params:
                 pathway : string
             - response:
-                a list of reactions belong to given pathway
+                a tuple of reactions belong to given pathway
         """
         try:
             return self.data['pathways'][pathway]
@@ -85,12 +439,5 @@ class MetaboliticsBase:
 
     def fill_data(self):
         """Filling the data referenced from the user"""
-        with open('../datasets/assets/' + str(self.dataset) + str(self.file_type)) as data:
-            if self.file_type == ".json":
-                json_str = data.read()  # Processing RECON Data
-                db = json.loads(json_str)  # Processing RECON Data
-                self.data = db
-
-
-tst = MetaboliticsBase()
-# print(tst.get_metabolites_by_reaction('SO4CLtex2'))
+        self.data = load_network(self.dataset, self.file_type)
+        self.index = load_network_index(self.dataset, self.file_type)
@@ -26,6 +26,41 @@ class BaseConfig:
                                   'redis://localhost:6379')
     CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND',
                                       'redis://localhost:6379')
+    # Shared cache of analysis results, set to an empty string to disable it. It
+    # shares the redis instance of the broker, so its values are kept under
+    # RESULT_CACHE_MAX_BYTES, least recently used first out
+    RESULT_CACHE_URL = os.getenv('RESULT_CACHE_URL', 'redis://localhost:6379/1')
+    RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    # Reaction level progress of running analyses, set to an empty string to disable it
+    PROGRESS_URL = os.getenv('PROGRESS_URL', 'redis://localhost:6379/1')
+    # Default of most-similar-diseases: 'exact' compares against every public
+    # analysis, 'centroid' against the mean pathway profile of every disease
+    SIMILARITY_MODE = os.getenv('SIMILARITY_MODE', 'exact')
+    # Quick DPM/PE tasks and minutes long FVA/training tasks have separate queues,
+    # so that a burst of FVA uploads does not delay DPM results of other users
+    CELERY_ROUTES = {
+        'app.tasks.save_dpm': {'queue': 'fast'},
+        'app.tasks.save_dpm_study': {'queue': 'fast'},
+        'app.tasks.save_pe': {'queue': 'fast'},
+        'app.tasks.save_pe_study': {'queue': 'fast'},
+        'app.tasks.enhance_synonyms': {'queue': 'fast'},
+        'app.tasks.save_analysis': {'queue': 'heavy'},
+        'app.tasks.save_analysis_study': {'queue': 'heavy'},
+        'train_save_model': {'queue': 'heavy'},
+    }
+    # Worker settings per queue, used by the run_celery_worker command. A heavy
+    # task already spreads its FVA over FVA_PROCESSES processes, and takes one
+    # task at a time so that queued uploads can go to another idle worker.
+    CELERY_QUEUE_WORKERS = {
+        'fast': {
+            'concurrency': int(os.getenv('CELERY_FAST_CONCURRENCY', 4)),
+            'prefetch': int(os.getenv('CELERY_FAST_PREFETCH', 4)),
+        },
+        'heavy': {
+            'concurrency': int(os.getenv('CELERY_HEAVY_CONCURRENCY', 1)),
+            'prefetch': int(os.getenv('CELERY_HEAVY_PREFETCH', 1)),
+        },
+    }
     CELERYBEAT_SCHEDULE = {
         'train_save_model': {
             'task': 'train_save_model',
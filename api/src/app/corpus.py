@@ -0,0 +1,635 @@
+import os
+import json
+import math
+import fcntl
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+CORPUS_PATH = '../datasets/corpus'
+CORPUS_VERSION = 1
+
+_corpora = {}
+_corpora_lock = threading.Lock()
+
+
+def _value(value):
+    """Scores missing from a row or not a number count as 0, as in similarty_dict"""
+    if value is None:
+        return 0.0
+    value = float(value)
+    return 0.0 if math.isnan(value) else value
+
+
+class PathwayCorpus:
+    """
+    Pathway scores of the public analyses of one analysis method
+
+    Stored under CORPUS_PATH/<method id>:
+        - meta.json : pathway column order and, per row, the analysis id,
+          disease and label, plus the analysis ids removed since
+        - scores-<generation>.f8 : rows of float64 pathway scores followed by
+          the row sum and sum of squares
+        - present-<generation>.u1 : which pathways each row actually had
+        - centroids.npz : mean and variance profiles per disease, see DiseaseCentroids
+    Rows are appended as analyses finish. A new generation is written only
+    when a pathway outside the column order shows up. The files are memory
+    mapped, so every gunicorn worker shares one copy of them.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.pathways = meta['pathways']
+        self.n_rows = len(meta['analysis_ids'])
+        self.columns = {pathway: i for i, pathway in enumerate(self.pathways)}
+        n_columns = len(self.pathways)
+        if self.n_rows:
+            self.scores = np.memmap(os.path.join(path, meta['scores']), dtype=np.float64, mode='r',
+                                    shape=(self.n_rows, n_columns + 2))
+            self.present = np.memmap(os.path.join(path, meta['present']), dtype=np.uint8, mode='r',
+                                     shape=(self.n_rows, n_columns))
+        else:
+            self.scores = np.zeros((0, n_columns + 2))
+            self.present = np.zeros((0, n_columns), dtype=np.uint8)
+        self.disease_names = sorted(set(meta['diseases']))
+        codes = {disease: i for i, disease in enumerate(self.disease_names)}
+        self.disease_codes = np.array([codes[d] for d in meta['diseases']], dtype=np.int64)
+        self._masks = {}
+
+    @classmethod
+    def load(cls, method_id):
+        path = os.path.join(CORPUS_PATH, str(method_id))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != CORPUS_VERSION:
+            raise ValueError('Corpus of method %s has version %s, expected %s'
+                             % (method_id, meta.get('version'), CORPUS_VERSION))
+        return cls(path, meta)
+
+    def _mask(self, excluded_labels):
+        """Rows to compare against and the pathway columns present in them"""
+        key = frozenset(excluded_labels)
+        cached = self._masks.get(key)
+        if cached is None:
+            removed = set(self.meta['removed'])
+            rows = np.array([
+                analysis_id not in removed and label not in key
+                for analysis_id, label in zip(self.meta['analysis_ids'], self.meta['labels'])], dtype=bool)
+            present = self.present[rows].any(axis=0) if rows.any() else np.zeros(len(self.pathways), dtype=bool)
+            cached = self._masks[key] = (rows, present)
+        return cached
+
+    def similarities(self, results_pathway, excluded_labels=()):
+        """
+        Correlation similarity of results_pathway to every row, averaged per disease
+            - params:
+                results_pathway : pathway scores of the analysis to compare
+                excluded_labels : labels of rows left out, such as healthy group averages
+            - response:
+                dict of disease to mean similarity
+        It is 1 - scipy.spatial.distance.correlation over the union of the pathways
+        of results_pathway and of the compared rows, as similarty_dict computes it,
+        but done with one matrix product.
+        """
+        rows, present = self._mask(excluded_labels)
+        if not rows.any():
+            return {}
+        n_columns = len(self.pathways)
+        x = np.zeros(n_columns)
+        x_only = 0
+        for pathway, value in results_pathway.items():
+            column = self.columns.get(pathway)
+            if column is None:
+                x_only += 1
+            else:
+                x[column] = _value(value)
+                if not present[column]:
+                    x_only += 1
+        values = [_value(v) for v in results_pathway.values()]
+        n = int(present.sum()) + x_only
+        sx, sxx = sum(values), sum(v * v for v in values)
+
+        scores = self.scores[rows]
+        dot = scores[:, :n_columns] @ x
+        sv, svv = scores[:, n_columns], scores[:, n_columns + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities = (dot - sx * sv / n) / np.sqrt((sxx - sx * sx / n) * (svv - sv * sv / n))
+
+        codes = self.disease_codes[rows]
+        totals = np.bincount(codes, weights=similarities, minlength=len(self.disease_names))
+        counts = np.bincount(codes, minlength=len(self.disease_names))
+        return {self.disease_names[i]: totals[i] / counts[i] for i in np.flatnonzero(counts)}
+
+    @property
+    def version(self):
+        """Changes whenever rows are added or removed"""
+        return '%d:%d:%d' % (self.meta['generation'], self.n_rows, len(self.meta['removed']))
+
+    def _centred_norms(self):
+        """Norm of every row after centring it over all pathway columns"""
+        if not hasattr(self, '_norms'):
+            n_columns = len(self.pathways)
+            sv, svv = self.scores[:, n_columns], self.scores[:, n_columns + 1]
+            norms = np.sqrt(np.maximum(svv - sv * sv / max(n_columns, 1), 0))
+            # Constant rows have no direction, they get a similarity of 0
+            self._norms = np.where(norms > 0, norms, np.inf)
+        return self._norms
+
+    def nearest(self, results_pathways, k=5, excluded_labels=(), exclude_ids=None, batch_size=64):
+        """
+        Top-k most similar rows and diseases for many analyses at once
+            - params:
+                results_pathways : pathway scores of the analyses to compare
+                excluded_labels : labels of rows left out, such as healthy group averages
+                exclude_ids : analysis id to leave out per analysis, usually its own
+            - response:
+                list with, per analysis, {'analyses': [{'id', 'disease', 'similarity'}],
+                'diseases': [{'disease', 'similarity'}]}, best first
+        Vectors are centred and normalised over the corpus pathway columns, so the
+        correlation of two analyses is a dot product and a batch of analyses is
+        one matrix product. Pathways outside the corpus columns are ignored.
+        """
+        rows, _ = self._mask(excluded_labels)
+        indices = np.flatnonzero(rows)
+        n_columns = len(self.pathways)
+        analysis_ids = np.asarray(self.meta['analysis_ids'])[indices]
+        codes = self.disease_codes[indices]
+        norms = self._centred_norms()[indices]
+        exclude_ids = exclude_ids if exclude_ids is not None else [None] * len(results_pathways)
+
+        results = []
+        for start in range(0, len(results_pathways), batch_size):
+            batch = results_pathways[start:start + batch_size]
+            queries = np.zeros((n_columns, len(batch)))
+            for j, results_pathway in enumerate(batch):
+                for pathway, value in results_pathway.items():
+                    column = self.columns.get(pathway)
+                    if column is not None:
+                        queries[column, j] = _value(value)
+            queries -= queries.mean(axis=0) if n_columns else 0
+            query_norms = np.linalg.norm(queries, axis=0)
+            queries /= np.where(query_norms > 0, query_norms, np.inf)
+            similarities = (self.scores[indices, :n_columns] @ queries) / norms[:, None]
+
+            for j in range(len(batch)):
+                column = similarities[:, j]
+                keep = analysis_ids != exclude_ids[start + j]
+                candidates = np.flatnonzero(keep)
+                if len(candidates) > k:
+                    candidates = candidates[np.argpartition(-column[candidates], k - 1)[:k]]
+                candidates = candidates[np.argsort(-column[candidates], kind='stable')]
+                totals = np.bincount(codes[keep], weights=column[keep], minlength=len(self.disease_names))
+                counts = np.bincount(codes[keep], minlength=len(self.disease_names))
+                diseases = sorted(((self.disease_names[i], totals[i] / counts[i]) for i in np.flatnonzero(counts)),
+                                  key=lambda d: d[1], reverse=True)[:k]
+                results.append({
+                    'analyses': [{'id': int(analysis_ids[i]), 'disease': self.meta['diseases'][indices[i]],
+                                  'similarity': float(column[i])} for i in candidates],
+                    'diseases': [{'disease': disease, 'similarity': float(similarity)}
+                                 for disease, similarity in diseases],
+                })
+        return results
+
+    @property
+    def centroids(self):
+        """Disease centroids of the rows of this corpus, see DiseaseCentroids"""
+        if not hasattr(self, '_centroids'):
+            centroids = DiseaseCentroids.load(self.path, self.meta)
+            if centroids is None:  # written by a crashed append or before centroids were kept
+                centroids = DiseaseCentroids.from_rows(self.meta, self.scores)
+            self._centroids = centroids
+            self._profiles = {}
+        return self._centroids
+
+    def centroid_similarities(self, results_pathway, excluded_labels=()):
+        """
+        Correlation similarity of results_pathway to the mean profile of every disease
+            - params:
+                results_pathway : pathway scores of the analysis to compare
+                excluded_labels : labels of rows left out, such as healthy group averages
+            - response:
+                dict of disease to similarity
+        One product with a vector per disease instead of one per analysis. It
+        approximates similarities, which averages the similarity to each row of
+        a disease. Vectors are centred over the corpus pathway columns, as in
+        nearest.
+        """
+        centroids = self.centroids
+        key = frozenset(excluded_labels)
+        profiles = self._profiles.get(key)
+        if profiles is None:
+            diseases, _, means, _ = centroids.profiles(key)
+            means = means - means.mean(axis=1)[:, None] if means.size else means
+            norms = np.linalg.norm(means, axis=1)
+            profiles = self._profiles[key] = (diseases, means / np.where(norms > 0, norms, np.inf)[:, None])
+        diseases, means = profiles
+        if not diseases:
+            return {}
+        x = np.zeros(len(self.pathways))
+        for pathway, value in results_pathway.items():
+            column = self.columns.get(pathway)
+            if column is not None:
+                x[column] = _value(value)
+        x -= x.mean()
+        norm = np.linalg.norm(x)
+        similarities = means @ (x / norm) if norm > 0 else np.zeros(len(diseases))
+        return dict(zip(diseases, similarities.tolist()))
+
+
+class DiseaseCentroids:
+    """
+    Count, mean and M2 (sum of squared deviations) of the pathway scores of the
+    corpus rows of every (disease, label) pair
+
+    Stored as centroids.npz next to meta.json, together with the number of
+    rows and of removed analyses it covers, so that a file left behind by an
+    interrupted write is recomputed instead of used. Rows are added and removed
+    with Welford updates, so finishing an analysis never reads the matrix.
+    Labels are kept apart so that excluded labels can be left out at query time.
+    """
+
+    def __init__(self, diseases, labels, count, mean, m2):
+        self.keys = {key: i for i, key in enumerate(zip(diseases, labels))}
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def empty(cls, n_columns):
+        return cls([], [], np.zeros(0, dtype=np.int64), np.zeros((0, n_columns)), np.zeros((0, n_columns)))
+
+    @classmethod
+    def from_rows(cls, meta, scores):
+        """Computing the centroids of every row of a corpus that was not removed"""
+        n_columns = len(meta['pathways'])
+        removed = set(meta['removed'])
+        groups = {}
+        for i, (analysis_id, disease, label) in enumerate(zip(meta['analysis_ids'], meta['diseases'],
+                                                              meta['labels'])):
+            if analysis_id not in removed:
+                groups.setdefault((disease, label), []).append(i)
+        centroids = cls.empty(n_columns)
+        for key, indices in groups.items():
+            block = np.asarray(scores[indices, :n_columns])
+            mean = block.mean(axis=0)
+            centroids._append_key(key)
+            centroids.count[-1] = len(indices)
+            centroids.mean[-1] = mean
+            centroids.m2[-1] = ((block - mean) ** 2).sum(axis=0)
+        return centroids
+
+    @classmethod
+    def load(cls, path, meta):
+        """Centroids saved for exactly the rows of meta, None when there are none"""
+        try:
+            saved = np.load(os.path.join(path, 'centroids.npz'))
+        except FileNotFoundError:
+            return None
+        with saved:
+            if int(saved['rows']) != len(meta['analysis_ids']) or int(saved['removed']) != len(meta['removed']):
+                return None
+            centroids = cls(saved['diseases'].tolist(), saved['labels'].tolist(), saved['count'],
+                            saved['mean'], saved['m2'])
+        centroids.resize(len(meta['pathways']))
+        return centroids
+
+    def save(self, path, meta):
+        diseases = [disease for disease, _ in self.keys]
+        labels = [label for _, label in self.keys]
+        with open(os.path.join(path, 'centroids.npz.tmp'), 'wb') as f:
+            np.savez(f, rows=len(meta['analysis_ids']), removed=len(meta['removed']),
+                     diseases=np.array(diseases, dtype=str), labels=np.array(labels, dtype=str),
+                     count=self.count, mean=self.mean, m2=self.m2)
+        os.replace(os.path.join(path, 'centroids.npz.tmp'), os.path.join(path, 'centroids.npz'))
+
+    def resize(self, n_columns):
+        """Adding columns for new pathways, which every earlier row scored 0"""
+        extra = n_columns - self.mean.shape[1]
+        if extra > 0:
+            self.mean = np.hstack([self.mean, np.zeros((len(self.count), extra))])
+            self.m2 = np.hstack([self.m2, np.zeros((len(self.count), extra))])
+
+    def _append_key(self, key):
+        self.keys[key] = len(self.keys)
+        self.count = np.append(self.count, 0)
+        self.mean = np.vstack([self.mean, np.zeros(self.mean.shape[1])])
+        self.m2 = np.vstack([self.m2, np.zeros(self.m2.shape[1])])
+        return self.keys[key]
+
+    def add(self, disease, label, x):
+        i = self.keys.get((disease, label))
+        if i is None:
+            i = self._append_key((disease, label))
+        self.count[i] += 1
+        delta = x - self.mean[i]
+        self.mean[i] += delta / self.count[i]
+        self.m2[i] += delta * (x - self.mean[i])
+
+    def remove(self, disease, label, x):
+        i = self.keys.get((disease, label))
+        if i is None or not self.count[i]:
+            return
+        self.count[i] -= 1
+        if not self.count[i]:
+            self.mean[i] = 0
+            self.m2[i] = 0
+            return
+        delta = x - self.mean[i]
+        self.mean[i] -= delta / self.count[i]
+        self.m2[i] = np.maximum(self.m2[i] - delta * (x - self.mean[i]), 0)
+
+    def profiles(self, excluded_labels=()):
+        """
+        Mean and variance profile of every disease over its labels not excluded
+            - response:
+                (diseases, counts, means, variances), one row of means and
+                variances per disease
+        """
+        merged = {}
+        for (disease, label), i in self.keys.items():
+            if label not in excluded_labels and self.count[i]:
+                merged.setdefault(disease, []).append(i)
+        diseases = sorted(merged)
+        n_columns = self.mean.shape[1]
+        counts = np.zeros(len(diseases), dtype=np.int64)
+        means = np.zeros((len(diseases), n_columns))
+        variances = np.zeros((len(diseases), n_columns))
+        for j, disease in enumerate(diseases):
+            indices = merged[disease]
+            count = self.count[indices]
+            mean = (count[:, None] * self.mean[indices]).sum(axis=0) / count.sum()
+            m2 = (self.m2[indices] + count[:, None] * (self.mean[indices] - mean) ** 2).sum(axis=0)
+            counts[j], means[j], variances[j] = count.sum(), mean, m2 / count.sum()
+        return diseases, counts, means, variances
+
+
+def get_corpus(method_id):
+    """
+    Getting the corpus of a method, None when it was never built
+    The corpus is mapped again only when its meta.json was replaced.
+    """
+    meta_path = os.path.join(CORPUS_PATH, str(method_id), 'meta.json')
+    try:
+        stat = os.stat(meta_path)
+    except FileNotFoundError:
+        return None
+    # meta.json is replaced on every write, so its inode changes even within one mtime tick
+    mtime = (stat.st_ino, stat.st_mtime_ns)
+    loaded = _corpora.get(method_id)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+    with _corpora_lock:
+        loaded = _corpora.get(method_id)
+        if loaded is None or loaded[0] != mtime:
+            loaded = (mtime, PathwayCorpus.load(method_id))
+            _corpora[method_id] = loaded
+    return loaded[1]
+
+
+@contextmanager
+def _locked(path):
+    """Lock shared by every process writing to the corpus at path"""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') == CORPUS_VERSION:
+            return meta
+    except FileNotFoundError:
+        pass
+    return {'version': CORPUS_VERSION, 'generation': 0, 'pathways': [], 'analysis_ids': [],
+            'diseases': [], 'labels': [], 'removed': []}
+
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+def _current_centroids(path, meta):
+    """Centroids of the rows meta.json knows of, recomputed when the saved ones do not match"""
+    centroids = DiseaseCentroids.load(path, meta)
+    if centroids is None:
+        if meta['analysis_ids']:
+            centroids = DiseaseCentroids.from_rows(meta, PathwayCorpus(path, meta).scores)
+        else:
+            centroids = DiseaseCentroids.empty(len(meta['pathways']))
+    return centroids
+
+
+def _encode_rows(pathways, results_pathways):
+    """Rows of scores (with sum and sum of squares) and presence flags in the column order"""
+    columns = {pathway: i for i, pathway in enumerate(pathways)}
+    scores = np.zeros((len(results_pathways), len(pathways) + 2))
+    present = np.zeros((len(results_pathways), len(pathways)), dtype=np.uint8)
+    for i, results_pathway in enumerate(results_pathways):
+        for pathway, value in results_pathway.items():
+            scores[i, columns[pathway]] = _value(value)
+            present[i, columns[pathway]] = 1
+    scores[:, -2] = scores[:, :-2].sum(axis=1)
+    scores[:, -1] = (scores[:, :-2] ** 2).sum(axis=1)
+    return scores, present
+
+
+def _write_generation(path, meta, pathways, scores, present):
+    """Writing all rows into files of a new generation and dropping the old ones"""
+    old = (meta.get('scores'), meta.get('present'))
+    meta['generation'] += 1
+    meta['pathways'] = pathways
+    meta['scores'] = 'scores-%d.f8' % meta['generation']
+    meta['present'] = 'present-%d.u1' % meta['generation']
+    scores.tofile(os.path.join(path, meta['scores']))
+    present.tofile(os.path.join(path, meta['present']))
+    _write_meta(path, meta)
+    for name in old:
+        if name:  # processes still mapping them keep their copy until they remap
+            try:
+                os.remove(os.path.join(path, name))
+            except FileNotFoundError:
+                pass
+
+
+def append_rows(method_id, rows):
+    """
+    Adding finished analyses to the corpus of a method
+        - params:
+            rows : list of (analysis id, disease, label, results_pathway)
+    Analyses already in the corpus are skipped.
+    """
+    path = os.path.join(CORPUS_PATH, str(method_id))
+    with _locked(path):
+        meta = _read_meta(path)
+        known = set(meta['analysis_ids'])
+        rows = [row for row in rows if row[0] not in known]
+        if not rows:
+            return
+        centroids = _current_centroids(path, meta)
+        pathways = list(meta['pathways'])
+        columns = set(pathways)
+        for _, _, _, results_pathway in rows:
+            for pathway in results_pathway:
+                if pathway not in columns:
+                    columns.add(pathway)
+                    pathways.append(pathway)
+        scores, present = _encode_rows(pathways, [row[3] for row in rows])
+        centroids.resize(len(pathways))
+        for (_, disease, label, _), row_scores in zip(rows, scores):
+            centroids.add(disease, label, row_scores[:-2])
+
+        meta['analysis_ids'] += [row[0] for row in rows]
+        meta['diseases'] += [row[1] for row in rows]
+        meta['labels'] += [row[2] for row in rows]
+        if len(pathways) == len(meta['pathways']) and meta.get('scores'):
+            # Writing right after the rows meta.json knows of, in case an earlier
+            # append was interrupted before its meta.json was written
+            n_old = len(meta['analysis_ids']) - len(rows)
+            for name, block in ((meta['scores'], scores), (meta['present'], present)):
+                with open(os.path.join(path, name), 'r+b') as f:
+                    f.seek(n_old * block.itemsize * block.shape[1])
+                    f.truncate()
+                    block.tofile(f)
+            centroids.save(path, meta)
+            _write_meta(path, meta)
+        else:
+            n_old = len(meta['analysis_ids']) - len(rows)
+            old = PathwayCorpus(path, dict(meta, analysis_ids=meta['analysis_ids'][:n_old],
+                                           diseases=meta['diseases'][:n_old])) if n_old else None
+            n_columns = len(meta['pathways'])
+            all_scores = np.zeros((n_old, len(pathways) + 2))
+            all_present = np.zeros((n_old, len(pathways)), dtype=np.uint8)
+            if old is not None:
+                all_scores[:, :n_columns] = old.scores[:, :n_columns]
+                all_scores[:, -2:] = old.scores[:, n_columns:]
+                all_present[:, :n_columns] = old.present
+            centroids.save(path, meta)
+            _write_generation(path, meta, pathways, np.vstack([all_scores, scores]),
+                              np.vstack([all_present, present]))
+
+
+def remove_analyses(method_id, analysis_ids):
+    """Leaving deleted analyses out of the corpus of a method until it is rebuilt"""
+    path = os.path.join(CORPUS_PATH, str(method_id))
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return
+    with _locked(path):
+        meta = _read_meta(path)
+        removed = set(meta['removed'])
+        known = set(meta['analysis_ids'])
+        added = [i for i in analysis_ids if i in known and i not in removed]
+        if added:
+            centroids = _current_centroids(path, meta)
+            corpus = PathwayCorpus(path, meta)
+            n_columns = len(meta['pathways'])
+            rows = {analysis_id: i for i, analysis_id in enumerate(meta['analysis_ids'])}
+            for analysis_id in added:
+                i = rows[analysis_id]
+                centroids.remove(meta['diseases'][i], meta['labels'][i], corpus.scores[i, :n_columns])
+            meta['removed'] += added
+            centroids.save(path, meta)
+            _write_meta(path, meta)
+
+
+def rebuild(method_id, rows):
+    """
+    Writing the corpus of a method from scratch
+        - params:
+            rows : iterable of (analysis id, disease, label, results_pathway)
+    """
+    path = os.path.join(CORPUS_PATH, str(method_id))
+    rows = list(rows)
+    pathways = []
+    columns = set()
+    for _, _, _, results_pathway in rows:
+        for pathway in results_pathway:
+            if pathway not in columns:
+                columns.add(pathway)
+                pathways.append(pathway)
+    scores, present = _encode_rows(pathways, [row[3] for row in rows])
+    with _locked(path):
+        meta = _read_meta(path)
+        meta['analysis_ids'] = [row[0] for row in rows]
+        meta['diseases'] = [row[1] for row in rows]
+        meta['labels'] = [row[2] for row in rows]
+        meta['removed'] = []
+        meta['pathways'] = pathways  # the column order from_rows reads
+        DiseaseCentroids.from_rows(meta, scores).save(path, meta)
+        _write_generation(path, meta, pathways, scores, present)
+
+
+def _corpus_query(query):
+    """Public analyses most_similar_diseases compares against, as corpus rows"""
+    from sqlalchemy import or_
+    from .models import Analyses, AnalysisMetadata, Diseases
+
+    return query.join(AnalysisMetadata).join(Diseases).filter(
+        Analyses.type == 'public').filter(Analyses.results_pathway != None).filter(
+            or_(Analyses.label == 'not_provided', Analyses.label.like('%label avg%'))).with_entities(
+                Analyses.id, AnalysisMetadata.method_id, Diseases.name, Diseases.synonym,
+                Analyses.label, Analyses.results_pathway)
+
+
+def _corpus_row(row):
+    analysis_id, _, name, synonym, label, results_pathway = row
+    # diseases without a synonym are listed by their name alone
+    disease = name + ' (' + synonym + ')' if synonym else name
+    return analysis_id, disease, label, results_pathway[0]
+
+
+def update_corpus(analysis_ids):
+    """
+    Adding finished analyses to the corpora of their methods
+    Corpora that were never built are left alone, build_corpus creates them.
+    """
+    from .models import db, Analyses
+
+    try:
+        rows = _corpus_query(db.session.query(Analyses).filter(Analyses.id.in_(list(analysis_ids)))).all()
+        by_method = {}
+        for row in rows:
+            by_method.setdefault(row[1], []).append(_corpus_row(row))
+        for method_id, method_rows in by_method.items():
+            if os.path.exists(os.path.join(CORPUS_PATH, str(method_id), 'meta.json')):
+                append_rows(method_id, method_rows)
+    except Exception:  # the corpus can be rebuilt, never fail the analysis for it
+        from .app import app
+
+        app.logger.exception('Analyses %s were not added to the corpus, build-corpus adds them', analysis_ids)
+
+
+def remove_from_corpus(analysis_ids):
+    """Leaving analyses about to be deleted out of the corpora"""
+    from .models import db, Analyses, AnalysisMetadata
+
+    try:
+        rows = db.session.query(Analyses).join(AnalysisMetadata).filter(
+            Analyses.id.in_(list(analysis_ids))).with_entities(Analyses.id, AnalysisMetadata.method_id).all()
+        by_method = {}
+        for analysis_id, method_id in rows:
+            by_method.setdefault(method_id, []).append(analysis_id)
+        for method_id, ids in by_method.items():
+            remove_analyses(method_id, ids)
+    except Exception:
+        from .app import app
+
+        app.logger.exception('Analyses %s were not removed from the corpus, build-corpus drops them', analysis_ids)
+
+
+def build_corpus(method_id, batch_size=500):
+    """Building the corpus of a method from every public analysis in the database"""
+    from .models import db, Analyses, AnalysisMetadata
+
+    rows = _corpus_query(db.session.query(Analyses)).filter(AnalysisMetadata.method_id == method_id).execution_options(
+        stream_results=True).yield_per(batch_size)
+    rebuild(method_id, (_corpus_row(row) for row in rows))
@@ -0,0 +1,196 @@
+import os
+import json
+import pickle
+import threading
+
+TRAINED_MODELS_PATH = '../trained_models'
+
+SCORE_FIELDS = ('fold_number', 'f1_score', 'precision_score', 'recall_score', 'algorithm')
+
+_registry = {}
+_registry_lock = threading.Lock()
+_scores = {}
+_scores_lock = threading.Lock()
+
+
+def _scan(path):
+    """Name, mtime and size of every model file, changing whenever a model is written"""
+    files = []
+    for entry in os.scandir(path):
+        if entry.name == '.keep' or entry.name.endswith(('.tmp', '.json')) or not entry.is_file():
+            continue
+        stat = entry.stat()
+        files.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(files))
+
+
+def sidecar_path(model_path):
+    """Path of the json file keeping the scores of a model, next to the model"""
+    return os.path.splitext(model_path)[0] + '.json'
+
+
+def _scan_scores(path):
+    """Name of every model file having a sidecar, with the mtime and size of the sidecar"""
+    files = []
+    for name, _, _ in _scan(path):
+        try:
+            stat = os.stat(sidecar_path(os.path.join(path, name)))
+        except OSError:  # listed once backfill_sidecars has written it
+            continue
+        files.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(files)
+
+
+def _read_scores(model_path):
+    """Getting (disease, scores) of a model from its sidecar"""
+    with open(sidecar_path(model_path)) as f:
+        saved = json.load(f)
+    return saved['disease'], {field: saved[field] for field in SCORE_FIELDS}
+
+
+def write_sidecar(model_path, saved):
+    """Writing the scores of a saved model next to it, aside and renamed"""
+    sidecar = sidecar_path(model_path)
+    with open(sidecar + '.tmp', 'w') as f:
+        json.dump({k: v for k, v in saved.items() if k != 'model'}, f)
+    os.replace(sidecar + '.tmp', sidecar)
+
+
+def backfill_sidecars(path=TRAINED_MODELS_PATH):
+    """
+    Writing the sidecars missing for models saved before sidecars were written
+        - response:
+            number of sidecars written
+    Each such model is unpickled once here, so that get_model_scores never has to.
+    """
+    written = 0
+    for name, _, _ in _scan(path):
+        model_path = os.path.join(path, name)
+        if os.path.isfile(sidecar_path(model_path)):
+            continue
+        try:
+            with open(model_path, 'rb') as f:
+                write_sidecar(model_path, pickle.load(f))
+            written += 1
+        except Exception as e:
+            print(e)
+    return written
+
+
+def get_model_scores(path=TRAINED_MODELS_PATH):
+    """
+    Getting the scores of every trained model, as a dict of disease to scores
+    They are read from the json sidecars only, once per sidecar, and read again
+    only for the models rewritten by a retrain, like get_disease_models.
+    Models without a sidecar are left out until backfill_sidecars runs.
+    """
+    files = _scan_scores(path)
+    loaded = _scores.get(path)
+    if loaded is not None and loaded['files'] == files:
+        return loaded['scores']
+
+    with _scores_lock:
+        loaded = _scores.get(path)
+        if loaded is not None and loaded['files'] == files:
+            return loaded['scores']
+        previous = loaded['entries'] if loaded is not None else {}
+        entries = {}
+        for file in files:
+            entry = previous.get(file)
+            if entry is None:
+                try:
+                    entry = _read_scores(os.path.join(path, file[0]))
+                except Exception as e:
+                    print(e)
+                    continue
+            entries[file] = entry
+        scores = {disease: model_scores for disease, model_scores in (entries[f] for f in files if f in entries)}
+        _scores[path] = {'files': files, 'entries': entries, 'scores': scores}
+    return scores
+
+
+def _load_model(path):
+    """
+    Loading a saved disease model, split into its vectorizer and the estimator after it
+    Models saved before the training matrix was introduced take result dicts
+    directly and have no vectorizer.
+    """
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    model = saved['model']
+    entry = {'disease': saved['disease'], 'vectorizer': None, 'estimator': model}
+    steps = getattr(model, 'steps', None)
+    if steps and steps[0][0] == 'vect':
+        entry['vectorizer'] = steps[0][1]
+        entry['estimator'] = model[1:]
+    return entry
+
+
+def get_disease_models(path=TRAINED_MODELS_PATH):
+    """
+    Getting the loaded disease models of this process
+        - response:
+            list of dicts with disease, vectorizer, vocabulary and estimator
+    Files are read again only when they were added, removed or rewritten, and
+    unchanged models are kept. The new list replaces the old one at once, so
+    requests running meanwhile keep using a complete set of models.
+    """
+    files = _scan(path)
+    loaded = _registry.get(path)
+    if loaded is not None and loaded['files'] == files:
+        return loaded['models']
+
+    with _registry_lock:
+        loaded = _registry.get(path)
+        if loaded is not None and loaded['files'] == files:
+            return loaded['models']
+        previous = loaded['entries'] if loaded is not None else {}
+        entries = {}
+        for file in files:
+            entry = previous.get(file)
+            if entry is None:
+                try:
+                    entry = _load_model(os.path.join(path, file[0]))
+                except Exception as e:
+                    print(e)
+                    continue
+            entries[file] = entry
+
+        # Models sharing a reaction vocabulary share one vectorized sample
+        vocabularies = {}
+        models = []
+        for file in files:
+            entry = entries.get(file)
+            if entry is None:
+                continue
+            vocabulary = None
+            if entry['vectorizer'] is not None:
+                vocabulary = vocabularies.setdefault(tuple(entry['vectorizer'].feature_names_), len(vocabularies))
+            models.append(dict(entry, vocabulary=vocabulary))
+        _registry[path] = {'files': files, 'entries': entries, 'models': models}
+    return models
+
+
+def predict_diseases(results_reaction, path=TRAINED_MODELS_PATH):
+    """
+    Running every disease model on the reaction results of one analysis
+        - response:
+            list of {'disease', 'pred_score'} for the models predicting the disease
+    """
+    samples = {}
+    preds = []
+    for model in get_disease_models(path):
+        try:
+            if model['vocabulary'] is None:
+                X = [results_reaction]
+            else:
+                X = samples.get(model['vocabulary'])
+                if X is None:
+                    X = samples[model['vocabulary']] = model['vectorizer'].transform([results_reaction])
+            pred = model['estimator'].predict(X)[0]
+            pred_score = max(model['estimator'].predict_proba(X)[0])
+            if pred != 0:
+                preds.append({'disease': model['disease'], 'pred_score': round(pred_score, 3)})
+        except Exception as e:
+            print(e)
+    return preds
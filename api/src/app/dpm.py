@@ -1,10 +1,168 @@
-from .base import MetaboliticsBase
+import threading
+
+import numpy as np
+
+from .base import load_compiled_network
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_dpm_engine(dataset='recon3D'):
+    """Getting the DPM engine of the given dataset, built once per process"""
+    engine = _engines.get(dataset)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(dataset)
+            if engine is None:
+                engine = DirectPathwayMappingEngine(dataset)
+                _engines[dataset] = engine
+    return engine
+
+
+class DirectPathwayMappingEngine():
+    """
+    Direct Pathway Mapping over precomputed sparse incidence matrices
+
+    reaction_matrix is reactions x metabolites and marks the participating
+    metabolites of every reaction. pathway_matrix is metabolites x pathways
+    and marks the subsystems reachable from a metabolite through its
+    reactions. Scores are sums of fold changes over these incidences divided
+    by the number of measured metabolites taking part.
+    """
+
+    def __init__(self, dataset='recon3D'):
+        from scipy import sparse
+
+        network = load_compiled_network(dataset)
+        n_reactions, n_pathways = network.n_reactions, network.n_pathways
+        self.metabolite_names = network.metabolite_names
+        self.reaction_names = network.reaction_names
+        self.pathway_names = network.pathway_names
+        self.metabolite_index = {m: i for i, m in enumerate(self.metabolite_names)}
+
+        # Indices are kept in network order so sums run in the same order as before
+        self.reaction_matrix = network.reaction_incidence()
+
+        metabolite_reactions = network.metabolite_incidence()
+        subsystems = np.asarray(network.reaction_subsystem)
+        has_subsystem = np.flatnonzero(subsystems >= 0)
+        reaction_pathways = sparse.csr_matrix(
+            (np.ones(len(has_subsystem)), (has_subsystem, subsystems[has_subsystem])),
+            shape=(n_reactions, n_pathways))
+        pathway_matrix = (metabolite_reactions @ reaction_pathways).tocsr()
+        pathway_matrix.data[:] = 1.0
+        self.pathway_matrix = pathway_matrix
+
+    def vectorize(self, fold_changes):
+        """
+        Turning a fold change dict into network-ordered arrays
+            response:
+                - indices of the measured metabolites in the order of fold_changes
+                - their fold changes
+        """
+        indices, values = [], []
+        for metabolite, value in fold_changes.items():
+            index = self.metabolite_index.get(metabolite)
+            if index is not None:
+                indices.append(index)
+                values.append(value)
+        return np.array(indices, dtype=np.int64), np.array(values, dtype=np.float64)
+
+    def score_reactions(self, fold_changes):
+        indices, values = self.vectorize(fold_changes)
+        x = np.zeros(len(self.metabolite_names))
+        x[indices] = values
+        measured = np.zeros(len(self.metabolite_names))
+        measured[indices] = 1.0
+        totals = self.reaction_matrix @ x
+        counts = self.reaction_matrix @ measured
+        scored = np.flatnonzero(counts)
+        scores = (totals[scored] / counts[scored]).tolist()
+        return {self.reaction_names[i]: score for i, score in zip(scored, scores)}
+
+    def score_pathways(self, fold_changes):
+        return self._score_pathways(*self.vectorize(fold_changes))
+
+    def _score_pathways(self, indices, values):
+        # Transposed rows are summed metabolite by metabolite in fold_changes order
+        membership = self.pathway_matrix[indices].T
+        totals = membership @ values
+        counts = membership @ np.ones(len(indices))
+        scored = np.flatnonzero(counts)
+        scores = (totals[scored] / counts[scored]).tolist()
+        return {self.pathway_names[i]: score for i, score in zip(scored, scores)}
+
+    def vectorize_many(self, cases, metabolites=None):
+        """
+        Turning many cases into a metabolites x cases matrix
+            params:
+                - cases: list of fold change dicts, or a cases x metabolites
+                  matrix whose columns are named by metabolites (nan marks
+                  a metabolite that was not measured)
+            response:
+                - fold changes, zero where not measured
+                - 1.0 where measured, 0.0 elsewhere
+        """
+        if metabolites is None:
+            X = np.zeros((len(self.metabolite_names), len(cases)))
+            measured = np.zeros_like(X)
+            for j, fold_changes in enumerate(cases):
+                indices, values = self.vectorize(fold_changes)
+                X[indices, j] = values
+                measured[indices, j] = 1.0
+            return X, measured
+        columns = [self.metabolite_index.get(m) for m in metabolites]
+        known = [i for i, index in enumerate(columns) if index is not None]
+        rows = [columns[i] for i in known]
+        values = np.asarray(cases, dtype=np.float64)[:, known].T
+        X = np.zeros((len(self.metabolite_names), values.shape[1]))
+        measured = np.zeros_like(X)
+        X[rows] = np.nan_to_num(values)
+        measured[rows] = ~np.isnan(values)
+        return X, measured
+
+    def _scores_to_dicts(self, totals, counts, names):
+        results = []
+        for j in range(totals.shape[1]):
+            scored = np.flatnonzero(counts[:, j])
+            scores = (totals[scored, j] / counts[scored, j]).tolist()
+            results.append({names[i]: score for i, score in zip(scored, scores)})
+        return results
+
+    def score_many(self, cases, metabolites=None):
+        """
+        Scoring pathways and reactions of many cases at once
+            params:
+                - cases, metabolites: see vectorize_many
+            response:
+                - list of pathway score dicts, one per case
+                - list of reaction score dicts, one per case
+        """
+        X, measured = self.vectorize_many(cases, metabolites)
+        reactions = self._scores_to_dicts(
+            self.reaction_matrix @ X, self.reaction_matrix @ measured, self.reaction_names)
+        # Pathway sums run case by case in the metabolite order of the case, as
+        # in score_pathways, so that the scores stay bit-identical
+        if metabolites is None:
+            pathways = [self.score_pathways(fold_changes) for fold_changes in cases]
+        else:
+            columns = [self.metabolite_index.get(m) for m in metabolites]
+            known = [i for i, index in enumerate(columns) if index is not None]
+            rows = np.array([columns[i] for i in known], dtype=np.int64)
+            values = np.asarray(cases, dtype=np.float64)[:, known]
+            pathways = []
+            for case in values:
+                kept = ~np.isnan(case)
+                pathways.append(self._score_pathways(rows[kept], case[kept]))
+        return pathways, reactions
+
 
 class DirectPathwayMapping():
-    def __init__(self, concentration_table):
+    def __init__(self, concentration_table, dataset='recon3D'):
         self.name = "Direct Pathway Mapping"
         self.fold_changes = concentration_table
-        self.base = MetaboliticsBase()
+        self.engine = get_dpm_engine(dataset)
         self.result_pathways = {}
         self.result_reactions = {}
 
@@ -13,41 +171,14 @@ class DirectPathwayMapping():
             response:
                 - dict
         """
-        reactions = self.base.get_reaction_names()  # Getting reaction names
-        reaction_scores = {}  # Scores will be stored
-        for reaction in reactions:
-            metabolites = self.base.get_metabolites_by_reaction(reaction)  # Get metabolites
-            # Total is the sum of fold changes
-            # Denominator is the number of participating metabolites
-            total, denominator = 0, 0
-            for metabolite in metabolites:
-                if metabolite in self.fold_changes:
-                    total += self.fold_changes[metabolite]
-                    denominator += 1.0
-            if denominator != 0:
-                reaction_scores[reaction] = total/denominator
-        return reaction_scores
+        return self.engine.score_reactions(self.fold_changes)
     
     def score_pathways(self):
-        pathways_scores, pathway_metabolites = {}, {}    # Scores will be stored
-        metabolites = self.fold_changes.keys()  # Getting metabolite names of user-uploaded data
-        for metabolite in metabolites:
-            if metabolite in self.base.data['metabolites']:
-                reactions = self.base.get_reactions_by_metabolite(metabolite)  # Getting reactions
-                pathways = []
-                for reaction in reactions:
-                    if 'subsystem' in self.base.data['reactions'][reaction]:
-                        pathways.append(self.base.data['reactions'][reaction]['subsystem'])
-                subsystems = set(pathways)  # Removing duplicates
-                for subsystem in subsystems:
-                    pathways_scores.setdefault(subsystem, 0)
-                    pathways_scores[subsystem] += self.fold_changes[metabolite]  # Scoring
-                    pathway_metabolites.setdefault(subsystem, [])
-                    pathway_metabolites[subsystem].append(metabolite)
-        # Taking the average of pathway scores
-        for pathway in pathways_scores:
-            pathways_scores[pathway] = pathways_scores[pathway]/len(pathway_metabolites[pathway])
-        return pathways_scores
+        """ Scoring all the pathways
+            response:
+                - dict
+        """
+        return self.engine.score_pathways(self.fold_changes)
     
     def display_pathway_scores(self):
         if len(self.result_pathways) != 0:
@@ -0,0 +1,161 @@
+import os
+import sys
+from contextlib import contextmanager
+
+from .pipelines import MODEL_PATH
+
+# Processes and reactions per chunk used for the FVA of a single sample
+FVA_PROCESSES = int(os.getenv('FVA_PROCESSES', os.cpu_count() or 1))
+FVA_CHUNK_SIZE = int(os.getenv('FVA_CHUNK_SIZE', 250))
+# Seconds an idle pool process is kept, with its loaded model
+FVA_POOL_TIMEOUT = int(os.getenv('FVA_POOL_TIMEOUT', 3600))
+
+def _fva_chunk(model_path, changes, reaction_ids):
+    """
+    FVA of a chunk in a pool process, on the model this process loaded from model_path
+    The changes of the sample are applied for the chunk only and then put back,
+    so the process keeps one LP that it re-solves from sample to sample.
+    """
+    from cobra.flux_analysis import flux_variability_analysis
+    from .pipelines import get_analysis_pipelines
+
+    reaction_scaler, _ = get_analysis_pipelines(model_path)
+    model = reaction_scaler.steps[0][1].analyzer.model
+    bounds, objective, direction = changes
+    with model:
+        for reaction_id, reaction_bounds in bounds.items():
+            model.reactions.get_by_id(reaction_id).bounds = reaction_bounds
+        model.objective = {model.reactions.get_by_id(reaction_id): coefficient
+                           for reaction_id, coefficient in objective.items()}
+        model.objective_direction = direction
+        return flux_variability_analysis(model, reaction_list=reaction_ids, processes=1)
+
+
+def _sample_changes(model, base_bounds=None):
+    """Bounds differing from base_bounds, every bound without it, and the objective of model"""
+    from cobra.util.solver import linear_reaction_coefficients
+
+    bounds = {reaction.id: reaction.bounds for reaction in model.reactions
+              if base_bounds is None or reaction.bounds != base_bounds[reaction.id]}
+    objective = {reaction.id: coefficient for reaction, coefficient in linear_reaction_coefficients(model).items()}
+    return bounds, objective, model.objective_direction
+
+
+def chunked_flux_variability(model, processes=FVA_PROCESSES, chunk_size=FVA_CHUNK_SIZE, progress=None,
+                             base_bounds=None, model_path=MODEL_PATH):
+    """
+    Flux variability analysis of every reaction, split into chunks run across a process pool
+        - params:
+            model : cobra model with the objective of the sample already set
+            processes : size of the pool, 1 runs the chunks in this process
+            chunk_size : number of reactions per chunk
+            progress : callable taking (reactions done, total reactions)
+            base_bounds : bounds of the model at model_path, by reaction id, optional
+            model_path : pickled pipelines the pool processes load their model from
+        - response:
+            minimum and maximum flux of each reaction, in the order of model.reactions
+    The pool is kept for the life of this process, and each pool process loads
+    the model of model_path once. Only the bounds and objective of the sample
+    are sent to it, instead of the whole model.
+    """
+    import pandas as pd
+    from cobra.flux_analysis import flux_variability_analysis
+
+    reaction_ids = [reaction.id for reaction in model.reactions]
+    chunks = [reaction_ids[i:i + chunk_size] for i in range(0, len(reaction_ids), chunk_size)]
+    total = len(reaction_ids)
+    done = 0
+    frames = []
+    if progress is not None:
+        progress(done, total)
+
+    if processes <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            frames.append(flux_variability_analysis(model, reaction_list=chunk, processes=1))
+            done += len(chunk)
+            if progress is not None:
+                progress(done, total)
+    else:
+        # loky pools can be started from celery worker processes, unlike multiprocessing ones
+        from concurrent.futures import as_completed
+        from joblib.externals.loky import get_reusable_executor
+
+        changes = _sample_changes(model, base_bounds)
+        executor = get_reusable_executor(max_workers=processes, timeout=FVA_POOL_TIMEOUT)
+        futures = {executor.submit(_fva_chunk, model_path, changes, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            frames.append(future.result())
+            done += len(futures[future])
+            if progress is not None:
+                progress(done, total)
+
+    return pd.concat(frames).loc[reaction_ids]
+
+
+@contextmanager
+def _patched_fva(analyzer, fva):
+    """
+    Replacing the flux_variability_analysis used by the analyzer, so that its own
+    preparation of the model (knock outs, gene bounds, objective) is kept as is
+    """
+    module = sys.modules[type(analyzer).__module__]
+    original = module.flux_variability_analysis
+    module.flux_variability_analysis = fva
+    try:
+        yield
+    finally:
+        module.flux_variability_analysis = original
+
+
+def fva_transform(transformer, x, x_tr=None, processes=FVA_PROCESSES, progress=None, model_path=MODEL_PATH):
+    """
+    Chunked counterpart of MetaboliticsTransformer's fva transform for one sample
+    The model of the transformer is prepared for the sample in place and put
+    back afterwards, instead of being copied as MetaboliticsTransformer does,
+    so its LP and solver settings are kept from one sample to the next.
+    """
+    analyzer = transformer.analyzer
+    base_bounds = {reaction.id: reaction.bounds for reaction in analyzer.model.reactions}
+
+    def fva(model, **kwargs):
+        return chunked_flux_variability(model, processes=processes, progress=progress,
+                                        base_bounds=base_bounds, model_path=model_path)
+
+    with analyzer.model, _patched_fva(analyzer, fva):
+        df = analyzer.variability_analysis(x, x_tr if x_tr is not None else {})
+
+    x_t = dict()
+    for r in df.itertuples():
+        x_t['%s_max' % r.Index] = r.maximum
+        x_t['%s_min' % r.Index] = r.minimum
+    return x_t
+
+
+def uses_chunked_fva(reaction_scaler):
+    """Whether transform_sample runs the FVA of reaction_scaler in chunks"""
+    steps = getattr(reaction_scaler, 'steps', None)
+    transformer = steps[0][1] if steps else None
+    return transformer is not None and getattr(transformer, 'flux_type', None) == 'fva'
+
+
+def transform_sample(reaction_scaler, concentration_changes, gene_changes=None,
+                     processes=FVA_PROCESSES, progress=None):
+    """
+    Running the reaction pipeline for a single sample with a parallel FVA
+        - params:
+            reaction_scaler : pipeline whose first step is the metabolitics transformer
+            concentration_changes : fold changes of the sample
+            gene_changes : gene fold changes of the sample, optional
+            progress : callable taking (reactions done, total reactions)
+        - response:
+            reaction results in the form returned by reaction_scaler.transform
+    Pipelines not starting with an fva metabolitics transformer are run as before.
+    """
+    if not uses_chunked_fva(reaction_scaler):
+        return reaction_scaler.transform([concentration_changes], gene_changes)
+
+    steps = reaction_scaler.steps
+    results = [fva_transform(steps[0][1], concentration_changes, gene_changes, processes, progress)]
+    for _, step in steps[1:]:
+        results = step.transform(results)
+    return results
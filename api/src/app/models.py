@@ -1,4 +1,5 @@
 import uuid
+import hashlib
 import datetime
 import json
 
@@ -73,6 +74,8 @@ class AnalysisMetadata(db.Model):
     name = db.Column(db.String())
     analysis_method_id = db.Column(db.Integer, db.ForeignKey('analysismethods.id'))
     analysis_method = db.relationship('AnalysisMethod')
+    # the name the views, tasks and study summaries use
+    method_id = db.synonym('analysis_method_id')
     diffusion_id = db.Column(db.Integer, db.ForeignKey('diffusionmethods.id'))
     diffusion_method = db.relationship('DiffusionMethod')
     status = db.Column(db.Boolean)
@@ -201,4 +204,70 @@ class DiseaseModel(db.Model):
     algorithm = db.Column(db.String())
 
     def __repr__(self):
-        return '<DiseaseModel %r>' % self.id
\ No newline at end of file
+        return '<DiseaseModel %r>' % self.id
+
+
+class DiseaseTrainingSet(db.Model):
+    """Fingerprint of the public analyses a disease was last trained on"""
+    __tablename__ = 'diseasetrainingsets'
+    id = db.Column(db.Integer, primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('diseases.id'), unique=True)
+    fingerprint = db.Column(db.String(40))
+    analysis_count = db.Column(db.Integer)
+    last_end_time = db.Column(db.DateTime)
+    trained_at = db.Column(db.DateTime)
+
+    @staticmethod
+    def make_fingerprint(analysis_ids, last_end_time):
+        """Hash of the training analysis ids and the newest of their end times"""
+        payload = ','.join(str(i) for i in sorted(analysis_ids)) + '|' + str(last_end_time)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return '<DiseaseTrainingSet %r>' % self.disease_id
+
+
+class DiseaseTrainingRecord(db.Model):
+    """One training run of a disease model, with its cost and winning algorithm"""
+    __tablename__ = 'diseasetrainingrecords'
+    id = db.Column(db.Integer, primary_key=True)
+    disease_id = db.Column(db.Integer, db.ForeignKey('diseases.id'))
+    started_at = db.Column(db.DateTime)
+    duration = db.Column(db.Float())
+    peak_memory_kb = db.Column(db.Float())
+    sample_count = db.Column(db.Integer)
+    algorithm = db.Column(db.String())
+    f1_score = db.Column(db.Float())
+    saved = db.Column(db.Boolean)
+
+    def __repr__(self):
+        return '<DiseaseTrainingRecord %r>' % self.id
+
+
+class StudySummary(db.Model):
+    """
+    Listing row of a study, rewritten by refresh_study_summaries in the same
+    transaction as the analyses of the study that started, finished or were deleted.
+    A study has one row per type of its analyses, and private rows one per owner.
+    """
+    __tablename__ = 'studysummaries'
+    __table_args__ = (db.UniqueConstraint('study_id', 'type', 'owner_user_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    study_id = db.Column(db.Integer, db.ForeignKey('analysismetadata.id'), index=True)
+    name = db.Column(db.String())
+    method_id = db.Column(db.Integer, index=True)
+    analysis_method = db.Column(db.String())
+    diffusion_method = db.Column(db.String())
+    disease_id = db.Column(db.Integer, index=True)
+    disease = db.Column(db.String())
+    type = db.Column(db.String(255), index=True)
+    owner_user_id = db.Column(db.Integer, index=True)
+    cases = db.Column(db.Integer)
+    finished = db.Column(db.Integer)
+    start_time = db.Column(db.DateTime)
+    end_time = db.Column(db.DateTime)
+    avg_id = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<StudySummary %r>' % self.study_id
@@ -1,12 +1,103 @@
-from .base import MetaboliticsBase
-from scipy.stats import hypergeom
-from statsmodels.stats.multitest import multipletests
+import threading
+
+import numpy as np
+
+from .base import load_compiled_network
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_pe_engine(dataset='recon3D'):
+    """Getting the PE engine of the given dataset, built once per process"""
+    engine = _engines.get(dataset)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(dataset)
+            if engine is None:
+                engine = PathwayEnrichmentEngine(dataset)
+                _engines[dataset] = engine
+    return engine
+
+
+class PathwayEnrichmentEngine():
+    """
+    Hypergeometric enrichment over precomputed set-membership matrices
+
+    For every pathway (or reaction) K is the size of its metabolite set and
+    k the number of measured metabolites in it. N is the number of network
+    metabolites and n the number of measured metabolites. All p-values of a
+    case come from one vectorized hypergeom.sf call and are BH corrected.
+    """
+
+    def __init__(self, dataset='recon3D'):
+        network = load_compiled_network(dataset)
+        self.metabolite_names = network.metabolite_names
+        self.reaction_names = network.reaction_names
+        self.pathway_names = network.pathway_names
+        self.metabolite_index = {m: i for i, m in enumerate(self.metabolite_names)}
+
+        self.reaction_matrix = network.reaction_incidence()
+        pathway_matrix = (network.pathway_incidence() @ self.reaction_matrix).tocsr()
+        pathway_matrix.data[:] = 1.0
+        self.pathway_matrix = pathway_matrix
+        self.reaction_sizes = np.asarray(self.reaction_matrix.sum(axis=1)).ravel()
+        self.pathway_sizes = np.asarray(self.pathway_matrix.sum(axis=1)).ravel()
+
+    def measured_matrix(self, cases):
+        """Metabolites x cases indicator of the measured network metabolites"""
+        measured = np.zeros((len(self.metabolite_names), len(cases)))
+        for j, fold_changes in enumerate(cases):
+            indices = [self.metabolite_index[m] for m in fold_changes if m in self.metabolite_index]
+            measured[indices, j] = 1.0
+        return measured
+
+    def _enrich(self, matrix, sizes, names, measured, n):
+        from scipy.stats import hypergeom
+        from statsmodels.stats.multitest import multipletests
+
+        k = matrix @ measured
+        p_values = hypergeom.sf(k - 1, len(self.metabolite_names), sizes[:, None], n[None, :])
+        results = []
+        for j in range(p_values.shape[1]):
+            q_values = multipletests(p_values[:, j], method="fdr_bh")[1]
+            results.append(dict(zip(names, q_values.tolist())))
+        return results
+
+    def score_many(self, cases, reactions=True):
+        """
+        Enriching pathways and reactions of many cases at once
+            params:
+                - cases: list of fold change dicts
+                - reactions: whether to enrich reactions as well
+            response:
+                - list of pathway q-value dicts, one per case
+                - list of reaction q-value dicts, one per case (None when skipped)
+        """
+        measured = self.measured_matrix(cases)
+        # n counts every uploaded metabolite, mapped to the network or not
+        n = np.array([len(fold_changes) for fold_changes in cases], dtype=np.float64)
+        pathways = self._enrich(self.pathway_matrix, self.pathway_sizes, self.pathway_names, measured, n)
+        if not reactions:
+            return pathways, None
+        return pathways, self._enrich(self.reaction_matrix, self.reaction_sizes, self.reaction_names, measured, n)
+
+    def score_pathways(self, fold_changes):
+        measured = self.measured_matrix([fold_changes])
+        n = np.array([len(fold_changes)], dtype=np.float64)
+        return self._enrich(self.pathway_matrix, self.pathway_sizes, self.pathway_names, measured, n)[0]
+
+    def score_reactions(self, fold_changes):
+        measured = self.measured_matrix([fold_changes])
+        n = np.array([len(fold_changes)], dtype=np.float64)
+        return self._enrich(self.reaction_matrix, self.reaction_sizes, self.reaction_names, measured, n)[0]
+
 
 class PathwayEnrichment():
-    def __init__(self, concentration_table):
+    def __init__(self, concentration_table, dataset='recon3D'):
         self.name = "Pathway Enrichment"
         self.fold_changes = concentration_table
-        self.base = MetaboliticsBase()
+        self.engine = get_pe_engine(dataset)
         self.result_pathways = {}
         self.result_reactions = {}
 
@@ -15,57 +106,14 @@ class PathwayEnrichment():
             response:
                 - dict
         """
-        reactions_scores = {}
-        all_metabolites = self.base.get_metabolite_names()
-        N = len(all_metabolites)
-        all_reactions = self.base.get_reaction_names()
-        data_metabolites = self.fold_changes.keys()
-        n = len(data_metabolites)
-
-        p_values = []
-        for reaction in all_reactions:
-            reaction_metabolites = self.base.get_metabolites_by_reaction(reaction)
-            K = len(reaction_metabolites)
-            common_metabolites = [value for value in data_metabolites if value in reaction_metabolites]
-            k = len(common_metabolites)
-            pval = hypergeom.sf(k-1, N, K, n)
-            #reactions_scores[reaction] = pval
-            p_values.append(pval)
-
-        q_values = multipletests(p_values, method="fdr_bh")[1]
-
-        for reaction, q_value in zip(all_reactions, q_values):
-            reactions_scores[reaction] = q_value
-        return reactions_scores
+        return self.engine.score_reactions(self.fold_changes)
     
     def score_pathways(self):
         """ Scoring all the pathways 
             response:
                 - dict
         """
-        pathways_scores = {}
-        all_metabolites = self.base.get_metabolite_names()
-        N = len(all_metabolites)
-        all_pathways = self.base.get_pathway_names()
-        data_metabolites = self.fold_changes.keys()
-        n = len(data_metabolites)
-
-        p_values = []
-        for pathway in all_pathways:
-            pathway_metabolites = self.base.get_metabolites_by_pathway(pathway)
-            K = len(pathway_metabolites)
-            common_metabolites = [value for value in data_metabolites if value in pathway_metabolites]
-            k = len(common_metabolites)
-            pval = hypergeom.sf(k-1, N, K, n)
-            #pathways_scores[pathway] = pval
-            p_values.append(pval)
-        
-        q_values = multipletests(p_values, method="fdr_bh")[1]
-        
-        for reaction, q_value in zip(all_pathways, q_values):
-            pathways_scores[reaction] = q_value
-        
-        return pathways_scores
+        return self.engine.score_pathways(self.fold_changes)
     
     def display_pathway_scores(self):
         if len(self.result_pathways) != 0:
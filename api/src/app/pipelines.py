@@ -0,0 +1,129 @@
+import os
+import pickle
+import hashlib
+import threading
+
+from celery.signals import worker_init, worker_process_init
+
+MODEL_PATH = '../models/api_model.p'
+# Solvers tried in order, CPLEX first and GLPK (swiglpk) as the open-source fallback
+SOLVERS = os.getenv('METABOLITICS_SOLVERS', 'cplex,glpk').split(',')
+
+# Tasks running the pipelines, whose queues get preloading workers
+PIPELINE_TASKS = ('app.tasks.save_analysis', 'app.tasks.save_analysis_study')
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+# Set in the main worker process before its pool processes are forked
+_preload = False
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def configure_solver(model, solvers=SOLVERS):
+    """
+    Choosing the LP solver of a cobra model for repeated FVA runs
+        - params:
+            model : cobra model of the metabolitics transformer
+            solvers : solver names in order of preference
+        - response:
+            name of the chosen solver
+    The solver is switched only when needed, since switching rebuilds the
+    whole LP. Its other settings, presolve included, are left at their defaults.
+    """
+    from optlang import available_solvers
+
+    for solver in solvers:
+        if available_solvers.get(solver.strip().upper()):
+            solver = solver.strip().lower()
+            break
+    else:
+        raise RuntimeError('None of the solvers %s is available' % ', '.join(solvers))
+
+    if model.problem.__name__ != 'optlang.%s_interface' % solver:
+        model.solver = solver
+    return solver
+
+
+def _load_pipelines(path):
+    from metabomics.preprocessing import MetaboliticsPipeline
+
+    with open(path, 'rb') as f:
+        reaction_scaler = pickle.load(f)
+
+    configure_solver(reaction_scaler['metabolitics-transformer'].analyzer.model)
+
+    pathway_scaler = MetaboliticsPipeline([
+        'pathway-transformer',
+        'transport-pathway-elimination'
+    ])
+    return reaction_scaler, pathway_scaler
+
+
+def get_analysis_pipelines(path=MODEL_PATH):
+    """
+    Getting the warm reaction and pathway pipelines of this worker
+        - response:
+            reaction_scaler : pickled metabolitics model of path
+            pathway_scaler : pathway transformer pipeline
+    The pickle is loaded once per process. It is loaded again only when its
+    mtime changed and its content hash differs from the loaded one.
+    """
+    mtime = os.path.getmtime(path)
+    loaded = _pipelines.get(path)
+    if loaded is not None and loaded['mtime'] == mtime:
+        return loaded['reaction_scaler'], loaded['pathway_scaler']
+
+    with _pipelines_lock:
+        loaded = _pipelines.get(path)
+        if loaded is None or loaded['mtime'] != mtime:
+            digest = _file_hash(path)
+            if loaded is not None and loaded['hash'] == digest:
+                loaded['mtime'] = mtime
+            else:
+                reaction_scaler, pathway_scaler = _load_pipelines(path)
+                loaded = {
+                    'mtime': mtime,
+                    'hash': digest,
+                    'reaction_scaler': reaction_scaler,
+                    'pathway_scaler': pathway_scaler,
+                }
+                _pipelines[path] = loaded
+    return loaded['reaction_scaler'], loaded['pathway_scaler']
+
+
+def get_model_version(path=MODEL_PATH):
+    """Getting the content hash of the loaded model, loading it if needed"""
+    get_analysis_pipelines(path)
+    return _pipelines[path]['hash']
+
+
+def pipeline_queues(conf):
+    """Names of the queues the pipeline tasks are routed to"""
+    routes = conf.task_routes or {}
+    return {routes.get(task, {}).get('queue', conf.task_default_queue) for task in PIPELINE_TASKS}
+
+
+@worker_init.connect
+def check_worker_queues(sender, **kwargs):
+    """Preloading only in workers consuming a queue of the pipeline tasks, not in fast DPM/PE ones"""
+    global _preload
+    consumed = set(sender.app.amqp.queues.consume_from)
+    _preload = bool(consumed & pipeline_queues(sender.app.conf))
+
+
+@worker_process_init.connect
+def preload_pipelines(**kwargs):
+    """Loading the pipelines when a worker process starts, before its first task"""
+    if not _preload:
+        return
+    try:
+        get_analysis_pipelines()
+    except Exception as e:
+        print(e)
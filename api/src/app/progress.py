@@ -0,0 +1,106 @@
+import threading
+
+from .app import app
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+PREFIX = 'metabolitics:progress:'
+# Progress of an analysis is dropped a day after its last update
+EXPIRE = 24 * 60 * 60
+
+
+def _get_client():
+    url = app.config.get('PROGRESS_URL')
+    if not url:
+        return None
+    client = _clients.get(url)
+    if client is None:
+        import redis
+
+        with _clients_lock:
+            client = _clients.get(url)
+            if client is None:
+                client = redis.StrictRedis.from_url(url)
+                _clients[url] = client
+    return client
+
+
+def set_progress(analysis_id, done, total):
+    """Recording that done of total reactions of an analysis are computed"""
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        key = PREFIX + str(analysis_id)
+        pipe = client.pipeline()
+        pipe.hmset(key, {'done': done, 'total': total})
+        pipe.expire(key, EXPIRE)
+        pipe.execute()
+    except Exception as e:  # progress is informative only, never fail the analysis
+        print(e)
+
+
+def clear_progress(analysis_id):
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        client.delete(PREFIX + str(analysis_id))
+    except Exception as e:
+        print(e)
+
+
+def get_progress(analysis_ids):
+    """
+    Getting the progress of running analyses
+        - params:
+            analysis_ids : ids of the analyses
+        - response:
+            dict of analysis id to the finished fraction, for the ids with a record
+    """
+    client = _get_client()
+    analysis_ids = list(analysis_ids)
+    if client is None or not analysis_ids:
+        return {}
+    try:
+        pipe = client.pipeline()
+        for analysis_id in analysis_ids:
+            pipe.hmget(PREFIX + str(analysis_id), 'done', 'total')
+        records = pipe.execute()
+    except Exception as e:
+        print(e)
+        return {}
+    progress = {}
+    for analysis_id, (done, total) in zip(analysis_ids, records):
+        if done is not None and total is not None and int(total) > 0:
+            progress[analysis_id] = int(done) / int(total)
+    return progress
+
+
+def running_analyses(analysis_data):
+    """Ids of the analyses of a study listing that started and did not end yet"""
+    return [a['id'] for a in analysis_data if a['end'] is None and a['start'] is not None]
+
+
+def study_progress(analysis_data, partial=None):
+    """
+    Setting the progress of every analysis of a study listing and returning the
+    study progress in percent, running analyses count with their reaction share
+        - params:
+            partial : get_progress of the running analyses, fetched when not given
+    """
+    if not analysis_data:
+        return 0
+    if partial is None:
+        partial = get_progress(running_analyses(analysis_data))
+    finished = 0.0
+    for analysis in analysis_data:
+        if analysis['end'] is not None:
+            analysis['progress'] = 100
+            finished += 1
+        else:
+            fraction = partial.get(analysis['id'], 0.0)
+            analysis['progress'] = round(fraction * 100)
+            finished += fraction
+    return round(finished / len(analysis_data) * 100)
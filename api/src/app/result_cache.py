@@ -0,0 +1,333 @@
+import json
+import time
+import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from .app import app
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Deleting a lock only while it still holds our token, it may have expired and been taken since
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# Extending a lock only while it still holds our token
+EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def normalize_vector(vector, digits=10):
+    """Turning a fold change dict into a canonical, order independent form"""
+    if not vector:
+        return []
+    return sorted((str(k), round(float(v), digits)) for k, v in vector.items())
+
+
+class ResultCache:
+    """
+    Content-addressed cache of analysis results, shared by all workers through redis
+
+    Entries are keyed by a hash of the method, the network or model version and
+    the normalised input vectors, so a new api_model.p or network file simply
+    leads to new keys. Old entries are dropped by the size bound: once the
+    stored values take more than max_bytes, the least recently used ones are
+    evicted. A lock per key lets concurrent identical submissions wait for a
+    single in-flight computation, and is kept alive for as long as it runs.
+    """
+
+    def __init__(self, client, prefix='metabolitics:results', max_bytes=256 * 1024 * 1024,
+                 lock_timeout=120, poll_interval=0.5):
+        self.client = client
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.lru_key = prefix + ':lru'
+        self.sizes_key = prefix + ':sizes'
+        self.bytes_key = prefix + ':bytes'
+        self.hits_key = prefix + ':hits'
+        self.misses_key = prefix + ':misses'
+
+    def key(self, method, version, *vectors):
+        payload = json.dumps([method, version] + [normalize_vector(v) for v in vectors])
+        return '%s:%s' % (self.prefix, hashlib.sha1(payload.encode('utf-8')).hexdigest())
+
+    def _touch(self, key):
+        self.client.execute_command('ZADD', self.lru_key, time.time(), key)
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            self.client.incr(self.misses_key)
+            return None
+        self.client.incr(self.hits_key)
+        self._touch(key)
+        return json.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+
+    def get_many(self, keys):
+        """Getting cached values of many keys at once, as a dict of the hits"""
+        if not keys:
+            return {}
+        values = self.client.mget(keys)
+        found = {}
+        for key, value in zip(keys, values):
+            if value is not None:
+                found[key] = json.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+                self._touch(key)
+        if found:
+            self.client.incr(self.hits_key, len(found))
+        if len(found) < len(keys):
+            self.client.incr(self.misses_key, len(keys) - len(found))
+        return found
+
+    def set(self, key, value):
+        payload = json.dumps(value)
+        self.client.set(key, payload)
+        self._touch(key)
+        # A key always holds the same result, so a rewrite keeps its size
+        if self.client.hset(self.sizes_key, key, len(payload)):
+            self.client.incr(self.bytes_key, len(payload))
+        self.evict()
+
+    def evict(self):
+        """Dropping the least recently used entries until the stored values fit in max_bytes"""
+        while int(self.client.get(self.bytes_key) or 0) > self.max_bytes:
+            oldest = self.client.zrange(self.lru_key, 0, 0)
+            if not oldest:
+                break
+            key = oldest[0]
+            # only the worker removing it from the lru accounts for it
+            if self.client.zrem(self.lru_key, key):
+                size = int(self.client.hget(self.sizes_key, key) or 0)
+                self.client.delete(key)
+                self.client.hdel(self.sizes_key, key)
+                self.client.incr(self.bytes_key, -size)
+
+    def _lock(self, key):
+        """
+        Taking the in-flight lock of key, returning its token, or None when another
+        worker holds it. When redis cannot be reached the key is computed unlocked.
+        """
+        token = uuid.uuid4().hex
+        try:
+            if not self.client.set(key + ':lock', token, ex=self.lock_timeout, nx=True):
+                return None
+        except Exception as e:
+            print(e)
+        return token
+
+    def _extend(self, key, token):
+        try:
+            self.client.eval(EXTEND_LOCK, 1, key + ':lock', token, self.lock_timeout)
+        except Exception as e:  # waiters take the key over once the lock expires
+            print(e)
+
+    def _unlock(self, key, token):
+        try:
+            self.client.eval(RELEASE_LOCK, 1, key + ':lock', token)
+        except Exception as e:  # the lock expires by itself
+            print(e)
+
+    @contextmanager
+    def _keeping_locks(self, tokens):
+        """
+        Extending the locks of tokens, a dict of key to token, every third of
+        lock_timeout while the body runs. A batch running longer than the
+        timeout keeps its keys, while a worker that died loses them quickly.
+        """
+        stopped = threading.Event()
+
+        def extend():
+            while not stopped.wait(self.lock_timeout / 3.0):
+                for key, token in tokens.items():
+                    self._extend(key, token)
+
+        keeper = threading.Thread(target=extend, daemon=True)
+        keeper.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            keeper.join()
+
+    def _store(self, key, value):
+        """Caching a computed value, a failed write only loses the entry"""
+        try:
+            self.set(key, value)
+        except Exception as e:
+            print(e)
+
+    def get_or_compute(self, key, compute):
+        """
+        Getting the cached value of key, computing it once when missing
+            - params:
+                key : from ResultCache.key
+                compute : callable returning a json serialisable value
+        Callers that find another worker computing the same key wait for its
+        result instead of computing it again, and take the key over when that
+        worker's lock expires. Once a write fails after compute, the computed
+        value is returned as is.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        token = self._lock(key)
+        while token is None:
+            time.sleep(self.poll_interval)
+            value = self.client.get(key)
+            if value is not None:
+                self._touch(key)
+                return json.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+            token = self._lock(key)
+        try:
+            with self._keeping_locks({key: token}):
+                value = compute()
+            self._store(key, value)
+            return value
+        finally:
+            self._unlock(key, token)
+
+    def get_or_compute_many(self, keys, inputs, compute_many):
+        """
+        Batch form of get_or_compute
+            - params:
+                keys : one key per input
+                inputs : inputs handed to compute_many, one per key
+                compute_many : callable taking a list of inputs and returning
+                    their values in the same order
+        Inputs sharing a key are computed once. Keys locked by another worker
+        are waited for after computing the others, and taken over when that
+        worker's lock expires.
+        """
+        found = self.get_many(keys)
+        first = {}
+        for i, key in enumerate(keys):
+            if key not in found:
+                first.setdefault(key, i)
+
+        def compute(missing):
+            """Computing the keys of missing this worker can lock, returning the others"""
+            tokens = {}
+            waiting = []
+            try:
+                for key in missing:
+                    token = self._lock(key)
+                    if token is None:
+                        waiting.append(key)
+                    else:
+                        tokens[key] = token
+                if tokens:
+                    with self._keeping_locks(tokens):
+                        values = compute_many([inputs[first[key]] for key in tokens])
+                    for key, value in zip(tokens, values):
+                        found[key] = value
+                        self._store(key, value)
+            finally:
+                for key, token in tokens.items():
+                    self._unlock(key, token)
+            return waiting
+
+        waiting = compute(list(first))
+        while waiting:
+            time.sleep(self.poll_interval)
+            try:
+                values = self.client.mget(waiting)
+            except Exception as e:  # computing the rest below instead
+                print(e)
+                break
+            for key, value in zip(waiting, values):
+                if value is not None:
+                    found[key] = json.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+            # keys whose holder gave up are taken over
+            waiting = compute([key for key in waiting if key not in found])
+        remaining = [key for key in first if key not in found]
+        if remaining:  # the cache went away while waiting
+            for key, value in zip(remaining, compute_many([inputs[first[key]] for key in remaining])):
+                found[key] = value
+        return [found[key] for key in keys]
+
+    def stats(self):
+        return {
+            'hits': int(self.client.get(self.hits_key) or 0),
+            'misses': int(self.client.get(self.misses_key) or 0),
+            'entries': self.client.zcard(self.lru_key),
+            'bytes': int(self.client.get(self.bytes_key) or 0),
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        keys = self.client.zrange(self.lru_key, 0, -1)
+        if keys:
+            self.client.delete(*keys)
+        self.client.delete(self.lru_key, self.sizes_key, self.bytes_key, self.hits_key, self.misses_key)
+
+
+def get_result_cache():
+    """Getting the result cache of this process, None when it is disabled"""
+    url = app.config.get('RESULT_CACHE_URL')
+    if not url:
+        return None
+    cache = _caches.get(url)
+    if cache is None:
+        import redis
+
+        with _caches_lock:
+            cache = _caches.get(url)
+            if cache is None:
+                cache = ResultCache(redis.StrictRedis.from_url(url),
+                                    max_bytes=app.config.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+                _caches[url] = cache
+    return cache
+
+
+def cached(method, version, compute, *vectors):
+    """Running compute through the result cache when it is enabled"""
+    import redis
+
+    cache = get_result_cache()
+    if cache is None:
+        return compute()
+    try:
+        key = cache.key(method, version, *vectors)
+        return cache.get_or_compute(key, compute)
+    except redis.RedisError as e:  # an unreachable cache must not fail the analysis
+        print(e)
+        return compute()
+
+
+def cached_many(method, version, compute_many, inputs, payloads=None):
+    """
+    Batch form of cached
+        - params:
+            compute_many : callable taking the list of missing inputs and
+                returning their values in the same order
+            inputs : list of tuples of input vectors, one tuple per case
+            payloads : what compute_many gets for each case instead of its
+                input vectors, such as the vectors with the id of the case.
+                Only the vectors make the cache key.
+        - response:
+            list of values, one per case
+    """
+    import redis
+
+    if payloads is None:
+        payloads = inputs
+    cache = get_result_cache()
+    if cache is None:
+        return compute_many(payloads)
+    try:
+        keys = [cache.key(method, version, *vectors) for vectors in inputs]
+        return cache.get_or_compute_many(keys, payloads, compute_many)
+    except redis.RedisError as e:
+        print(e)
+        return compute_many(payloads)
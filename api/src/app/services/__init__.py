@@ -1,5 +1,20 @@
-from .data_reader import DataReader
-from .data_writer import DataWriter
-from .naming_service import NamingService
-from .data_utils import *
-from .mail_service import *
\ No newline at end of file
+from importlib import import_module
+
+from .mail_service import *
+
+# The data services pull in cobra, pandas and sklearn, so they are imported on
+# first access instead of whenever a task or view needs send_mail.
+_lazy_services = {
+    'DataReader': 'data_reader',
+    'DataWriter': 'data_writer',
+    'NamingService': 'naming_service',
+}
+
+
+def __getattr__(name):
+    if name in _lazy_services:
+        return getattr(import_module('.' + _lazy_services[name], __name__), name)
+    data_utils = import_module('.data_utils', __name__)
+    if not name.startswith('_') and hasattr(data_utils, name):
+        return getattr(data_utils, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -26,10 +26,10 @@
 
 # from flask_mail import Message
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-
 def send_mail(to,subject,content):
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+
     message = Mail(
         from_email='metabolitics@itu.edu.tr',
         to_emails= to,
@@ -0,0 +1,155 @@
+import datetime
+from itertools import chain
+
+from sqlalchemy import and_, or_, func, case, literal_column, event, inspect
+
+from .models import db, Analyses, AnalysisMetadata, AnalysisMethod, DiffusionMethod, Diseases, StudySummary
+
+
+def listed_analyses():
+    """Analyses shown in the study listings, every case but the healthy group average"""
+    return or_(AnalysisMetadata.group == 'not_provided',
+               func.coalesce(Analyses.name, '') != func.lower(func.coalesce(AnalysisMetadata.group, 'none')) + ' label avg')
+
+
+def summary_query():
+    """
+    Grouped query computing the summary of every study from its analyses
+    A study has ended only once every case has, and its avg case is the
+    first case when it has no label avg case. Public and private analyses
+    of a study are summarised in rows of their own, and so are the private
+    analyses of each owner, so no row mixes what two listings show.
+    """
+    is_avg = and_(func.coalesce(AnalysisMetadata.group, '') != 'not_provided', Analyses.name.like('% label avg%'))
+    end = case([(func.count(Analyses.end_time) == func.count(Analyses.id), func.max(Analyses.end_time))])
+    avg_id = func.coalesce(func.max(case([(is_avg, Analyses.id)])), func.min(Analyses.id))
+    # literal, so the selected and grouped expressions render the same
+    owner = case([(Analyses.type == literal_column("'private'"), Analyses.owner_user_id)])
+    return db.session.query(
+        AnalysisMetadata.id, AnalysisMetadata.name, AnalysisMetadata.method_id, AnalysisMethod.name,
+        DiffusionMethod.name, AnalysisMetadata.disease_id, Diseases.name, Analyses.type,
+        owner, func.count(Analyses.id), func.count(Analyses.end_time),
+        func.min(Analyses.start_time), end, avg_id).select_from(AnalysisMetadata).join(
+            Analyses, Analyses.dataset_id == AnalysisMetadata.id).outerjoin(
+                AnalysisMethod, AnalysisMethod.id == AnalysisMetadata.method_id).outerjoin(
+                    DiffusionMethod, DiffusionMethod.id == AnalysisMetadata.diffusion_id).outerjoin(
+                        Diseases, Diseases.id == AnalysisMetadata.disease_id).filter(listed_analyses()).group_by(
+                            AnalysisMetadata.id, AnalysisMethod.name, DiffusionMethod.name, Diseases.name,
+                            Analyses.type, owner)
+
+
+def _existing_summaries(study_ids):
+    """Summary rows of the studies, keyed by study id, type and owner"""
+    return {(summary.study_id, summary.type, summary.owner_user_id): summary for summary in
+            StudySummary.query.filter(StudySummary.study_id.in_(study_ids))}
+
+
+def _write_summaries(rows, existing):
+    """Updating, adding and dropping the summary rows of existing so that they match rows"""
+    now = datetime.datetime.now()
+    seen = set()
+    for row in rows:
+        key = (row[0], row[7], row[8])
+        summary = existing.get(key)
+        if summary is None:
+            summary = StudySummary(study_id=row[0])
+            db.session.add(summary)
+        (_, summary.name, summary.method_id, summary.analysis_method, summary.diffusion_method,
+         summary.disease_id, summary.disease, summary.type, summary.owner_user_id, summary.cases,
+         summary.finished, summary.start_time, summary.end_time, summary.avg_id) = row
+        summary.updated_at = now
+        seen.add(key)
+    for key, summary in existing.items():
+        if key not in seen:  # its last listed case was deleted
+            db.session.delete(summary)
+
+
+def refresh_study_summaries(study_ids):
+    """
+    Recomputing the summary rows of studies inside the current transaction
+    Callers commit it together with the analysis rows they changed, so the
+    listings never see one without the other. The studies are locked first, so
+    cases of one study finishing in parallel tasks are all counted. Commits call
+    it for analyses changed through the ORM, bulk updates call it themselves.
+    """
+    study_ids = sorted({int(study_id) for study_id in study_ids if study_id is not None})
+    if not study_ids:
+        return
+    db.session.query(AnalysisMetadata.id).filter(AnalysisMetadata.id.in_(study_ids)).order_by(
+        AnalysisMetadata.id).with_for_update().all()
+    # changes flushed so far are counted below, the commit need not refresh these again
+    db.session.info.get('changed_studies', set()).difference_update(study_ids)
+    rows = summary_query().filter(AnalysisMetadata.id.in_(study_ids)).all()
+    _write_summaries(rows, _existing_summaries(study_ids))
+
+
+def rebuild_study_summaries(batch_size=500):
+    """
+    Recomputing the summary of every study, committing a batch of studies at a time
+        - response:
+            number of summary rows written
+    """
+    study_ids = [study_id for study_id, in db.session.query(AnalysisMetadata.id).order_by(AnalysisMetadata.id)]
+    # rows of studies that no longer exist
+    StudySummary.query.filter(~StudySummary.study_id.in_(db.session.query(AnalysisMetadata.id))).delete(
+        synchronize_session=False)
+    written = 0
+    for start in range(0, len(study_ids), batch_size):
+        batch = study_ids[start:start + batch_size]
+        rows = summary_query().filter(AnalysisMetadata.id.in_(batch)).all()
+        _write_summaries(rows, _existing_summaries(batch))
+        db.session.commit()
+        written += len(rows)
+    db.session.commit()
+    return written
+
+
+def migrate_study_summaries(batch_size=500):
+    """
+    Creating the study summary table when it is missing and filling it when it is empty
+        - response:
+            number of summary rows written
+    """
+    StudySummary.__table__.create(db.engine, checkfirst=True)
+    if db.session.query(StudySummary.id).first() is not None:
+        return 0
+    return rebuild_study_summaries(batch_size)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _collect_changed_studies(session, flush_context, instances):
+    """
+    Remembering the studies edited through the ORM, and those of analyses added,
+    edited or deleted, such as from the admin
+    """
+    changed = session.info.setdefault('changed_studies', set())
+    for study in session.dirty:
+        if isinstance(study, AnalysisMetadata) and session.is_modified(study):
+            changed.add(study.id)
+    for analysis in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(analysis, Analyses):
+            continue
+        if analysis in session.dirty and not session.is_modified(analysis):
+            continue
+        # an analysis moved to another study leaves the old one too
+        changed.update(inspect(analysis).attrs.dataset_id.history.deleted or ())
+        changed.add(analysis.dataset_id)
+
+
+@event.listens_for(Analyses.dataset_id, 'set', active_history=True)
+def _load_previous_study(analysis, value, previous, initiator):
+    """Listening with active_history loads the study an analysis leaves, so its history has it"""
+
+
+@event.listens_for(db.session, 'before_commit')
+def _refresh_changed_studies(session):
+    """Refreshing the summaries of the changed studies in the transaction committing the analyses"""
+    session.flush()
+    study_ids = session.info.pop('changed_studies', None)
+    if study_ids:
+        refresh_study_summaries(study_ids)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _forget_changed_studies(session, previous_transaction):
+    session.info.pop('changed_studies', None)
@@ -1,32 +1,32 @@
 import datetime
 import pickle
 
-from metabomics.preprocessing import MetaboliticsPipeline
 import celery
-from .models import db, Analyses, AnalysisMetadata, OmicsDatasets, Diseases, DiseaseModel
+from .models import db, Analyses, AnalysisMetadata, OmicsDatasets, Diseases, DiseaseModel, DiseaseTrainingSet, \
+    DiseaseTrainingRecord
+from .pipelines import get_analysis_pipelines, get_model_version
+from .result_cache import cached, cached_many
+from .progress import set_progress, clear_progress
+from .fva import transform_sample, uses_chunked_fva
+from .disease_models import write_sidecar, backfill_sidecars
+from .corpus import update_corpus
+from .study_summary import refresh_study_summaries
+from .training import TRAIN_PROCESSES, TRAIN_BATCH_SIZE, stream_matrix, train_disease
+from .base import get_network_version
 from .services.mail_service import *
 import json
-import requests
-from libchebipy import ChebiEntity
 import os
-from sklearn.pipeline import Pipeline
-from sklearn.decomposition import PCA
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.linear_model import LogisticRegression
 from collections import OrderedDict
-from sklearn.model_selection import cross_val_score, StratifiedKFold, cross_validate
-from sklearn.metrics import f1_score
 import sys
 from .dpm import *
 from .pe import *
-from sklearn_utils.preprocessing import *
-from sklearn.feature_selection import VarianceThreshold, SelectKBest
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.svm import SVC
 import random
 import numpy as np
 import math
 
+# metabomics, sklearn and requests are imported inside the tasks using them,
+# so that importing the app (web workers, CLI, tests) stays cheap.
+
 
 @celery.task()
 def save_analysis(analysis_id, concentration_changes, gene_changes = None, registered=True,mail='none',study2='none'):
@@ -34,33 +34,94 @@ def save_analysis(analysis_id, concentration_changes, gene_changes = None, regis
     analysis = Analyses.query.get(analysis_id)
     analysis.start_time = datetime.datetime.now()
     db.session.commit()
-    with open('../models/api_model.p', 'rb') as f:
-        reaction_scaler = pickle.load(f)
-
-    reaction_scaler['metabolitics-transformer'].analyzer.model.solver = 'cplex'
-
-    pathway_scaler = MetaboliticsPipeline([
-        'pathway-transformer',
-        'transport-pathway-elimination'
-    ])
-    # print ("-----------------------1")
-
-    results_reaction = reaction_scaler.transform([concentration_changes], gene_changes)
-    results_pathway = pathway_scaler.transform(results_reaction)
+    def run_analysis():
+        reaction_scaler, pathway_scaler = get_analysis_pipelines()
+        # The reactions of this single sample are split across a process pool
+        results_reaction = transform_sample(
+            reaction_scaler, concentration_changes, gene_changes,
+            progress=lambda done, total: set_progress(analysis_id, done, total))
+        results_pathway = pathway_scaler.transform(results_reaction)
+        return {'reactions': dict(results_reaction[0]), 'pathways': dict(results_pathway[0])}
 
+    results = cached('metabolitics', get_model_version(), run_analysis,
+                     concentration_changes, gene_changes)
 
-    analysis.results_reaction = analysis.clean_name_tag(results_reaction)
-    analysis.results_pathway = analysis.clean_name_tag(results_pathway)
+    analysis.results_reaction = analysis.clean_name_tag([results['reactions']])
+    analysis.results_pathway = analysis.clean_name_tag([results['pathways']])
     study = AnalysisMetadata.query.get(analysis.dataset_id)
     study.status = True
     analysis.end_time = datetime.datetime.now()
 
     db.session.commit()
+    clear_progress(analysis_id)
+    update_corpus([analysis_id])
 
     if registered != True:
         message = 'Hello, \n you can find your analysis results in the following link: \n http://metabolitics.itu.edu.tr/past-analysis/'+str(analysis_id)
         send_mail(mail,study2+' Analysis Results',message)
 
+@celery.task()
+def save_analysis_study(study_id, cases, gene_changes=None, registered=True, mail='none', study_name='none'):
+    """
+    Running Metabolitics for every case of a study in one batch
+        params:
+            - study_id: id of the AnalysisMetadata
+            - cases: dict of analysis id to fold changes
+            - gene_changes: dict of analysis id to gene fold changes, optional
+    """
+    analysis_ids = [int(analysis_id) for analysis_id in cases]
+    concentration_changes = list(cases.values())
+    gene_changes = {int(k): v for k, v in (gene_changes or {}).items() if v}
+
+    start_time = datetime.datetime.now()
+    db.session.bulk_update_mappings(Analyses, [
+        {'id': analysis_id, 'start_time': start_time} for analysis_id in analysis_ids])
+    # bulk updates are not seen by the commit hook refreshing the study summaries
+    refresh_study_summaries([study_id])
+    db.session.commit()
+
+    inputs = [(changes, gene_changes.get(analysis_id))
+              for analysis_id, changes in zip(analysis_ids, concentration_changes)]
+    # run_analyses gets the analysis id of every case, the cache key is made of its input alone
+    payloads = [(analysis_id,) + case for analysis_id, case in zip(analysis_ids, inputs)]
+
+    def run_analyses(payloads):
+        reaction_scaler, pathway_scaler = get_analysis_pipelines()
+        if not uses_chunked_fva(reaction_scaler) and not any(genes for _, _, genes in payloads):
+            results_reaction = reaction_scaler.transform([changes for _, changes, _ in payloads])
+        else:
+            # Cases run one by one, each spreading its FVA over a process pool
+            results_reaction = []
+            for analysis_id, changes, genes in payloads:
+                progress = lambda done, total, analysis_id=analysis_id: set_progress(analysis_id, done, total)
+                results_reaction.extend(transform_sample(reaction_scaler, changes, genes, progress=progress))
+        results_pathway = pathway_scaler.transform(results_reaction)
+        return [{'reactions': dict(reaction), 'pathways': dict(pathway)}
+                for reaction, pathway in zip(results_reaction, results_pathway)]
+
+    results = cached_many('metabolitics', get_model_version(), run_analyses, inputs, payloads)
+
+    end_time = datetime.datetime.now()
+    db.session.bulk_update_mappings(Analyses, [
+        {
+            'id': analysis_id,
+            'results_reaction': [result['reactions']],
+            'results_pathway': [result['pathways']],
+            'end_time': end_time,
+        }
+        for analysis_id, result in zip(analysis_ids, results)])
+    study = AnalysisMetadata.query.get(study_id)
+    study.status = True
+    refresh_study_summaries([study_id])
+    db.session.commit()
+    for analysis_id in analysis_ids:
+        clear_progress(analysis_id)
+    update_corpus(analysis_ids)
+
+    if registered != True and analysis_ids:
+        message = 'Hello, \n you can find your analysis results in the following link: \n http://metabolitics.itu.edu.tr/past-analysis/'+str(analysis_ids[-1])
+        send_mail(mail,study_name+' Analysis Results',message)
+
 @celery.task()
 def save_dpm(analysis_id, concentration_changes):
 
@@ -69,14 +130,71 @@ def save_dpm(analysis_id, concentration_changes):
     db.session.commit()
     
     
-    analysis_runs = DirectPathwayMapping(concentration_changes)  # Forming the instance
-    # fold_changes
-    analysis_runs.run()  # Making the analysis
-    analysis.results_pathway = [analysis_runs.result_pathways]
-    analysis.results_reaction = [analysis_runs.result_reactions]
+    def run_analysis():
+        analysis_runs = DirectPathwayMapping(concentration_changes)  # Forming the instance
+        # fold_changes
+        analysis_runs.run()  # Making the analysis
+        return {'pathways': analysis_runs.result_pathways, 'reactions': analysis_runs.result_reactions}
+
+    results = cached('dpm', get_network_version(), run_analysis, concentration_changes)
+    analysis.results_pathway = [results['pathways']]
+    analysis.results_reaction = [results['reactions']]
     analysis.end_time = datetime.datetime.now()
 
     db.session.commit()
+    update_corpus([analysis_id])
+
+def _score_study(study_id, cases, engine, method):
+    """
+    Scoring every case of a study in one batch and writing all rows in one commit,
+    only cases missing from the result cache are scored
+    """
+    analysis_ids = [int(analysis_id) for analysis_id in cases]
+    analyses = {analysis.id: analysis for analysis in
+                Analyses.query.filter(Analyses.id.in_(analysis_ids))}
+    start_time = datetime.datetime.now()
+    for analysis in analyses.values():
+        analysis.start_time = start_time
+    db.session.commit()
+
+    def score_many(inputs):
+        results_pathways, results_reactions = engine.score_many([changes for changes, in inputs])
+        return [{'pathways': pathways, 'reactions': reactions}
+                for pathways, reactions in zip(results_pathways, results_reactions)]
+
+    results = cached_many(method, get_network_version(), score_many,
+                          [(changes,) for changes in cases.values()])
+    end_time = datetime.datetime.now()
+    for analysis_id, result in zip(analysis_ids, results):
+        analysis = analyses[analysis_id]
+        analysis.results_pathway = [result['pathways']]
+        analysis.results_reaction = [result['reactions']]
+        analysis.end_time = end_time
+    study = AnalysisMetadata.query.get(study_id)
+    study.status = True
+
+    db.session.commit()
+    update_corpus(analysis_ids)
+
+@celery.task()
+def save_dpm_study(study_id, cases):
+    """
+    Scoring every case of a study with Direct Pathway Mapping in one batch
+        params:
+            - study_id: id of the AnalysisMetadata
+            - cases: dict of analysis id to fold changes
+    """
+    _score_study(study_id, cases, get_dpm_engine(), 'dpm')
+
+@celery.task()
+def save_pe_study(study_id, cases):
+    """
+    Scoring every case of a study with Pathway Enrichment in one batch
+        params:
+            - study_id: id of the AnalysisMetadata
+            - cases: dict of analysis id to fold changes
+    """
+    _score_study(study_id, cases, get_pe_engine(), 'pe')
 
 @celery.task()
 def save_pe(analysis_id, concentration_changes):
@@ -86,17 +204,24 @@ def save_pe(analysis_id, concentration_changes):
     db.session.commit()
     
     
-    analysis_runs = PathwayEnrichment(concentration_changes)  # Forming the instance
-    # fold_changes
-    analysis_runs.run()  # Making the analysis
-    analysis.results_pathway = [analysis_runs.result_pathways]
-    analysis.results_reaction = [analysis_runs.result_reactions]
+    def run_analysis():
+        analysis_runs = PathwayEnrichment(concentration_changes)  # Forming the instance
+        # fold_changes
+        analysis_runs.run()  # Making the analysis
+        return {'pathways': analysis_runs.result_pathways, 'reactions': analysis_runs.result_reactions}
+
+    results = cached('pe', get_network_version(), run_analysis, concentration_changes)
+    analysis.results_pathway = [results['pathways']]
+    analysis.results_reaction = [results['reactions']]
     analysis.end_time = datetime.datetime.now()
 
     db.session.commit()
+    update_corpus([analysis_id])
 
 @celery.task()
 def enhance_synonyms(metabolites):
+    import requests
+
     print('Enhancing synonyms...')
     with open('../datasets/assets/new-synonym-mapping.json') as f:
         synonyms = json.load(f, object_pairs_hook=OrderedDict)
@@ -125,99 +250,188 @@ def enhance_synonyms(metabolites):
         json.dump(synonyms, f, indent=4) 
     print("Enhancing synonyms done.")
 
+def _training_job(disease_id, force):
+    """
+    Getting what is needed to train a disease, None when it has too few analyses
+    or when its fingerprint did not change since it was last trained
+    """
+    disease_name = AnalysisMetadata.query.get(disease_id).name
+    dataset_ids = db.session.query(AnalysisMetadata.id).filter(AnalysisMetadata.disease_id == disease_id).filter(
+        AnalysisMetadata.group != 'not_provided').filter(AnalysisMetadata.method_id == 1).all()
+    training = db.session.query(Analyses).filter(Analyses.type == 'public').filter(
+        Analyses.dataset_id.in_(dataset_ids)).filter(Analyses.results_reaction != None).with_entities(
+            Analyses.id, Analyses.end_time).all()
+    if len(training) < 12:
+        return None
+    analysis_ids = [analysis_id for analysis_id, _ in training]
+    end_times = [end_time for _, end_time in training if end_time is not None]
+    last_end_time = max(end_times) if end_times else None
+    fingerprint = DiseaseTrainingSet.make_fingerprint(analysis_ids, last_end_time)
+    training_set = DiseaseTrainingSet.query.filter_by(disease_id=disease_id).first()
+    if training_set is None:
+        training_set = DiseaseTrainingSet(disease_id=disease_id)
+        # Models trained before fingerprints were kept count as up to date
+        # when no analysis finished after them
+        disease_model = DiseaseModel.query.filter_by(disease_id=disease_id).first()
+        if disease_model is not None and last_end_time is not None and disease_model.creation_date is not None \
+                and disease_model.creation_date >= last_end_time:
+            training_set.fingerprint = fingerprint
+            training_set.trained_at = disease_model.creation_date
+    if not force and training_set.fingerprint == fingerprint:
+        print('Skipping %s, its training set did not change.' % disease_name)
+        if training_set.id is None:
+            training_set.analysis_count = len(analysis_ids)
+            training_set.last_end_time = last_end_time
+            db.session.add(training_set)
+            db.session.commit()
+        return None
+
+    return {
+        'disease_id': disease_id,
+        'disease_name': disease_name,
+        'disease_synonym': AnalysisMetadata.query.get(disease_id).synonym,
+        'dataset_ids': dataset_ids,
+        'analysis_ids': analysis_ids,
+        'training_set': training_set,
+        'fingerprint': fingerprint,
+        'analysis_count': len(analysis_ids),
+        'last_end_time': last_end_time,
+    }
+
+
+def _load_training_matrix(job):
+    """
+    Streaming the reaction results of a training job into its sparse matrix,
+    without keeping the list of result dicts in memory
+    """
+    rows = db.session.query(Analyses).filter(Analyses.id.in_(job['analysis_ids'])).with_entities(
+            Analyses.results_reaction, Analyses.label).execution_options(
+                stream_results=True).yield_per(TRAIN_BATCH_SIZE)
+    X, feature_names, labels = stream_matrix(rows, len(job['analysis_ids']))
+    groups = db.session.query(AnalysisMetadata.group).filter(AnalysisMetadata.id.in_(job['dataset_ids'])).all()
+    def is_healthy(label):
+        for group, in groups:
+            if group.lower() + ' label avg' == label or group == label:
+                return True
+        return False
+    labels = [0 if is_healthy(label) else 1 for label in labels]
+    return X, feature_names, labels
+
+
+def _save_trained_model(job, trained):
+    """Saving the winning model of a disease and recording how its training went"""
+    disease_id = job['disease_id']
+    disease_name = job['disease_name']
+    best = trained['best']
+    saved = best is not None and best['f1_score'] > 0.7
+    if saved:
+        file_path = '../trained_models/' + disease_name.replace(' ', '_') + '_' + str(disease_id) + '_model.p'
+        save = {}
+        save['disease'] = str(disease_name) + ' (' + job['disease_synonym'] + ')'
+        save['model'] = best['model']
+        save['fold_number'] = trained['fold_number']
+        save['f1_score'] = best['f1_score']
+        save['precision_score'] = best['precision_score']
+        save['recall_score'] = best['recall_score']
+        save['algorithm'] = best['algorithm']
+        disease_model = DiseaseModel(
+            disease_id=disease_id,
+            fold_number=trained['fold_number'],
+            f1_score=best['f1_score'],
+            precision_score=best['precision_score'],
+            recall_score=best['recall_score'],
+            creation_date=datetime.datetime.now(),
+            file_path=file_path,
+            algorithm=best['algorithm']
+        )
+        DiseaseModel.query.filter_by(disease_id=disease_id).delete()
+        db.session.add(disease_model)
+        # Written aside and renamed, so that prediction never reads a partial model.
+        # The scores go to a json sidecar first, /models/scores reads only that.
+        write_sidecar(file_path, save)
+        with open(file_path + '.tmp', 'wb') as f:
+            pickle.dump(save, f)
+        os.replace(file_path + '.tmp', file_path)
+
+    training_set = job['training_set']
+    training_set.fingerprint = job['fingerprint']
+    training_set.analysis_count = job['analysis_count']
+    training_set.last_end_time = job['last_end_time']
+    training_set.trained_at = datetime.datetime.now()
+    db.session.add(training_set)
+    db.session.add(DiseaseTrainingRecord(
+        disease_id=disease_id,
+        started_at=trained['started_at'],
+        duration=trained['duration'],
+        peak_memory_kb=trained['peak_memory_kb'],
+        sample_count=job['analysis_count'],
+        algorithm=best['algorithm'] if best is not None else None,
+        f1_score=best['f1_score'] if best is not None else None,
+        saved=saved,
+    ))
+    db.session.commit()
+
+
 @celery.task(name='train_save_model')
-def train_save_model():
+def train_save_model(force=False):
+    """
+    Training and saving the disease prediction models
+        params:
+            - force: retrain every disease, even when its training set did not change
+    A disease is retrained only when the fingerprint of its public analyses
+    (their ids and newest end_time) differs from the one it was last trained on.
+    Diseases are trained side by side in a process pool, and the folds of each
+    disease share the remaining cores.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    from joblib.externals.loky import ProcessPoolExecutor
+
     print('Training and saving models...')
+    # Scores of models that are not retrained below still need their sidecar
+    backfill_sidecars()
     disease_ids = db.session.query(AnalysisMetadata.disease_id).filter(AnalysisMetadata.group != 'not_provided').filter(AnalysisMetadata.method_id == 1).distinct()
+    jobs = []
     for disease_id, in disease_ids:
-        seed = 41
-        random.seed(seed)
-        np.random.seed(seed)
-        os.environ['PYTHONHASHSEED'] = str(seed)
-        disease_name = AnalysisMetadata.query.get(disease_id).name
-        disease_synonym = AnalysisMetadata.query.get(disease_id).synonym
-        dataset_ids = db.session.query(AnalysisMetadata.id).filter(AnalysisMetadata.disease_id == disease_id).filter(
-            AnalysisMetadata.group != 'not_provided').filter(AnalysisMetadata.method_id == 1).all()
-        results_reactions_labels = db.session.query(Analyses).filter(Analyses.type == 'public').filter(
-            Analyses.dataset_id.in_(dataset_ids)).filter(Analyses.results_reaction != None).with_entities(
-                Analyses.results_reaction, Analyses.label).all()
-        results_reactions = [value[0][0] for value in results_reactions_labels]
-        if len(results_reactions) < 12:
+        try:
+            job = _training_job(disease_id, force)
+        except Exception as e:
+            print(e)
             continue
-        labels = [value[1] for value in results_reactions_labels]
-        groups = db.session.query(AnalysisMetadata.group).filter(AnalysisMetadata.id.in_(dataset_ids)).all()
-        def is_healthy(label):
-            for group, in groups:
-                if group.lower() + ' label avg' == label or group == label:
-                    return True
-            return False
-        labels = [0 if is_healthy(label) else 1 for label in labels]
-        num_healthy = labels.count(0)
-        num_disease = labels.count(1)
-        file_path = '../trained_models/' + disease_name.replace(' ', '_') + '_' + str(disease_id) + '_model.p'
+        if job is not None:
+            jobs.append(job)
+    if not jobs:
+        print('Training and saving models done.')
+        return
+
+    cores = os.cpu_count() or 1
+    processes = max(1, min(TRAIN_PROCESSES, len(jobs)))
+    n_jobs = max(1, cores // processes)
+
+    def finish(future, job):
         try:
-            fs = ('fs', Pipeline([
-                            ('vt', DictInput(VarianceThreshold(0.01), feature_selection=True)),
-                            ('skb', DictInput(SelectKBest(k=100), feature_selection=True))
-                        ]))
-            vect = ('vect', DictVectorizer(sparse=True))
-            lr = ('lr', LogisticRegression(penalty='l1', tol=0.015, C=0.0008, intercept_scaling=0.3, solver='liblinear', max_iter=100000))
-            lr_pipe = Pipeline([fs, vect, lr])
-            rfc = ('rfc', RandomForestClassifier(n_estimators=100))
-            rfc_pipe = Pipeline([fs, vect, rfc])
-            svc = ('svc', SVC(gamma='auto', probability=True))
-            svc_pipe = Pipeline([fs, vect, svc])
-            pipes = [('Logistic Regression ', lr_pipe), ('Random Forest Classification', rfc_pipe), ('Support Vector Classification', svc_pipe)]
-            models = []
-            for algorithm, pipe in pipes:
-                model = {}
-                model['model'] = pipe.fit(results_reactions, labels)
-                if min(num_healthy, num_disease) < 10:
-                    kf = StratifiedKFold(n_splits=5)
-                    fold_number = 5
-                else:
-                    kf = StratifiedKFold(n_splits=10)
-                    fold_number = 10
-                scoring = ['f1', 'precision', 'recall']
-                scores = cross_validate(estimator=pipe, X=results_reactions, y=labels, scoring=scoring, cv=kf, return_train_score=False)
-                f1_scores = scores['test_f1']
-                precision_scores = scores['test_precision']
-                recall_scores = scores['test_recall']
-                model['f1_score'] = f1_scores[f1_scores != 0].mean()
-                model['precision_score'] = precision_scores[precision_scores != 0].mean()
-                model['recall_score'] = recall_scores[recall_scores != 0].mean()
-                model['algorithm'] = algorithm
-                if not math.isnan(model['f1_score']) and not math.isnan(model['precision_score']) and not math.isnan(model['recall_score']):
-                    models.append(model)
-            models = sorted(models, key=lambda model: model['f1_score'], reverse=True)
-            model = models[0]
-            if model['f1_score'] > 0.7:
-                save = {}
-                save['disease'] = str(disease_name) + ' (' + disease_synonym + ')'
-                save['model'] = model['model']
-                save['fold_number'] = fold_number
-                save['f1_score'] = model['f1_score']
-                save['precision_score'] = model['precision_score']
-                save['recall_score'] = model['recall_score']
-                save['algorithm'] = model['algorithm']
-                disease_model = DiseaseModel(
-                    disease_id=disease_id,
-                    fold_number=fold_number,
-                    f1_score=model['f1_score'],
-                    precision_score=model['precision_score'],
-                    recall_score=model['recall_score'],
-                    creation_date=datetime.datetime.now(),
-                    file_path=file_path,
-                    algorithm=model['algorithm']
-                )
-                exists = db.session.query(DiseaseModel.id).filter_by(disease_id=disease_id).first() is not None
-                if exists:
-                    DiseaseModel.query.filter_by(disease_id=disease_id).delete()
-                    db.session.commit()
-                db.session.add(disease_model)
-                db.session.commit()
-                with open(file_path, 'wb') as f:
-                    pickle.dump(save, f)
+            trained = future.result()
+            _save_trained_model(job, trained)
+            print('Trained %s in %.1f s' % (job['disease_name'], trained['duration']))
         except Exception as e:
+            db.session.rollback()
             print(e)
+
+    # A training matrix is loaded only when a process is free for it, so at most
+    # `processes` of them are held in memory at once
+    futures = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for job in jobs:
+            if len(futures) >= processes:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future, futures.pop(future))
+            try:
+                X, feature_names, labels = _load_training_matrix(job)
+            except Exception as e:
+                print(e)
+                continue
+            futures[executor.submit(train_disease, job['disease_id'], X, feature_names, labels, n_jobs)] = job
+            del X, feature_names, labels
+        for future in wait(futures).done:
+            finish(future, futures[future])
     print('Training and saving models done.')
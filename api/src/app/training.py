@@ -0,0 +1,202 @@
+import os
+import math
+import time
+import random
+import datetime
+import threading
+from array import array
+
+import numpy as np
+
+SEED = 41
+# Processes training diseases side by side, cross-validation folds share the rest of the cores
+TRAIN_PROCESSES = int(os.getenv('TRAIN_PROCESSES', os.cpu_count() or 1))
+# Rows fetched from the database cursor at a time while loading a training set
+TRAIN_BATCH_SIZE = int(os.getenv('TRAIN_BATCH_SIZE', 100))
+# Seconds between two samples of the resident memory while a disease trains
+MEMORY_SAMPLE_INTERVAL = float(os.getenv('MEMORY_SAMPLE_INTERVAL', 0.2))
+
+
+def seed_everything(seed=SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+    os.environ['PYTHONHASHSEED'] = str(seed)
+
+
+def stream_matrix(rows, n_rows):
+    """
+    Decoding training rows one at a time into a sparse float32 matrix
+        - params:
+            rows : iterable of (results_reaction, label), such as a streamed query
+            n_rows : number of rows expected
+        - response:
+            X : csr matrix with one row per analysis
+            feature_names : reaction vocabulary, the sorted reaction keys
+            labels : label of each row
+    Only the current row is kept as a dict, the others are held as float32
+    values and int32 column indices.
+    """
+    from scipy import sparse
+
+    vocabulary = {}
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    indices = array('i')
+    data = array('f')
+    labels = []
+    for i, (results_reaction, label) in enumerate(rows):
+        for key, value in results_reaction[0].items():
+            indices.append(vocabulary.setdefault(key, len(vocabulary)))
+            data.append(value)
+        labels.append(label)
+        indptr[i + 1] = len(indices)
+    indptr = indptr[:len(labels) + 1]
+
+    # Columns are renumbered in the sorted order DictVectorizer would use
+    feature_names = sorted(vocabulary)
+    order = np.empty(len(feature_names), dtype=np.int32)
+    for position, name in enumerate(feature_names):
+        order[vocabulary[name]] = position
+    X = sparse.csr_matrix(
+        (np.frombuffer(data, dtype=np.float32), order[np.frombuffer(indices, dtype=np.int32)], indptr),
+        shape=(len(labels), len(feature_names)))
+    X.sort_indices()
+    return X, feature_names, labels
+
+
+class PeakMemory():
+    """
+    Sampling the resident memory of this process and of all its children, such as
+    the loky workers running the cross-validation folds, and keeping the peak
+    Resident memory includes the native buffers of numpy, BLAS and scipy.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        import psutil
+
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        import psutil
+
+        rss = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                # The child exited between listing and reading it
+                pass
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def make_vectorizer(feature_names):
+    """DictVectorizer turning reaction result dicts into rows of the training matrix"""
+    from sklearn.feature_extraction import DictVectorizer
+
+    vectorizer = DictVectorizer(dtype=np.float32, sparse=True)
+    vectorizer.feature_names_ = list(feature_names)
+    vectorizer.vocabulary_ = {name: i for i, name in enumerate(feature_names)}
+    return vectorizer
+
+
+def make_pipelines(seed=SEED):
+    """
+    Getting the candidate pipelines of a disease model, as (algorithm, pipeline)
+    The pipelines work on the matrix of stream_matrix. Feature selection is part of
+    them, so it is fitted inside each cross-validation fold. Every estimator gets
+    its own random_state, so results do not depend on which process or in which
+    order the folds run.
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.feature_selection import VarianceThreshold, SelectKBest
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.svm import SVC
+
+    fs = [('vt', VarianceThreshold(0.01)), ('skb', SelectKBest(k=100))]
+    lr = ('lr', LogisticRegression(penalty='l1', tol=0.015, C=0.0008, intercept_scaling=0.3, solver='liblinear',
+                                   max_iter=100000, random_state=seed))
+    lr_pipe = Pipeline(fs + [lr])
+    rfc = ('rfc', RandomForestClassifier(n_estimators=100, random_state=seed))
+    rfc_pipe = Pipeline(fs + [rfc])
+    svc = ('svc', SVC(gamma='auto', probability=True, random_state=seed))
+    svc_pipe = Pipeline(fs + [svc])
+    return [('Logistic Regression ', lr_pipe), ('Random Forest Classification', rfc_pipe),
+            ('Support Vector Classification', svc_pipe)]
+
+
+def train_disease(disease_id, X, feature_names, labels, n_jobs=1, seed=SEED):
+    """
+    Fitting and cross-validating every candidate pipeline of one disease
+        - params:
+            X, feature_names : training matrix and its vocabulary, from stream_matrix
+            labels : 0 for healthy and 1 for disease, per analysis
+            n_jobs : processes used for the cross-validation folds
+        - response:
+            dict with the best model and its scores (None when no model scored),
+            the fold number, the start time, the wall time in seconds and the
+            peak resident memory in KiB of this process and its fold workers
+    The saved model starts with the vectorizer, so it still predicts from
+    reaction result dicts.
+    """
+    from sklearn.base import clone
+    from sklearn.pipeline import Pipeline
+    from sklearn.model_selection import StratifiedKFold, cross_validate
+
+    seed_everything(seed)
+    started_at = datetime.datetime.now()
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+        y = np.asarray(labels)
+        if min(labels.count(0), labels.count(1)) < 10:
+            fold_number = 5
+        else:
+            fold_number = 10
+        kf = StratifiedKFold(n_splits=fold_number)
+        scoring = ['f1', 'precision', 'recall']
+        models = []
+        for algorithm, pipe in make_pipelines(seed):
+            model = {}
+            scores = cross_validate(estimator=clone(pipe), X=X, y=y, scoring=scoring, cv=kf,
+                                    return_train_score=False, n_jobs=n_jobs)
+            f1_scores = scores['test_f1']
+            precision_scores = scores['test_precision']
+            recall_scores = scores['test_recall']
+            model['f1_score'] = f1_scores[f1_scores != 0].mean()
+            model['precision_score'] = precision_scores[precision_scores != 0].mean()
+            model['recall_score'] = recall_scores[recall_scores != 0].mean()
+            model['algorithm'] = algorithm
+            if not math.isnan(model['f1_score']) and not math.isnan(model['precision_score']) and not math.isnan(model['recall_score']):
+                model['model'] = pipe
+                models.append(model)
+        models = sorted(models, key=lambda model: model['f1_score'], reverse=True)
+        best = models[0] if models else None
+        if best is not None:
+            # Only the winner is fitted on the whole training set
+            best['model'] = Pipeline([('vect', make_vectorizer(feature_names))] + best['model'].fit(X, y).steps)
+    return {
+        'disease_id': disease_id,
+        'best': best,
+        'fold_number': fold_number,
+        'started_at': started_at,
+        'duration': time.perf_counter() - start,
+        'peak_memory_kb': memory.peak / 1024,
+    }
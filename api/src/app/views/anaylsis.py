@@ -1,15 +1,18 @@
 from functools import reduce
 from flask import jsonify, request
-from flask_jwt import jwt_required, current_identity
+from flask_jwt import jwt_required, current_identity, _jwt_required
 from sqlalchemy import and_, or_
 from sqlalchemy.types import Float
-from ..utils import similarty_dict
-from ..visualization import HeatmapVisualization
 import time
 from ..app import app
 from ..schemas import *
-from ..models import db, User, Analyses, OmicsDatasets, AnalysisMethod, DiffusionMethod, AnalysisMetadata, Diseases
-from ..tasks import save_analysis, enhance_synonyms, save_dpm, save_pe
+from ..models import db, User, Analyses, OmicsDatasets, AnalysisMethod, DiffusionMethod, AnalysisMetadata, Diseases, \
+    StudySummary
+from ..progress import get_progress, running_analyses, study_progress
+from ..study_summary import listed_analyses
+from ..corpus import get_corpus, update_corpus, remove_from_corpus
+from ..disease_models import predict_diseases, get_model_scores as get_disease_model_scores
+from ..tasks import save_analysis, save_analysis_study, enhance_synonyms, save_dpm, save_dpm_study, save_pe, save_pe_study
 from ..base import *
 from ..dpm import *
 import datetime
@@ -17,7 +20,6 @@ from ..services.mail_service import *
 import os
 import pickle
 from ..pe import *
-from metabomics.preprocessing import MetaboliticsPipeline
 import sys
 
 
@@ -60,6 +62,8 @@ def fva_analysis():
         description: Analysis is not yours
     """
 
+    from metabomics.preprocessing import MetaboliticsPipeline
+
     (data, error) = AnalysisInputSchema().load(request.json)
     if error:
         return jsonify(error), 400
@@ -92,6 +96,7 @@ def fva_analysis():
         db.session.commit()
 
         analysis_id = 0
+        cases, gene_changes = {}, {}
         healthy_metab_data = None
         healthy_gene_data = None
         for key,value in data['analysis'].items():
@@ -152,7 +157,7 @@ def fva_analysis():
                 transcriptomics_data.disease_id = disease.id
                 transcriptomics_data.disease = disease
                 db.session.add(transcriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
 
                 analysis = Analyses(name=key, user=user)
@@ -170,10 +175,14 @@ def fva_analysis():
                 analysis.dataset_id = study.id
 
                 db.session.add(analysis)
-                db.session.commit()
-                save_analysis.delay(analysis.id, value["Metabolites"] if healthy_metab_data is None else X_t, gene_changes=None if healthy_metab_data is None else X_gene_scaled)
+                db.session.flush()
+                cases[analysis.id] = value["Metabolites"] if healthy_metab_data is None else X_t
+                gene_changes[analysis.id] = None if healthy_metab_data is None else X_gene_scaled
                 analysis_id = analysis.id
 
+        # the cases are committed together, so their study is summarised once, as queued
+        db.session.commit()
+        save_analysis_study.delay(study.id, cases, gene_changes=gene_changes)
         return jsonify({'id': analysis_id})
 
 
@@ -192,9 +201,6 @@ def fva_analysis_public():
         return "", 404
     # print(request.json)
 
-    counter = 1
-    check_value = len(list(request.json['analysis'].keys()))
-
     # if 'metabolites' in data:
     #     enhance_synonyms.delay(data['metabolites'])
 
@@ -218,10 +224,9 @@ def fva_analysis_public():
         db.session.add(study)
         db.session.commit()
 
-    #
+        cases = {}
         for key, value in data["analysis"].items():  # user as key, value {metaboldata , label}
             if len(value['Metabolites']) > 0:
-                check_value -=1
 
                 metabolomics_data = OmicsDatasets(
                     omics_type = "metabolitics",
@@ -245,7 +250,7 @@ def fva_analysis_public():
                 trancsriptomics_data.disease = disease
                 db.session.add(metabolomics_data)
                 db.session.add(trancsriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
                 analysis = Analyses(name=key, user=user)
                 analysis.label = value['Label']
@@ -259,15 +264,13 @@ def fva_analysis_public():
                 analysis.dataset_id = study.id
 
                 db.session.add(analysis)
-                db.session.commit()
-
-                if check_value == counter:
-                    save_analysis.delay(analysis.id, value["Metabolites"],registered=False,mail=request.json["email"],study2=request.json['study_name'])
-                else:
-                    counter+=1
-                    save_analysis.delay(analysis.id, value["Metabolites"])
+                db.session.flush()
 
+                cases[analysis.id] = value["Metabolites"]
 
+        # the cases are committed together, so their study is summarised once, as queued
+        db.session.commit()
+        save_analysis_study.delay(study.id, cases, registered=False, mail=request.json["email"], study_name=request.json['study_name'])
         return jsonify({'id': analysis.id})
         # return jsonify({1:1})
 
@@ -278,6 +281,8 @@ def fva_analysis_public():
 @jwt_required()
 def direct_pathway_mapping():
 
+    from metabomics.preprocessing import MetaboliticsPipeline
+
     (data, error) = AnalysisInputSchema().load(request.json)
     if error:
         return jsonify(error), 400
@@ -309,6 +314,7 @@ def direct_pathway_mapping():
         db.session.add(study)
         db.session.commit()
         analysis_id = 0
+        cases = {}
         healthy_metab_data = None
         healthy_gene_data = None
         for key,value in data['analysis'].items():
@@ -368,7 +374,7 @@ def direct_pathway_mapping():
                 transcriptomics_data.disease_id = disease.id
                 transcriptomics_data.disease = disease
                 db.session.add(transcriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
 
                 analysis = Analyses(name=key, user=user)
@@ -386,10 +392,13 @@ def direct_pathway_mapping():
                 analysis.dataset_id = study.id
 
                 db.session.add(analysis)
-                db.session.commit()
-                save_dpm.delay(analysis.id, value["Metabolites"] if healthy_metab_data == None else X_t)
+                db.session.flush()
+                cases[analysis.id] = value["Metabolites"] if healthy_metab_data == None else X_t
                 analysis_id = analysis.id
 
+        # the cases are committed together, so their study is summarised once, as queued
+        db.session.commit()
+        save_dpm_study.delay(study.id, cases)
         return jsonify({'id': analysis_id})
 
 
@@ -426,6 +435,7 @@ def direct_pathway_mapping2():
         db.session.commit()
 
         analysis_id = 0
+        analyses, cases = [], []
         for key,value in data["analysis"].items():  # user as key, value {metaboldata , label}
 
             if len(value['Metabolites']) > 0:
@@ -453,7 +463,7 @@ def direct_pathway_mapping2():
                 trancsriptomics_data.disease = disease
                 db.session.add(metabolomics_data)
                 db.session.add(trancsriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
                 analysis = Analyses(name =key, user = user)
                 analysis.label = value['Label']
@@ -467,16 +477,21 @@ def direct_pathway_mapping2():
 
                 analysis.omics_data_id = [metabolomics_data.id, trancsriptomics_data.id] if trancsriptomics_data != None else metabolomics_data.id
                 analysis.dataset_id = study.id
-                analysis_runs = DirectPathwayMapping(value["Metabolites"])  # Forming the instance
-                # fold_changes
-                analysis_runs.run()  # Making the analysis
-                analysis.results_pathway = [analysis_runs.result_pathways]
-                analysis.results_reaction = [analysis_runs.result_reactions]
-                analysis.end_time = datetime.datetime.now()
-
                 db.session.add(analysis)
-                db.session.commit()
-                analysis_id = analysis.id
+                analyses.append(analysis)
+                cases.append(value["Metabolites"])
+
+        # Scoring all cases of the study at once
+        results_pathways, results_reactions = get_dpm_engine().score_many(cases)
+        end_time = datetime.datetime.now()
+        for analysis, results_pathway, results_reaction in zip(analyses, results_pathways, results_reactions):
+            analysis.results_pathway = [results_pathway]
+            analysis.results_reaction = [results_reaction]
+            analysis.end_time = end_time
+        db.session.commit()
+        update_corpus([analysis.id for analysis in analyses])
+        if analyses:
+            analysis_id = analyses[-1].id
 
         message = 'Hello, \n you can find your analysis results in the following link: \n http://metabolitics.itu.edu.tr/past-analysis/' + str(analysis_id)
         send_mail( request.json["email"], request.json['study_name'] + ' Analysis Results', message)
@@ -489,6 +504,8 @@ def direct_pathway_mapping2():
 @jwt_required()
 def pathway_enrichment():
 
+    from metabomics.preprocessing import MetaboliticsPipeline
+
     (data, error) = AnalysisInputSchema().load(request.json)
     if error:
         return jsonify(error), 400
@@ -520,6 +537,7 @@ def pathway_enrichment():
         db.session.add(study)
         db.session.commit()
         analysis_id = 0
+        cases = {}
         healthy_metab_data = None
         healthy_gene_data = None
         for key,value in data['analysis'].items():
@@ -579,7 +597,7 @@ def pathway_enrichment():
                 transcriptomics_data.disease_id = disease.id
                 transcriptomics_data.disease = disease
                 db.session.add(transcriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
 
                 analysis = Analyses(name=key, user=user)
@@ -597,10 +615,13 @@ def pathway_enrichment():
                 analysis.dataset_id = study.id
 
                 db.session.add(analysis)
-                db.session.commit()
-                save_pe.delay(analysis.id, value["Metabolites"] if healthy_metab_data == None else X_t)                
+                db.session.flush()
+                cases[analysis.id] = value["Metabolites"] if healthy_metab_data == None else X_t
                 analysis_id = analysis.id
 
+        # the cases are committed together, so their study is summarised once, as queued
+        db.session.commit()
+        save_pe_study.delay(study.id, cases)
         return jsonify({'id': analysis_id})
 
 
@@ -637,6 +658,7 @@ def pathway_enrichment2():
         db.session.commit()
 
         analysis_id = 0
+        analyses, cases = [], []
         for key,value in data["analysis"].items():  # user as key, value {metaboldata , label}
 
             if len(value['Metabolites']) > 0:
@@ -664,7 +686,7 @@ def pathway_enrichment2():
                 trancsriptomics_data.disease = disease
                 db.session.add(metabolomics_data)
                 db.session.add(trancsriptomics_data)
-                db.session.commit()
+                db.session.flush()
 
                 analysis = Analyses(name =key, user = user)
                 analysis.label = value['Label']
@@ -678,16 +700,20 @@ def pathway_enrichment2():
 
                 analysis.omics_data_id = [metabolomics_data.id, trancsriptomics_data.id] if trancsriptomics_data != None else metabolomics_data.id
                 analysis.dataset_id = study.id
-                analysis_runs = PathwayEnrichment(value["Metabolites"])  # Forming the instance
-                # fold_changes
-                analysis_runs.run()  # Making the analysis
-                analysis.results_pathway = [analysis_runs.result_pathways]
-                #analysis.results_reaction = [analysis_runs.result_reactions]
-                analysis.end_time = datetime.datetime.now()
-
                 db.session.add(analysis)
-                db.session.commit()
-                analysis_id = analysis.id
+                analyses.append(analysis)
+                cases.append(value["Metabolites"])
+
+        # Enriching all cases of the study at once
+        results_pathways, _ = get_pe_engine().score_many(cases, reactions=False)
+        end_time = datetime.datetime.now()
+        for analysis, results_pathway in zip(analyses, results_pathways):
+            analysis.results_pathway = [results_pathway]
+            analysis.end_time = end_time
+        db.session.commit()
+        update_corpus([analysis.id for analysis in analyses])
+        if analyses:
+            analysis_id = analyses[-1].id
 
         message = 'Hello, \n you can find your analysis results in the following link: \n http://metabolitics.itu.edu.tr/past-analysis/' + str(analysis_id)
         send_mail( request.json["email"], request.json['study_name'] + ' Analysis Results', message)
@@ -727,6 +753,8 @@ def analysis_visualization():
           required: true
     """
 
+    from ..visualization import HeatmapVisualization
+
     data = request.json['data']
     # print(data)
     analyses = Analyses.get_multiple(data.values())
@@ -757,6 +785,12 @@ def most_similar_diseases(id: int):
         in: path
         type: integer
         required: true
+      -
+        name: mode
+        in: query
+        type: string
+        enum: [exact, centroid]
+        required: false
     responses:
       200:
         description: Most similar diseases
@@ -765,6 +799,8 @@ def most_similar_diseases(id: int):
       401:
         description: Analysis is not yours
     """
+    from ..utils import similarty_dict
+
     analysis = Analyses.query.get(id)
     if not analysis:
         return '', 404
@@ -773,6 +809,16 @@ def most_similar_diseases(id: int):
     analysis_method_id = AnalysisMetadata.query.get(analysis.dataset_id).method_id
     groups = db.session.query(AnalysisMetadata.group).all()
     groups = [group[0].lower() + ' label avg' for group in groups]
+    corpus = get_corpus(analysis_method_id)
+    if corpus is not None:
+        if request.args.get('mode', app.config['SIMILARITY_MODE']) == 'centroid':
+            dis_sim_dict = corpus.centroid_similarities(analysis.results_pathway[0], groups)
+        else:
+            dis_sim_dict = corpus.similarities(analysis.results_pathway[0], groups)
+        top_five = sorted(dis_sim_dict.items(), key=lambda x: x[1], reverse=True)[:5]
+        return jsonify(dict(top_five))
+
+    # Corpus not built yet, comparing against the database rows
     public_analyses = db.session.query(Analyses).join(AnalysisMetadata).join(Diseases).filter(
         Analyses.type == 'public').filter(AnalysisMetadata.method_id == analysis_method_id).filter(
             Analyses.results_pathway != None).filter(
@@ -792,6 +838,89 @@ def most_similar_diseases(id: int):
     top_five = sorted(dis_sim_dict.items(), key=lambda x: x[1], reverse=True)[:5]
     return jsonify(dict(top_five))
 
+@app.route('/analysis/similar', methods=['POST'])
+def similar_analyses():
+    """
+    Most similar public analyses and diseases for many analyses at once
+    ---
+    tags:
+      - analysis
+    parameters:
+      -
+        name: authorization
+        in: header
+        type: string
+        required: false
+      -
+        name: body
+        in: body
+        schema:
+          type: object
+          properties:
+            analysis_ids:
+              type: array
+              items:
+                type: integer
+            k:
+              type: integer
+    responses:
+      200:
+        description: Top-k similar analyses and diseases per analysis id, null
+          for analyses that are missing, not yours or whose method has no corpus
+      400:
+        description: analysis_ids are not integers or k is not a positive integer
+    """
+    import hashlib
+    from sqlalchemy.orm import defer
+    from ..result_cache import cached_many
+
+    body = request.get_json(silent=True) or {}
+    try:
+        analysis_ids = [int(i) for i in body.get('analysis_ids', [])]
+        k = int(body.get('k', 5))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'analysis_ids must be integers and k a positive integer'}), 400
+    if k <= 0:
+        return jsonify({'error': 'k must be a positive integer'}), 400
+
+    # The token is optional, without it only public analyses are compared
+    try:
+        _jwt_required(app.config['JWT_DEFAULT_REALM'])
+    except Exception:
+        pass
+    user_id = current_identity.id if current_identity else None
+
+    analyses = Analyses.query.filter(Analyses.id.in_(analysis_ids)).options(
+        defer(Analyses.results_pathway), defer(Analyses.results_reaction)).all()
+    study_methods = dict(db.session.query(AnalysisMetadata.id, AnalysisMetadata.method_id).filter(
+        AnalysisMetadata.id.in_({analysis.dataset_id for analysis in analyses})).all())
+    by_method = {}
+    for analysis in analyses:
+        if analysis.type in ['private', 'noise'] and (user_id is None or analysis.owner_user_id != user_id):
+            continue
+        by_method.setdefault(study_methods.get(analysis.dataset_id), []).append(analysis.id)
+    groups = db.session.query(AnalysisMetadata.group).all()
+    groups = sorted({group[0].lower() + ' label avg' for group in groups})
+
+    results = {}
+    for method_id, ids in by_method.items():
+        corpus = get_corpus(method_id)
+        if corpus is None:
+            continue
+
+        def nearest(inputs):
+            ids = [int(vectors[0]['analysis']) for vectors in inputs]
+            results_pathways = dict(db.session.query(Analyses.id, Analyses.results_pathway).filter(
+                Analyses.id.in_(ids)).all())
+            return corpus.nearest([results_pathways[i][0] for i in ids], k, groups, exclude_ids=ids)
+
+        # Entries stay valid until the corpus or the healthy groups change
+        version = '%s:%s:%s' % (method_id, corpus.version,
+                                 hashlib.sha1(','.join(groups).encode('utf-8')).hexdigest())
+        results.update(zip(ids, cached_many('similar:%d' % k, version, nearest,
+                                            [({'analysis': i},) for i in ids])))
+    return jsonify({str(i): results.get(i) for i in analysis_ids})
+
 @app.route('/analysis/disease-prediction/<id>')
 def disease_prediction(id: int):
     """
@@ -824,76 +953,99 @@ def disease_prediction(id: int):
     if not analysis.authenticated():
         return '', 401
     results_reaction = analysis.results_reaction[0]
-    dir = '../trained_models'
-    preds = []
-    for file in os.listdir(dir):
-        if file == '.keep':
-            continue
-        file_path = os.path.join(dir, file)
-        if os.path.isfile(file_path):
-            try:
-                saved = pickle.load(open(file_path, 'rb'))
-                disease = saved['disease']
-                model = saved['model']
-                pred = model.predict([results_reaction])[0]
-                pred_score = model.predict_proba([results_reaction])[0]
-                pred_score = max(pred_score)
-                if pred != 0:
-                    preds.append({'disease' : disease, 'pred_score': round(pred_score, 3)})
-            except Exception as e:
-                print(e)
+    preds = predict_diseases(results_reaction)
     return jsonify(sorted(preds, key=lambda p: p['pred_score'], reverse=True))
 
+def _study_listing(summary_filter, analyses_filter):
+    """
+    Studies whose summary matches summary_filter, for the study listings
+        - query args:
+            page, per_page : 1-based page and studies per page (50), all studies without page
+            disease, method : disease id and analysis method id to keep
+            sort : id (default), name, start, end, disease or method
+            order : asc (default) or desc
+        - response:
+            json list of studies, with the total number of studies in X-Total-Count
+    Dates, case counts and the avg case come from the study summary table,
+    and the analyses of the studies on the page from one more query. The
+    healthy group average is not listed.
+    """
+    studies = StudySummary.query.filter(summary_filter)
+    disease_id = request.args.get('disease', type=int)
+    if disease_id is not None:
+        studies = studies.filter(StudySummary.disease_id == disease_id)
+    method_id = request.args.get('method', type=int)
+    if method_id is not None:
+        studies = studies.filter(StudySummary.method_id == method_id)
+
+    sort_columns = {'id': StudySummary.study_id, 'name': StudySummary.name, 'start': StudySummary.start_time,
+                    'end': StudySummary.end_time, 'disease': StudySummary.disease,
+                    'method': StudySummary.analysis_method}
+    sort = sort_columns.get(request.args.get('sort'), StudySummary.study_id)
+    if request.args.get('order') == 'desc':
+        studies = studies.order_by(sort.desc(), StudySummary.study_id.desc())
+    else:
+        studies = studies.order_by(sort, StudySummary.study_id)
+
+    page = request.args.get('page', type=int)
+    if page is not None:
+        per_page = max(request.args.get('per_page', 50, type=int), 1)
+        total = studies.order_by(None).count()
+        studies = studies.limit(per_page).offset((max(page, 1) - 1) * per_page).all()
+    else:
+        studies = studies.all()
+        total = len(studies)
+
+    analyses = {}
+    if studies:
+        rows = db.session.query(Analyses.id, Analyses.name, Analyses.dataset_id, Analyses.start_time,
+                                Analyses.end_time).join(AnalysisMetadata, Analyses.dataset_id == AnalysisMetadata.id).filter(
+            Analyses.dataset_id.in_([study.study_id for study in studies])).filter(analyses_filter).filter(
+                listed_analyses()).order_by(Analyses.id)
+        for analysis in rows:
+            analyses.setdefault(analysis[2], []).append(
+                {'id': analysis[0], 'name': analysis[1], 'start': analysis[3], 'end': analysis[4]})
+
+    # progress of the running analyses of the whole page, in one round trip
+    partial = get_progress([analysis_id for analysis_data in analyses.values()
+                            for analysis_id in running_analyses(analysis_data)])
+    returned_data = []
+    for study in studies:
+        analysis_data = analyses.get(study.study_id, [])
+        returned_data.append({
+            'id': study.study_id,
+            'name': study.name,
+            'analyses': analysis_data,
+            'analysis_method': study.analysis_method,
+            'diffusion_method': study.diffusion_method,
+            'disease': study.disease,
+            'start': study.start_time,
+            'end': study.end_time,
+            'cases': study.cases,
+            'finished': study.finished,
+            'avg_id': study.avg_id,
+            'progress': study_progress(analysis_data, partial)
+        })
+    response = jsonify(returned_data)
+    response.headers['X-Total-Count'] = str(total)
+    return response
+
 @app.route('/analysis/<type>')
 def analysis_details(type):
-    data = AnalysisMetadata.query.all()
-    returned_data = []
-    for item in data:
-        analyses = Analyses.query.filter_by(type='public', dataset_id=item.id).with_entities(
-            Analyses.id, Analyses.name, Analyses.dataset_id, Analyses.start_time, Analyses.end_time)
-        analysisMethod = AnalysisMethod.query.get(item.method_id)
-        diffusionMethod = DiffusionMethod.query.get(item.diffusion_id)
-        disease = Diseases.query.get(item.disease_id)
-        group = item.group
-        if len(list(analyses)) > 0:
-            avg_id = -1
-            analysis_data = []
-            starts = []
-            ends = []
-            for analysis in analyses:
-                if group != 'not_provided':
-                    if str(group).lower() + ' label avg' == analysis[1]:
-                        continue
-                analysis_data.append({'id': analysis[0], 'name': analysis[1], "start": analysis[3], "end": analysis[4]})
-                if analysis[3] != None:
-                    starts.append(analysis[3])
-                if analysis[4] != None:
-                    ends.append(analysis[4])
-                if group != 'not_provided':
-                    if ' label avg' in analysis[1]:
-                        avg_id = analysis[0]
-            if len(starts) > 0:
-                start = min(starts)
-            else:
-                start = None
-            if len(ends) == len(analysis_data):
-                end = max(ends)
-            else:
-                end = None
-            returned_data.append({
-                'id': item.id,
-                'name': item.name,
-                'analyses': analysis_data,
-                'analysis_method': analysisMethod.name,
-                'diffusion_method': diffusionMethod.name,
-                'disease': disease.name,
-                'start': start,
-                'end': end,
-                'avg_id': analysis_data[0]['id'] if avg_id == -1 else avg_id,
-                'progress': round(len(ends) / len(analysis_data) * 100) 
-            })
-    # print(returned_data)
-    return jsonify(returned_data)
+    """
+    List of public studies
+    ---
+    tags:
+        - analysis
+    parameters:
+        - {name: page, in: query, type: integer, required: false}
+        - {name: per_page, in: query, type: integer, required: false}
+        - {name: disease, in: query, type: integer, required: false}
+        - {name: method, in: query, type: integer, required: false}
+        - {name: sort, in: query, type: string, enum: [id, name, start, end, disease, method], required: false}
+        - {name: order, in: query, type: string, enum: [asc, desc], required: false}
+    """
+    return _study_listing(StudySummary.type == 'public', Analyses.type == 'public')
 
 @app.route('/analysis/list')
 @jwt_required()
@@ -909,57 +1061,20 @@ def user_analysis():
           in: header
           type: string
           required: true
+        - {name: page, in: query, type: integer, required: false}
+        - {name: per_page, in: query, type: integer, required: false}
+        - {name: disease, in: query, type: integer, required: false}
+        - {name: method, in: query, type: integer, required: false}
+        - {name: sort, in: query, type: string, enum: [id, name, start, end, disease, method], required: false}
+        - {name: order, in: query, type: string, enum: [asc, desc], required: false}
     """
-    data = AnalysisMetadata.query.all()
-    returned_data = []
-
-    if 'Authorization Required' not in str(current_identity.id):
-        for item in data:
-            analyses = Analyses.query.filter_by(owner_user_id=current_identity.id, type='private', dataset_id=item.id).with_entities(
-            Analyses.id, Analyses.name, Analyses.dataset_id, Analyses.start_time, Analyses.end_time)
-            analysisMethod = AnalysisMethod.query.get(item.method_id)
-            diffusionMethod = DiffusionMethod.query.get(item.diffusion_id)
-            disease = Diseases.query.get(item.disease_id)
-            group = item.group
-            if len(list(analyses)) > 0:
-                avg_id = -1
-                analysis_data = []
-                starts = []
-                ends = []
-                for analysis in analyses:
-                    if group != 'not_provided':
-                        if str(group).lower() + ' label avg' == analysis[1]:
-                            continue
-                    analysis_data.append({'id': analysis[0], 'name': analysis[1], 'start': analysis[3], 'end': analysis[4]})
-                    if analysis[3] != None:
-                        starts.append(analysis[3])
-                    if analysis[4] != None:
-                        ends.append(analysis[4])
-                    if group != 'not_provided':
-                        if ' label avg' in analysis[1]:
-                            avg_id = analysis[0]
-                if len(starts) > 0:
-                    start = min(starts)
-                else:
-                    start = None
-                if len(ends) == len(analysis_data):
-                    end = max(ends)
-                else:
-                    end = None
-                returned_data.append({
-                    'id': item.id,
-                    'name': item.name,
-                    'analyses': analysis_data,
-                    'analysis_method': analysisMethod.name,
-                    "diffusion_method": diffusionMethod.name,
-                    'disease': disease.name,
-                    'start': start,
-                    'end': end,
-                    'avg_id': analysis_data[0]['id'] if avg_id == -1 else avg_id,
-                    'progress': round(len(ends) / len(analysis_data) * 100) 
-                })
-
-    return jsonify(returned_data)
+    if 'Authorization Required' in str(current_identity.id):
+        response = jsonify([])
+        response.headers['X-Total-Count'] = '0'
+        return response
+    return _study_listing(
+        and_(StudySummary.owner_user_id == current_identity.id, StudySummary.type == 'private'),
+        and_(Analyses.owner_user_id == current_identity.id, Analyses.type == 'private'))
 
 #TODO
 @app.route('/analysis/detail/<id>')
@@ -1100,10 +1215,11 @@ def search_analysis_by_metabol():
 
 
 ################## New
-def checkMapped(data):
+def checkMapped(data, dataset='recon3D'):
     '''
 
     :param data: our data strcuture for multi cases inputs
+    :param dataset: network in datasets/assets whose metabolite ids are kept
     :return: same data strcuture but removing the unmapped metabolites
     '''
 
@@ -1150,9 +1266,7 @@ def checkMapped(data):
         #     tempo = line.split(",")
         #     mapping_metabolites[tempo[0].strip()] = tempo[1].strip()
         #
-        with open('../datasets/assets/recon3D.json') as f:
-            mapping_data1 = json.load(f)
-            mapping_data1 = mapping_data1["metabolites"]
+        mapping_data1 = load_network(dataset)["metabolites"]
 
         with open('../datasets/assets/new-synonym-mapping.json') as f:
             mapping_data2 = json.load(f)
@@ -1185,25 +1299,7 @@ def checkMapped(data):
 
 @app.route('/models/scores', methods=['GET'])
 def get_model_scores():
-    scores = {}
-    dir = '../trained_models'
-    for file in os.listdir(dir):
-        if file == '.keep':
-            continue
-        file_path = os.path.join(dir, file)
-        if os.path.isfile(file_path):
-            try:
-                saved = pickle.load(open(file_path, 'rb'))
-                disease = saved['disease']
-                fold_number = saved['fold_number']
-                f1_score = saved['f1_score']
-                precision_score = saved['precision_score']
-                recall_score = saved['recall_score']
-                algorithm = saved['algorithm']
-                scores[disease] = {'fold_number': fold_number, 'f1_score': f1_score, 'precision_score': precision_score, 'recall_score': recall_score, 'algorithm': algorithm}
-            except Exception as e:
-                print(e)
-    return jsonify(scores)
+    return jsonify(get_disease_model_scores())
 
 @app.route('/delete/delete_analysis', methods=['POST'])
 @jwt_required()
@@ -1221,6 +1317,7 @@ def delete_analysis():
         if not analyses_to_delete:
             return jsonify({"error": "No matching analyses found"}), 404
 
+        remove_from_corpus([analysis.id for analysis in analyses_to_delete])
         for analysis in analyses_to_delete:
             db.session.delete(analysis)
 
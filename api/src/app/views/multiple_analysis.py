@@ -2,8 +2,6 @@ from flask import jsonify, request
 from flask_jwt import jwt_required, current_identity
 from sqlalchemy import and_
 from sqlalchemy.types import Float
-from ..utils import similarty_dict
-from ..visualization import HeatmapVisualization
 import time
 from ..app import app
 from ..schemas import *
@@ -12,7 +10,6 @@ from ..tasks import save_analysis
 from ..base import *
 from ..dpm import *
 import datetime
-import mwtab
 from timeit import default_timer as timer
 import json
 from collections import OrderedDict
@@ -205,6 +202,7 @@ def meta_data_processing(meta):
 ################################################### MWtab codes below
 
 def mwtabReader(name):
+    import mwtab
 
     dicte = {}
     liste = []
@@ -237,6 +235,8 @@ def mwtabReader(name):
 
 
 def checkDatabases(name):  # check if our used databases are used.
+    import mwtab
+
     mw = next(mwtab.read_files(name[0],name[1]))
     database = []
     data = mw["METABOLITES"]["METABOLITES_START"]["DATA"]
@@ -255,6 +255,8 @@ def databaseProccesing(name):
     checks which database has more metabolites available
     # if everything is ok it returns the name and data of database
     """
+    import mwtab
+
     temp = checkDatabases(name)
     mapped = {}
     mapped_final = {}
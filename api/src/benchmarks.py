@@ -0,0 +1,328 @@
+"""
+Offline benchmarks for the analysis hot paths
+
+Studies are sampled from the curated sheets in datasets/diseases and scored
+against datasets/assets/recon2.json, so no database, broker or network access
+is needed. Every benchmark runs across growing sample and metabolite counts
+and records wall time, peak memory and throughput.
+
+    python main.py benchmark --output ../outputs/benchmarks.json
+    python main.py benchmark --baseline ../outputs/benchmarks.json
+    python main.py benchmark-similarity --output ../outputs/similarity.json
+"""
+import io
+import os
+import csv
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import datetime
+import tracemalloc
+from contextlib import redirect_stdout
+
+DISEASES_PATH = '../datasets/diseases'
+SYNONYMS_PATH = '../datasets/assets/new-synonym-mapping.json'
+DATASET = 'recon2'
+SAMPLE_COUNTS = (10, 50, 200)
+METABOLITE_FRACTIONS = (0.25, 0.5, 1.0)
+
+
+def read_csv_source(name):
+    """Reading a curated csv sheet into (metabolite names, [(label, values)])"""
+    with open(os.path.join(DISEASES_PATH, name + '.csv')) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = []
+        for row in reader:
+            values = {}
+            for metabolite, value in zip(header[1:], row[1:]):
+                try:
+                    values[metabolite] = float(value)
+                except ValueError:
+                    continue
+            rows.append((row[0], values))
+    return header[1:], rows
+
+
+def read_xlsx_source(name):
+    """Reading an analyzed study sheet (data and meta worksheets) into the csv layout"""
+    import pandas as pd
+
+    path = os.path.join(DISEASES_PATH, 'analyzed', name + '.xlsx')
+    data = pd.read_excel(path, sheet_name='data', index_col=0)
+    meta = pd.read_excel(path, sheet_name='meta', header=None)
+    labels = {str(row[0]): str(row[1]) for row in meta.values[3:]}
+    metabolites = [str(m) for m in data.index]
+    rows = []
+    for sample in data.columns:
+        values = {str(m): float(v) for m, v in data[sample].items() if v == v}
+        rows.append((labels.get(str(sample), 'not_provided'), values))
+    return metabolites, rows
+
+
+def read_source(name):
+    if os.path.exists(os.path.join(DISEASES_PATH, name + '.csv')):
+        return read_csv_source(name)
+    return read_xlsx_source(name)
+
+
+def make_study(source, n_samples, fraction, seed=41):
+    """
+    Sampling a study in the upload format used by the analysis endpoints
+        - params:
+            source : (metabolite names, rows) from read_source
+            n_samples : number of cases, rows are drawn with replacement
+            fraction : share of the metabolite columns to keep
+    """
+    metabolites, rows = source
+    rng = random.Random(seed)
+    kept = set(rng.sample(metabolites, max(1, int(len(metabolites) * fraction))))
+    analysis = {}
+    for i in range(n_samples):
+        label, values = rng.choice(rows)
+        analysis['case %d' % i] = {
+            'Label': label,
+            'Metabolites': {k: v for k, v in values.items() if k in kept},
+        }
+    labels = sorted(set(case['Label'] for case in analysis.values()))
+    return {
+        'study_name': 'benchmark',
+        'public': True,
+        'disease': 0,
+        'group': labels[0],
+        'analysis': analysis,
+    }, len(kept)
+
+
+def map_study(study, base, synonyms):
+    """Mapping metabolite names of a study to network ids, as checkMapped does"""
+    metabolite_names = base.get_metabolite_names()
+    cases = []
+    for case in study['analysis'].values():
+        mapped = {}
+        for name, value in case['Metabolites'].items():
+            if name in synonyms:
+                mapped[synonyms[name]] = value
+            if name in metabolite_names:
+                mapped[name] = value
+        cases.append(mapped)
+    return cases
+
+
+def measure(func, n_items, repeat=3):
+    """Best wall time of repeat runs, peak traced memory of one run and items per second"""
+    with redirect_stdout(io.StringIO()):
+        func()  # warm up caches such as the network registry and engines
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    wall_time = min(times)
+    return {
+        'wall_time': wall_time,
+        'peak_memory_kb': peak / 1024,
+        'throughput': n_items / wall_time if wall_time > 0 else None,
+    }
+
+
+def benchmark_cases(study, cases):
+    """Benchmarks of one sampled study, as (name, callable, number of items)"""
+    from app.dpm import DirectPathwayMapping
+    from app.pe import PathwayEnrichment
+    from app.utils import similarty_dict
+    from app.visualization import HeatmapVisualization
+    from app.views.anaylsis import checkMapped
+    from app.views.multiple_analysis import group_avg
+
+    def run_all(cls):
+        results = []
+        for fold_changes in cases:
+            analysis = cls(fold_changes, dataset=DATASET)
+            analysis.run()
+            results.append(analysis.result_pathways)
+        return results
+
+    pathways = run_all(DirectPathwayMapping)
+    labels = [case['Label'] for case in study['analysis'].values()]
+    return [
+        ('checkMapped', lambda: checkMapped(study, dataset=DATASET), len(cases)),
+        ('group_avg', lambda: group_avg(study), len(cases)),
+        ('DirectPathwayMapping.run', lambda: run_all(DirectPathwayMapping), len(cases)),
+        ('PathwayEnrichment.run', lambda: run_all(PathwayEnrichment), len(cases)),
+        ('similarty_dict', lambda: similarty_dict(pathways[0], pathways[1:]), len(cases)),
+        ('HeatmapVisualization.clustered_data',
+         lambda: HeatmapVisualization(pathways, labels).clustered_data(), len(cases)),
+    ]
+
+
+def run(sources=('BC', 'CRC'), sample_counts=SAMPLE_COUNTS,
+        metabolite_fractions=METABOLITE_FRACTIONS, repeat=3):
+    """Running every benchmark for every source and size, returning the report"""
+    from app.base import MetaboliticsBase
+
+    base = MetaboliticsBase(DATASET)
+    with open(SYNONYMS_PATH) as f:
+        synonyms = json.load(f)
+
+    records = []
+    for source_name in sources:
+        source = read_source(source_name)
+        for n_samples in sample_counts:
+            for fraction in metabolite_fractions:
+                study, n_metabolites = make_study(source, n_samples, fraction)
+                cases = map_study(study, base, synonyms)
+                for name, func, n_items in benchmark_cases(study, cases):
+                    record = {
+                        'name': name,
+                        'source': source_name,
+                        'samples': n_samples,
+                        'metabolites': n_metabolites,
+                    }
+                    try:
+                        record.update(measure(func, n_items, repeat))
+                    except Exception as e:
+                        record['error'] = repr(e)
+                    records.append(record)
+                    print(format_record(record))
+    return {
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'dataset': DATASET,
+        'records': records,
+    }
+
+
+def record_key(record):
+    return (record['name'], record['source'], record['samples'], record['metabolites'])
+
+
+def format_record(record):
+    head = '%-38s %-6s %5d samples %5d metabolites' % record_key(record)
+    if 'error' in record:
+        return head + '  error: ' + record['error']
+    return head + '  %10.4f s %12.1f KiB %10.1f /s' % (
+        record['wall_time'], record['peak_memory_kb'], record['throughput'] or 0)
+
+
+def compare(report, baseline, threshold=1.2):
+    """
+    Comparing a report against a saved baseline
+        - response:
+            list of (key, baseline wall time, wall time, ratio) whose wall time
+            grew by more than threshold
+    """
+    previous = {record_key(r): r for r in baseline['records'] if 'error' not in r}
+    regressions = []
+    for record in report['records']:
+        old = previous.get(record_key(record))
+        if old is None or 'error' in record or not old['wall_time']:
+            continue
+        ratio = record['wall_time'] / old['wall_time']
+        if ratio > threshold:
+            regressions.append((record_key(record), old['wall_time'], record['wall_time'], ratio))
+    return regressions
+
+
+def similarity_rows(sources, n_samples, base, synonyms):
+    """
+    Corpus rows scored with DPM from sampled studies, as (id, disease, label, results_pathway)
+    Every label of every source counts as a disease, so that there is more
+    than one disease to rank.
+    """
+    from app.dpm import DirectPathwayMapping
+
+    rows = []
+    for source_name in sources:
+        study, _ = make_study(read_source(source_name), n_samples, 1.0)
+        cases = map_study(study, base, synonyms)
+        for case, fold_changes in zip(study['analysis'].values(), cases):
+            analysis = DirectPathwayMapping(fold_changes, dataset=DATASET)
+            analysis.run()
+            rows.append((len(rows) + 1, '%s %s' % (source_name, case['Label']), 'not_provided',
+                         analysis.result_pathways))
+    return rows
+
+
+def rank_agreement(exact, approximate, k):
+    """Top-1 match, share of the top k in common and Spearman correlation of two disease rankings"""
+    import numpy as np
+
+    diseases = sorted(exact)
+    if not diseases:
+        return 1.0, 1.0, 1.0
+    a = np.array([exact[d] for d in diseases])
+    b = np.array([approximate.get(d, -np.inf) for d in diseases])
+    ranks_a = np.argsort(np.argsort(-a, kind='stable')).astype(float)
+    ranks_b = np.argsort(np.argsort(-b, kind='stable')).astype(float)
+    top_a, top_b = set(np.flatnonzero(ranks_a < k)), set(np.flatnonzero(ranks_b < k))
+    spearman = np.corrcoef(ranks_a, ranks_b)[0, 1] if len(diseases) > 1 else 1.0
+    return float(ranks_b[ranks_a.argmin()] == 0), len(top_a & top_b) / len(top_a), float(spearman)
+
+
+def run_similarity(sources=('BC', 'CRC'), n_samples=200, k=5, repeat=3, query_share=0.1):
+    """
+    Comparing the exact and centroid modes of most-similar-diseases
+    A share of the rows is held out as queries and the rest written to a
+    temporary corpus. Both modes rank the diseases of every query, the report
+    has the latency of each mode and how well the centroid ranking agrees with
+    the exact one.
+    """
+    from app import corpus
+    from app.base import MetaboliticsBase
+
+    base = MetaboliticsBase(DATASET)
+    with open(SYNONYMS_PATH) as f:
+        synonyms = json.load(f)
+    rows = similarity_rows(sources, n_samples, base, synonyms)
+    step = max(2, int(round(1 / query_share)))
+    queries = [row[3] for i, row in enumerate(rows) if i % step == 0]
+    corpus_rows = [row for i, row in enumerate(rows) if i % step != 0]
+
+    path, original = tempfile.mkdtemp(), corpus.CORPUS_PATH
+    corpus.CORPUS_PATH = path
+    try:
+        corpus.rebuild(0, corpus_rows)
+        pathway_corpus = corpus.get_corpus(0)
+        modes = {'exact': pathway_corpus.similarities, 'centroid': pathway_corpus.centroid_similarities}
+        rankings = {name: [similarities(x) for x in queries] for name, similarities in modes.items()}
+        records = []
+        for name, similarities in modes.items():
+            record = {'name': 'most_similar_diseases.' + name, 'source': '+'.join(sources),
+                      'samples': len(corpus_rows), 'metabolites': 0}
+            record.update(measure(lambda: [similarities(x) for x in queries], len(queries), repeat))
+            records.append(record)
+            print(format_record(record))
+    finally:
+        corpus.CORPUS_PATH = original
+        shutil.rmtree(path)
+
+    agreement = [rank_agreement(exact, centroid, k)
+                 for exact, centroid in zip(rankings['exact'], rankings['centroid'])]
+    summary = {
+        'queries': len(queries),
+        'diseases': len(pathway_corpus.disease_names),
+        'k': k,
+        'top1_agreement': sum(a[0] for a in agreement) / len(agreement),
+        'topk_overlap': sum(a[1] for a in agreement) / len(agreement),
+        'spearman': sum(a[2] for a in agreement) / len(agreement),
+        'speedup': records[0]['wall_time'] / records[1]['wall_time'] if records[1]['wall_time'] else None,
+    }
+    print('top-1 agreement %.3f, top-%d overlap %.3f, spearman %.3f, speedup x%.1f' % (
+        summary['top1_agreement'], k, summary['topk_overlap'], summary['spearman'], summary['speedup'] or 0))
+    return {
+        'created': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'dataset': DATASET,
+        'records': records,
+        'agreement': summary,
+    }
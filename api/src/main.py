@@ -4,24 +4,21 @@ from __future__ import absolute_import
 
 
 import os
+import sys
 import yaml
 import logging.config
 
-from subprocess import call
+from subprocess import call, run, PIPE
 import click
 import os
 import uuid
 import json
 from collections import defaultdict
 import pickle
-from sklearn.pipeline import  Pipeline
 from app.app import app
 from app.models import db, AnalysisMethod, User, Diseases, DiffusionMethod
 from app.DOParser import DOParser
-
-from sklearn_utils.utils import SkUtilsIO
-from metabomics.preprocessing import *
-from metabomics.utils import load_network_model
+from app.base import compile_network as compile_network_
 
 @click.group()
 def cli():
@@ -39,13 +36,32 @@ def run_api():
 
 @cli.command()
 def run_celery():
-    call('celery -A app.celery worker', shell=True)
+    # A single worker for development, consuming every queue
+    call('celery -A app.celery worker -Q celery,fast,heavy', shell=True)
     # celery4 = make_celery(app)
     #call('celery -A app.celery.celery worker -l info -Q celery')
 
     # call('celery --app =app worker --loglevel=info')
     # make_celery(app)
 
+@cli.command()
+@click.option('--queue', type=click.Choice(['fast', 'heavy']), required=True)
+@click.option('--concurrency', default=None, type=int, help='Overrides CELERY_QUEUE_WORKERS')
+@click.option('--prefetch', default=None, type=int, help='Overrides CELERY_QUEUE_WORKERS')
+def run_celery_worker(queue, concurrency, prefetch):
+    '''
+    This function starts a celery worker consuming only the given queue
+    '''
+    settings = app.config['CELERY_QUEUE_WORKERS'][queue]
+    concurrency = concurrency or settings['concurrency']
+    prefetch = prefetch or settings['prefetch']
+    command = 'celery -A app.celery worker -Q %s -n %s@%%h -c %d --prefetch-multiplier %d' % (
+        queue, queue, concurrency, prefetch)
+    if queue == 'heavy':
+        # hand a task only to a process that is free, instead of queueing it behind a running FVA
+        command += ' -O fair'
+    call(command, shell=True)
+
 @cli.command()
 def run_celery_beat():
     call('celery -A app.celery beat', shell=True)
@@ -88,6 +104,52 @@ def migrate():
     db.session.commit()
 
 
+@cli.command()
+def create_tables():
+    '''
+    This function creates the tables missing from the database, keeping existing data,
+    and fills the study summary table when it is empty
+    '''
+    from app.study_summary import migrate_study_summaries
+
+    db.create_all()
+    written = migrate_study_summaries()
+    if written:
+        print('Filled the study summary table with %d rows' % written)
+
+
+@cli.command()
+@click.option('--batch-size', default=500, help='Studies recomputed per transaction')
+def rebuild_study_summaries(batch_size):
+    '''
+    This function recomputes the study summary table read by the study listings from the analyses
+    '''
+    from app.study_summary import rebuild_study_summaries as rebuild_study_summaries_
+
+    print('Rebuilt %d study summaries' % rebuild_study_summaries_(batch_size))
+
+
+@cli.command()
+@click.option('--force', is_flag=True, help='Retrain every disease, even unchanged ones')
+def train_models(force):
+    '''
+    This function trains the disease prediction models, only for diseases with new analyses
+    '''
+    from app.tasks import train_save_model
+
+    train_save_model(force=force)
+
+
+@cli.command()
+def backfill_model_scores():
+    '''
+    This function writes the score files missing next to trained models, read by /models/scores
+    '''
+    from app.disease_models import backfill_sidecars
+
+    print('Wrote %d model score files' % backfill_sidecars())
+
+
 @cli.command()
 def generate_secret():
     with open('../secret.txt', 'w') as f:
@@ -99,6 +161,8 @@ def generate_angular_friendly_model():
     '''
     This function convert json model into angular friendly json
     '''
+    from metabomics.utils import load_network_model
+
     model = load_network_model()
     model_json = json.load(open('../dataset/network/recon3D.json'))
 
@@ -124,8 +188,132 @@ def generate_angular_friendly_model():
 
 
 
+@cli.command()
+@click.option('--dataset', default='recon3D', help='Network name in datasets/assets')
+def compile_network(dataset):
+    '''
+    This function compiles a json network into the memory-mapped binary format
+    '''
+    out = compile_network_(dataset)
+    print('Compiled %s into %s' % (dataset, out))
+
+
+@cli.command()
+@click.option('--method', multiple=True, type=int, default=[1, 2, 3],
+              help='Analysis method id (1 Metabolitics, 2 DPM, 3 PE)')
+def build_corpus(method):
+    '''
+    This function builds the memory-mapped public pathway score matrix used by most-similar-diseases
+    '''
+    from app.corpus import build_corpus as build_corpus_, get_corpus
+
+    for method_id in method:
+        build_corpus_(method_id)
+        print('Built corpus of method %d with %d analyses' % (method_id, get_corpus(method_id).n_rows))
+
+
+@cli.command()
+@click.option('--module', default='app', help='Module to import')
+@click.option('--top', default=20, help='Number of packages to list')
+def import_report(module, top):
+    '''
+    This function prints the import cost of a module, grouped by top-level package
+    '''
+    result = run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                 stderr=PIPE, universal_newlines=True)
+    costs = defaultdict(int)
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.rstrip()
+        costs[name.strip().split('.')[0]] += int(self_us)
+        if not name.startswith('  '):  # top level imports carry the cumulative cost
+            total += int(cumulative_us)
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+    print('%-30s %10s' % ('package', 'ms'))
+    for package, cost in sorted(costs.items(), key=lambda c: c[1], reverse=True)[:top]:
+        print('%-30s %10.1f' % (package, cost / 1000))
+    print('%-30s %10.1f' % ('total', total / 1000))
+
+
+@cli.command()
+@click.option('--source', multiple=True, default=['BC', 'CRC'],
+              help='Sheet in datasets/diseases (csv name or analyzed xlsx name)')
+@click.option('--repeat', default=3, help='Timed runs per benchmark, the best is kept')
+@click.option('--output', default='../outputs/benchmarks.json', help='Report file')
+@click.option('--baseline', default=None, help='Report to compare against')
+@click.option('--threshold', default=1.2, help='Slowdown ratio reported as regression')
+def benchmark(source, repeat, output, baseline, threshold):
+    '''
+    This function benchmarks DPM, PE, mapping and visualization hot paths offline
+    '''
+    import benchmarks
+
+    report = benchmarks.run(sources=source, repeat=repeat)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print('Report written to %s' % output)
+    if baseline:
+        with open(baseline) as f:
+            regressions = benchmarks.compare(report, json.load(f), threshold)
+        for key, old, new, ratio in regressions:
+            print('Regression %s: %.4f s -> %.4f s (x%.2f)' % (key, old, new, ratio))
+        if not regressions:
+            print('No regressions against %s' % baseline)
+
+
+@cli.command()
+@click.option('--source', multiple=True, default=['BC', 'CRC'],
+              help='Sheet in datasets/diseases (csv name or analyzed xlsx name)')
+@click.option('--samples', default=200, help='Analyses sampled per source')
+@click.option('--top', default=5, help='Number of diseases compared between the modes')
+@click.option('--repeat', default=3, help='Timed runs per mode, the best is kept')
+@click.option('--output', default='../outputs/similarity.json', help='Report file')
+def benchmark_similarity(source, samples, top, repeat, output):
+    '''
+    This function compares the ranking agreement and latency of the exact and centroid similarity modes
+    '''
+    import benchmarks
+
+    report = benchmarks.run_similarity(sources=source, n_samples=samples, k=top, repeat=repeat)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print('Report written to %s' % output)
+
+
+@cli.command()
+@click.option('--clear', is_flag=True, help='Drop every cached result and reset the counters')
+def result_cache(clear):
+    '''
+    This function prints the hit rate and size of the shared analysis result cache
+    '''
+    from app.result_cache import get_result_cache
+
+    cache = get_result_cache()
+    if cache is None:
+        print('Result cache is disabled, set RESULT_CACHE_URL to enable it')
+        return
+    if clear:
+        cache.clear()
+        print('Result cache cleared')
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    print('hits %d, misses %d, hit rate %.1f%%' % (
+        stats['hits'], stats['misses'], 100.0 * stats['hits'] / lookups if lookups else 0))
+    print('entries %d, %.1f of %.1f MB' % (stats['entries'], stats['bytes'] / 1048576.0, stats['max_bytes'] / 1048576.0))
+
+
 @cli.command()
 def healties_model():
+    from sklearn.pipeline import Pipeline
+    from sklearn_utils.utils import SkUtilsIO
+    from metabomics.preprocessing import MetaboliticsPipeline, MetaboliticsTransformer, ReactionDiffTransformer
+
     disease_name = 'BC'
     path = '../datasets/diseases/%s.csv' % disease_name
     X, y = SkUtilsIO(path).from_csv(label_column='stage')
@@ -1,9 +1,33 @@
+import datetime
+import fcntl
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import flask_testing
 
 from .app import app, config
-from .models import Analyses, db
-from .tasks import save_analysis
+from .auth import jwt
+from .celery import celery
+from .models import Analyses, AnalysisMetadata, Diseases, DiseaseModel, DiseaseTrainingSet, StudySummary, User, db
+from . import tasks
+from .tasks import save_analysis, save_analysis_study
+from . import base, dpm, pe
+from .base import MetaboliticsBase, load_compiled_network
+from .dpm import DirectPathwayMapping
+from .pe import PathwayEnrichment
+from . import corpus, disease_models, pipelines, result_cache, training
+from .study_summary import summary_query, rebuild_study_summaries
+from .views import anaylsis as analysis_views
+from .utils import similarty_dict
+from . import benchmarks
 
 
 class ApiTests(flask_testing.TestCase):
@@ -27,6 +51,174 @@ class TaskTests(unittest.TestCase):
         # db.session.delete(self.analysis)
         # db.session.commit()
 
+    def test_save_analysis_study_progress(self):
+        reaction_scaler, pathway_scaler = mock.Mock(), mock.Mock()
+        pathway_scaler.transform.side_effect = lambda reactions: [{'p': len(r)} for r in reactions]
+
+        def transform_sample(scaler, changes, genes, progress=None):
+            progress(1, 2)
+            progress(2, 2)
+            return [dict(changes)]
+
+        with mock.patch.object(tasks, 'db'), mock.patch.object(tasks, 'AnalysisMetadata'), \
+                mock.patch.object(tasks, 'refresh_study_summaries'), mock.patch.object(tasks, 'update_corpus'), \
+                mock.patch.object(tasks, 'get_model_version', return_value='v'), \
+                mock.patch.object(tasks, 'cached_many', lambda method, version, compute, inputs, payloads: compute(payloads)), \
+                mock.patch.object(tasks, 'get_analysis_pipelines', return_value=(reaction_scaler, pathway_scaler)), \
+                mock.patch.object(tasks, 'uses_chunked_fva', return_value=True), \
+                mock.patch.object(tasks, 'transform_sample', side_effect=transform_sample), \
+                mock.patch.object(tasks, 'set_progress') as set_progress, \
+                mock.patch.object(tasks, 'clear_progress') as clear_progress:
+            save_analysis_study(1, {'5': {'a': 1.0}, '6': {'b': 2.0}})
+
+        self.assertEqual(set_progress.call_args_list, [mock.call(5, 1, 2), mock.call(5, 2, 2),
+                                                       mock.call(6, 1, 2), mock.call(6, 2, 2)])
+        self.assertEqual(clear_progress.call_args_list, [mock.call(5), mock.call(6)])
+        reaction_scaler.transform.assert_not_called()
+
+
+class ImportTests(unittest.TestCase):
+    def test_app_import_is_light(self):
+        heavy = ['sklearn', 'metabomics', 'statsmodels', 'scipy.stats', 'plotly', 'mwtab', 'cobra', 'sendgrid']
+        code = ('import sys, app\n'
+                'print(len(app.base._networks))\n'
+                'print(" ".join(module for module in %r if module in sys.modules))' % heavy)
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        networks, imported = output.splitlines()[-2:]
+        self.assertEqual(networks, '0')
+        self.assertEqual(imported, '')
+
+
+class PipelinesTests(unittest.TestCase):
+    def worker(self, queues):
+        conf = mock.Mock(task_routes=app.config['CELERY_ROUTES'], task_default_queue='celery')
+        queues = mock.Mock(consume_from=dict.fromkeys(queues))
+        return mock.Mock(app=mock.Mock(conf=conf, amqp=mock.Mock(queues=queues)))
+
+    def test_preload_only_for_pipeline_queues(self):
+        for queues, preloaded in ((['fast'], False), (['heavy'], True), (['celery', 'fast', 'heavy'], True)):
+            with mock.patch.object(pipelines, '_preload', False), \
+                    mock.patch.object(pipelines, 'get_analysis_pipelines') as get_analysis_pipelines:
+                pipelines.check_worker_queues(self.worker(queues))
+                pipelines.preload_pipelines()
+            self.assertEqual(get_analysis_pipelines.called, preloaded, queues)
+
+
+class TrainingJobTests(unittest.TestCase):
+    def setUp(self):
+        self.training = [(i, datetime.datetime(2020, 1, i + 1)) for i in range(12)]
+        self.training_set = None
+        self.disease_model = None
+        patches = [mock.patch.object(tasks, 'db'), mock.patch.object(AnalysisMetadata, 'query'),
+                   mock.patch.object(DiseaseTrainingSet, 'query'), mock.patch.object(DiseaseModel, 'query')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        tasks.db.session.query.side_effect = self.query
+        DiseaseTrainingSet.query.filter_by.side_effect = lambda **kwargs: mock.Mock(first=lambda: self.training_set)
+        DiseaseModel.query.filter_by.side_effect = lambda **kwargs: mock.Mock(first=lambda: self.disease_model)
+
+    def query(self, *entities):
+        chain = mock.Mock()
+        chain.filter.return_value = chain
+        chain.with_entities.return_value = chain
+        chain.all.return_value = [(1,)] if entities[0] is AnalysisMetadata.id else list(self.training)
+        return chain
+
+    def fingerprint(self):
+        return DiseaseTrainingSet.make_fingerprint([i for i, _ in self.training], self.training[-1][1])
+
+    def test_fingerprint(self):
+        ids = [i for i, _ in self.training]
+        end_time = self.training[-1][1]
+        fingerprint = DiseaseTrainingSet.make_fingerprint(ids, end_time)
+        self.assertEqual(fingerprint, DiseaseTrainingSet.make_fingerprint(ids[::-1], end_time))
+        self.assertNotEqual(fingerprint, DiseaseTrainingSet.make_fingerprint(ids + [99], end_time))
+        self.assertNotEqual(fingerprint, DiseaseTrainingSet.make_fingerprint(ids, end_time + datetime.timedelta(1)))
+
+    def test_new_disease_trained(self):
+        job = tasks._training_job(3, False)
+        self.assertEqual(job['fingerprint'], self.fingerprint())
+        self.assertEqual(job['analysis_count'], 12)
+
+    def test_too_few_analyses(self):
+        self.training = self.training[:11]
+        self.assertIsNone(tasks._training_job(3, False))
+
+    def test_unchanged_skipped_unless_forced(self):
+        self.training_set = DiseaseTrainingSet(id=1, disease_id=3, fingerprint=self.fingerprint())
+        self.assertIsNone(tasks._training_job(3, False))
+        self.assertIsNotNone(tasks._training_job(3, True))
+
+    def test_new_analysis_retrained(self):
+        self.training_set = DiseaseTrainingSet(id=1, disease_id=3, fingerprint=self.fingerprint())
+        self.training.append((12, datetime.datetime(2020, 2, 1)))
+        job = tasks._training_job(3, False)
+        self.assertEqual(job['fingerprint'], self.fingerprint())
+        self.assertIs(job['training_set'], self.training_set)
+
+    def test_model_trained_before_fingerprints(self):
+        self.disease_model = DiseaseModel(disease_id=3, creation_date=datetime.datetime(2020, 3, 1))
+        self.assertIsNone(tasks._training_job(3, False))
+        training_set, = tasks.db.session.add.call_args[0]
+        self.assertEqual(training_set.fingerprint, self.fingerprint())
+        self.disease_model.creation_date = datetime.datetime(2020, 1, 5)
+        self.assertIsNotNone(tasks._training_job(3, False))
+
+
+class TrainingTests(unittest.TestCase):
+    def setUp(self):
+        self.results = [{'r1_max': 0.5, 'r1_min': -0.25}, {'r2_max': 2.0, 'r1_min': 1.5},
+                        {'r3_min': -1.0, 'r1_max': 0.75, 'r2_max': 0.125}]
+
+    def test_stream_matrix_matches_dict_vectorizer(self):
+        from sklearn.feature_extraction import DictVectorizer
+
+        rows = iter([([results], label) for label, results in enumerate(self.results)])
+        X, feature_names, labels = training.stream_matrix(rows, len(self.results))
+        vectorizer = DictVectorizer(dtype=X.dtype.type)
+        expected = vectorizer.fit_transform(self.results)
+        self.assertEqual(X.dtype.name, 'float32')
+        self.assertEqual(feature_names, vectorizer.feature_names_)
+        self.assertEqual(labels, [0, 1, 2])
+        self.assertEqual((X != expected).nnz, 0)
+        self.assertEqual((training.make_vectorizer(feature_names).transform(self.results) != X).nnz, 0)
+
+    def test_stream_matrix_fewer_rows(self):
+        X, feature_names, labels = training.stream_matrix(iter([([self.results[0]], 'a')]), 3)
+        self.assertEqual(X.shape, (1, 2))
+        self.assertEqual(labels, ['a'])
+
+    def test_pipelines_seeded(self):
+        def params(pipe):
+            return {key: value for key, value in pipe.get_params().items() if not hasattr(value, 'get_params')
+                    and key != 'steps'}
+
+        first, second = training.make_pipelines(7), training.make_pipelines(7)
+        self.assertEqual([algorithm for algorithm, _ in first], [algorithm for algorithm, _ in second])
+        for (algorithm, pipe), (_, other) in zip(first, second):
+            self.assertEqual(pipe.steps[-1][1].random_state, 7, algorithm)
+            self.assertEqual(params(pipe), params(other), algorithm)
+
+
+class QueueRoutingTests(unittest.TestCase):
+    def queue(self, name):
+        return celery.amqp.router.route({}, name)['queue'].name
+
+    def test_fast_and_heavy_tasks(self):
+        for task in (tasks.save_dpm, tasks.save_dpm_study, tasks.save_pe, tasks.save_pe_study, tasks.enhance_synonyms):
+            self.assertEqual(self.queue(task.name), 'fast', task.name)
+        for task in (tasks.save_analysis, tasks.save_analysis_study, tasks.train_save_model):
+            self.assertEqual(self.queue(task.name), 'heavy', task.name)
+        self.assertEqual(pipelines.pipeline_queues(celery.conf), {'heavy'})
+
+    def test_every_task_routed(self):
+        names = [name for name, task in celery.tasks.items() if task.__module__ == tasks.__name__]
+        self.assertTrue(names)
+        for name in names:
+            self.assertIn(self.queue(name), ('fast', 'heavy'), name)
+
 
 class ModelsTests(flask_testing.TestCase):
     def setUp(self):
@@ -56,5 +248,660 @@ class ModelsTests(flask_testing.TestCase):
         expected = [{'a': 1, 'b': 2}]
         self.assertEqual(list(cleaned), expected)
 
+class StudySummaryTests(flask_testing.TestCase):
+    def create_app(self):
+        app.config.from_object(config['testing'])
+        db.create_all()
+        return app
+
+    def setUp(self):
+        self.start = datetime.datetime(2020, 1, 1)
+        self.users = [User(email='summary-%d@test' % i) for i in range(2)]
+        self.study = AnalysisMetadata(name='summary test', group='healthy')
+        self.studies, self.diseases = [self.study], []
+        db.session.add_all(self.users + [self.study])
+        db.session.flush()
+        self.analyses = []
+        for name, user, type, end_time in (('a', self.users[0], 'public', self.start),
+                                           ('b', self.users[1], 'public', None),
+                                           ('c', self.users[0], 'private', None),
+                                           ('d', self.users[1], 'private', self.start),
+                                           ('healthy label avg', self.users[0], 'public', self.start)):
+            analysis = Analyses(name, user, type=type)
+            analysis.owner_user_id = user.id
+            analysis.dataset_id = self.study.id
+            analysis.start_time = self.start
+            analysis.end_time = end_time
+            self.analyses.append(analysis)
+        db.session.add_all(self.analyses)
+        db.session.commit()
+
+    def tearDown(self):
+        study_ids = [study.id for study in self.studies]
+        for analysis in Analyses.query.filter(Analyses.dataset_id.in_(study_ids)):
+            db.session.delete(analysis)
+        db.session.commit()
+        StudySummary.query.filter(StudySummary.study_id.in_(study_ids)).delete(synchronize_session=False)
+        for row in self.studies + self.diseases + self.users:
+            db.session.delete(row)
+        db.session.commit()
+
+    def summaries(self):
+        return {(summary.type, summary.owner_user_id): (summary.cases, summary.finished, summary.end_time)
+                for summary in StudySummary.query.filter_by(study_id=self.study.id)}
+
+    def test_grouped_by_type_and_owner(self):
+        rows = summary_query().filter(AnalysisMetadata.id == self.study.id).all()
+        self.assertEqual(len(rows), 3)
+        public, = [row for row in rows if row[7] == 'public']
+        # the healthy group average is not a case, and the study has not ended
+        self.assertEqual((public[8], public[9], public[10], public[12]), (None, 2, 1, None))
+        self.assertEqual(public[13], self.analyses[0].id)
+        self.assertEqual(self.summaries(), {
+            ('public', None): (2, 1, None),
+            ('private', self.users[0].id): (1, 0, None),
+            ('private', self.users[1].id): (1, 1, self.start),
+        })
+
+    def test_refreshed_on_commit(self):
+        self.analyses[1].end_time = self.start
+        db.session.commit()
+        self.assertEqual(self.summaries()[('public', None)], (2, 2, self.start))
+
+        db.session.delete(self.analyses[2])
+        db.session.commit()
+        self.assertNotIn(('private', self.users[0].id), self.summaries())
+
+    def test_listing_pages(self):
+        disease = Diseases(name='summary test')
+        db.session.add(disease)
+        db.session.flush()
+        self.diseases.append(disease)
+        self.study.disease_id = disease.id
+        for i in range(2):
+            study = AnalysisMetadata(name='summary test %d' % i, group='healthy', disease_id=disease.id)
+            db.session.add(study)
+            db.session.flush()
+            self.studies.append(study)
+            analysis = Analyses('e', self.users[0], type='public')
+            analysis.owner_user_id = self.users[0].id
+            analysis.dataset_id = study.id
+            analysis.start_time = self.start
+            db.session.add(analysis)
+        db.session.commit()
+        study_ids = [study.id for study in self.studies]
+
+        with mock.patch.object(analysis_views, 'get_progress', return_value={}) as get_progress:
+            pages = [self.client.get('/analysis/public?disease=%d&page=%d&per_page=2' % (disease.id, page))
+                     for page in (0, 1, 2, 3)]
+        for response in pages:
+            self.assertEqual(response.headers['X-Total-Count'], '3')
+        self.assertEqual([[study['id'] for study in response.json] for response in pages],
+                         [study_ids[:2], study_ids[:2], study_ids[2:], []])
+        # one progress lookup per page, with the running analyses of every study on it
+        self.assertEqual(get_progress.call_count, 4)
+        running = sorted(get_progress.call_args_list[1][0][0])
+        self.assertEqual(running, sorted([self.analyses[1].id] + [
+            analysis.id for analysis in Analyses.query.filter(Analyses.dataset_id == study_ids[1])]))
+
+    def test_rebuild_in_batches(self):
+        expected = self.summaries()
+        StudySummary.query.filter_by(study_id=self.study.id).delete()
+        db.session.commit()
+        self.assertEqual(self.summaries(), {})
+        rebuild_study_summaries(batch_size=1)
+        self.assertEqual(self.summaries(), expected)
+
+
+class SimilarAnalysesTests(flask_testing.TestCase):
+    def create_app(self):
+        app.config.from_object(config['testing'])
+        db.create_all()
+        return app
+
+    def setUp(self):
+        self.users = [User(email='similar-%d@test' % i) for i in range(2)]
+        self.study = AnalysisMetadata(name='similar test', group='healthy')
+        db.session.add_all(self.users + [self.study])
+        db.session.flush()
+        self.analyses = []
+        for user, type in ((self.users[0], 'public'), (self.users[0], 'private'), (self.users[1], 'private')):
+            analysis = Analyses('similar', user, type=type)
+            analysis.owner_user_id = user.id
+            analysis.dataset_id = self.study.id
+            analysis.results_pathway = [{'p1': float(len(self.analyses))}]
+            self.analyses.append(analysis)
+        db.session.add_all(self.analyses)
+        db.session.commit()
+        self.ids = [analysis.id for analysis in self.analyses]
+
+        self.corpus = mock.Mock(version=1)
+        self.corpus.nearest.side_effect = lambda results_pathways, k, groups, exclude_ids: [
+            {'k': k, 'p1': results_pathway['p1']} for results_pathway in results_pathways]
+        patches = [mock.patch.object(analysis_views, 'get_corpus', return_value=self.corpus),
+                   mock.patch.object(result_cache, 'cached_many',
+                                     lambda method, version, compute, inputs, payloads=None: compute(inputs))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for analysis in self.analyses:
+            db.session.delete(analysis)
+        db.session.commit()
+        StudySummary.query.filter_by(study_id=self.study.id).delete(synchronize_session=False)
+        for row in [self.study] + self.users:
+            db.session.delete(row)
+        db.session.commit()
+
+    def similar(self, body, user=None):
+        headers = {}
+        if user is not None:
+            headers['Authorization'] = 'JWT ' + jwt.jwt_encode_callback(user).decode('utf-8')
+        return self.client.post('/analysis/similar', data=json.dumps(body), content_type='application/json',
+                                headers=headers)
+
+    def test_public_only_without_token(self):
+        missing = max(self.ids) + 1000
+        response = self.similar({'analysis_ids': self.ids + [missing]})
+        self.assert200(response)
+        self.assertEqual(response.json, {str(self.ids[0]): {'k': 5, 'p1': 0.0}, str(self.ids[1]): None,
+                                         str(self.ids[2]): None, str(missing): None})
+        results_pathways, k, groups = self.corpus.nearest.call_args[0]
+        self.assertIn('healthy label avg', groups)
+        self.assertEqual(self.corpus.nearest.call_args[1], {'exclude_ids': [self.ids[0]]})
+
+    def test_own_private_with_token(self):
+        response = self.similar({'analysis_ids': self.ids, 'k': 2}, self.users[0])
+        self.assert200(response)
+        self.assertEqual(response.json, {str(self.ids[0]): {'k': 2, 'p1': 0.0}, str(self.ids[1]): {'k': 2, 'p1': 1.0},
+                                         str(self.ids[2]): None})
+
+    def test_invalid_body(self):
+        self.assert400(self.similar({'analysis_ids': ['a']}))
+        self.assert400(self.similar({'analysis_ids': self.ids, 'k': 0}))
+        self.corpus.nearest.assert_not_called()
+
+
+class DirectPathwayMappingTests(unittest.TestCase):
+    def setUp(self):
+        self.dpm = DirectPathwayMapping({})
+        network = MetaboliticsBase()
+        self.reaction = next(iter(network.get_reaction_names()))
+        self.metabolites = list(network.get_metabolites_by_reaction(self.reaction))
+
+    def test_score_reactions(self):
+        fold_changes = {m: float(i + 1) for i, m in enumerate(self.metabolites)}
+        fold_changes['not_in_network'] = 100.0
+        self.dpm.fold_changes = fold_changes
+        scores = self.dpm.score_reactions()
+        expected = sum(range(1, len(self.metabolites) + 1)) / len(self.metabolites)
+        self.assertAlmostEqual(scores[self.reaction], expected)
+        self.assertNotIn('not_in_network', scores)
+
+    def test_score_pathways(self):
+        metabolite = self.metabolites[0]
+        self.dpm.fold_changes = {metabolite: 2.0}
+        scores = self.dpm.score_pathways()
+        self.assertTrue(scores)
+        self.assertTrue(all(score == 2.0 for score in scores.values()))
+
+    def test_score_many(self):
+        cases = [{m: float(i + 1)} for i, m in enumerate(self.metabolites)]
+        pathways, reactions = self.dpm.engine.score_many(cases)
+        self.assertEqual(len(reactions), len(cases))
+        for case, pathway_scores, reaction_scores in zip(cases, pathways, reactions):
+            self.dpm.fold_changes = case
+            self.assertEqual(reaction_scores, self.dpm.score_reactions())
+            self.assertEqual(pathway_scores, self.dpm.score_pathways())
+
+    def test_compiled_network_only(self):
+        load_compiled_network()
+        with mock.patch.object(base, 'load_network', side_effect=AssertionError('json network read')), \
+                mock.patch.dict(dpm._engines, clear=True):
+            scores = DirectPathwayMapping({self.metabolites[0]: 2.0}).score_pathways()
+        self.assertTrue(scores)
+
+
+class MetaboliticsBaseTests(unittest.TestCase):
+    def setUp(self):
+        self.base = MetaboliticsBase()
+
+    def test_indexes_are_inverse(self):
+        for pathway in self.base.get_pathway_names():
+            for metabolite in self.base.get_metabolites_by_pathway(pathway):
+                self.assertIn(pathway, self.base.get_pathways_by_metabolite(metabolite))
+
+    def test_common_metabolites(self):
+        pathway = next(iter(self.base.get_pathway_names()))
+        metabolite = next(iter(self.base.get_metabolites_by_pathway(pathway)))
+        common = self.base.get_common_metabolites_for_analysis(pathway, {metabolite: 1.0, 'unknown': 1.0})
+        self.assertEqual(common, [metabolite])
+
+    def test_network_shared_and_read_only(self):
+        network = base.load_network()
+        self.assertIs(network, base.load_network())
+        self.assertIs(MetaboliticsBase().data, network)
+        reaction = next(iter(network['reactions']))
+        pathway = next(iter(network['pathways']))
+        with self.assertRaises(TypeError):
+            network['reactions'] = {}
+        with self.assertRaises(TypeError):
+            network['reactions'][reaction]['metabolites']['x'] = 1.0
+        with self.assertRaises(AttributeError):
+            network['pathways'][pathway].append(reaction)
+
+
+class CompiledNetworkTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.original_path, base.COMPILED_PATH = base.COMPILED_PATH, self.path
+        self.networks = mock.patch.dict(base._networks, clear=True)
+        self.networks.start()
+
+    def tearDown(self):
+        self.networks.stop()
+        base.COMPILED_PATH = self.original_path
+        shutil.rmtree(self.path)
+
+    def test_matches_json(self):
+        network = load_compiled_network()
+        data = base.load_network()
+        self.assertEqual(network.metabolite_names, list(data['metabolites']))
+        self.assertEqual(network.reaction_names, list(data['reactions']))
+        self.assertEqual(network.pathway_names, list(data['pathways']))
+        incidence = network.reaction_incidence()
+        for i, reaction in enumerate(network.reaction_names[:50]):
+            metabolites = {network.metabolite_names[j] for j in incidence[i].indices}
+            self.assertEqual(metabolites, set(data['reactions'][reaction]['metabolites']))
+
+    def test_recompiled_when_source_changes(self):
+        load_compiled_network()
+        meta_path = os.path.join(self.path, 'recon3D', 'meta.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta['source_mtime'] -= 1
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        base._networks.clear()
+        with mock.patch.object(base, 'compile_network', wraps=base.compile_network) as compile_network:
+            network = load_compiled_network()
+        compile_network.assert_called_once_with('recon3D')
+        self.assertEqual(network.meta['source_mtime'], os.path.getmtime('../datasets/assets/recon3D.json'))
+
+    def test_not_compiled_again_after_waiting_for_lock(self):
+        compile_network = base.compile_network
+        operations = []
+
+        def flock(lock, operation):
+            operations.append(operation)
+            if operation == fcntl.LOCK_EX:  # another process compiled it while this one waited
+                compile_network()
+
+        with mock.patch.object(fcntl, 'flock', side_effect=flock), \
+                mock.patch.object(base, 'compile_network') as compile_again:
+            network = load_compiled_network()
+        compile_again.assert_not_called()
+        self.assertEqual(operations, [fcntl.LOCK_EX, fcntl.LOCK_UN])
+        self.assertTrue(network.n_reactions)
+
+
+class PathwayEnrichmentTests(unittest.TestCase):
+    def setUp(self):
+        self.pe = PathwayEnrichment({})
+        self.network = MetaboliticsBase()
+        self.pathway = next(iter(self.network.get_pathway_names()))
+        self.metabolites = sorted(self.network.get_metabolites_by_pathway(self.pathway))
+
+    def test_score_pathways(self):
+        self.pe.fold_changes = {m: 1.0 for m in self.metabolites}
+        scores = self.pe.score_pathways()
+        self.assertEqual(set(scores), set(self.network.get_pathway_names()))
+        self.assertEqual(min(scores, key=scores.get), self.pathway)
+
+    def test_score_many(self):
+        cases = [{m: 1.0 for m in self.metabolites}, {self.metabolites[0]: 1.0}]
+        pathways, reactions = self.pe.engine.score_many(cases)
+        for case, pathway_scores, reaction_scores in zip(cases, pathways, reactions):
+            self.pe.fold_changes = case
+            self.assertEqual(pathway_scores, self.pe.score_pathways())
+            self.assertEqual(reaction_scores, self.pe.score_reactions())
+
+    def test_compiled_network_only(self):
+        load_compiled_network()
+        with mock.patch.object(base, 'load_network', side_effect=AssertionError('json network read')), \
+                mock.patch.dict(pe._engines, clear=True):
+            scores = PathwayEnrichment({m: 1.0 for m in self.metabolites}).score_pathways()
+        self.assertEqual(min(scores, key=scores.get), self.pathway)
+
+
+class PathwayCorpusTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.original_path, corpus.CORPUS_PATH = corpus.CORPUS_PATH, self.path
+        self.rows = [
+            (1, 'a', 'not_provided', {'p1': 1.0, 'p2': 2.0, 'p3': 0.5}),
+            (2, 'a', 'x label avg', {'p1': -1.0, 'p2': 0.5}),
+            (3, 'b', 'not_provided', {'p2': 3.0, 'p3': -2.0}),
+            (4, 'b', 'h label avg', {'p1': 2.0, 'p4': 1.0}),
+        ]
+
+    def tearDown(self):
+        corpus.CORPUS_PATH = self.original_path
+        shutil.rmtree(self.path)
+
+    def test_similarities(self):
+        corpus.append_rows(1, self.rows[:2])
+        corpus.append_rows(1, self.rows[2:])  # p4 starts a new generation
+        x = {'p1': 0.5, 'p3': 1.0, 'p5': 2.0}
+        similarities = corpus.get_corpus(1).similarities(x, {'h label avg'})
+        expected = similarty_dict(x, [row[3] for row in self.rows[:3]])
+        self.assertAlmostEqual(similarities['a'], (expected[0] + expected[1]) / 2)
+        self.assertAlmostEqual(similarities['b'], expected[2])
+
+    def test_nearest(self):
+        corpus.append_rows(1, [(i, d, l, dict(x, p4=0.0)) for i, d, l, x in self.rows])
+        x = {'p1': 0.5, 'p2': -1.0, 'p3': 1.0, 'p4': 0.0}
+        nearest, = corpus.get_corpus(1).nearest([x], k=2, exclude_ids=[1])
+        expected = similarty_dict(x, [dict(row[3], p4=0.0) for row in self.rows[1:]])
+        best = sorted(zip(expected, [2, 3, 4]), reverse=True)[:2]
+        self.assertEqual([a['id'] for a in nearest['analyses']], [i for _, i in best])
+        self.assertAlmostEqual(nearest['analyses'][0]['similarity'], best[0][0])
+
+    def test_removed_analyses(self):
+        corpus.append_rows(1, self.rows)
+        corpus.remove_analyses(1, [3, 4])
+        self.assertEqual(set(corpus.get_corpus(1).similarities({'p1': 1.0, 'p2': 0.0})), {'a'})
+
+    def test_centroids(self):
+        corpus.append_rows(1, self.rows[:2])
+        corpus.append_rows(1, self.rows[2:])  # Welford updates across a new generation
+        corpus.remove_analyses(1, [2])
+        pathway_corpus = corpus.get_corpus(1)
+        expected = corpus.DiseaseCentroids.from_rows(pathway_corpus.meta, pathway_corpus.scores).profiles()
+        diseases, counts, means, variances = pathway_corpus.centroids.profiles()
+        self.assertEqual(diseases, ['a', 'b'])
+        self.assertEqual(counts.tolist(), [1, 2])
+        for actual, other in ((means, expected[2]), (variances, expected[3])):
+            for a, b in zip(actual.ravel(), other.ravel()):
+                self.assertAlmostEqual(a, b)
+
+        x = {'p1': 0.5, 'p2': -1.0, 'p3': 1.0}
+        similarities = pathway_corpus.centroid_similarities(x, {'h label avg'})
+        self.assertEqual(set(similarities), {'a', 'b'})
+        expected = similarty_dict(dict(x, p4=0.0), [dict(self.rows[2][3], p1=0.0, p4=0.0)])
+        self.assertAlmostEqual(similarities['b'], expected[0])
+
+    def test_centroids_after_rebuild(self):
+        corpus.rebuild(1, [(1, 'a', 'not_provided', {'p1': 1.0, 'p2': 1.0}),
+                           (2, 'a', 'not_provided', {'p1': 2.0, 'p2': 2.0})])
+        corpus.append_rows(1, [(3, 'a', 'not_provided', {'p1': 3.0, 'p2': 3.0, 'p3': 1.0})])
+        pathway_corpus = corpus.get_corpus(1)
+        _, counts, means, variances = pathway_corpus.centroids.profiles()
+        expected = corpus.DiseaseCentroids.from_rows(pathway_corpus.meta, pathway_corpus.scores).profiles()
+        self.assertEqual(counts.tolist(), [3])
+        self.assertEqual(means.tolist(), [[2.0, 2.0, 1.0 / 3]])
+        for actual, other in ((means, expected[2]), (variances, expected[3])):
+            for a, b in zip(actual.ravel(), other.ravel()):
+                self.assertAlmostEqual(a, b)
+
+    def test_rows_without_synonym(self):
+        self.assertEqual(corpus._corpus_row((1, 1, 'a', 's', 'not_provided', [{}]))[1], 'a (s)')
+        self.assertEqual(corpus._corpus_row((1, 1, 'a', None, 'not_provided', [{}]))[1], 'a')
+
+    def test_update_failure_logged(self):
+        with mock.patch.object(corpus, '_corpus_query', side_effect=ValueError('broken')), \
+                mock.patch.object(app.logger, 'exception') as exception:
+            corpus.update_corpus([5])
+        exception.assert_called_once()
+
+
+class DiseaseModelsTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.scores = {'fold_number': 10, 'f1_score': 0.9, 'precision_score': 0.8, 'recall_score': 0.7,
+                       'algorithm': 'svc'}
+        with open(os.path.join(self.path, 'a_1_model.p'), 'wb') as f:
+            pickle.dump(dict(self.scores, disease='a (x)', model=None), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def save(self, name, disease, model):
+        model_path = os.path.join(self.path, name)
+        with open(model_path, 'wb') as f:
+            pickle.dump(dict(self.scores, disease=disease, model=model), f)
+        # a rewrite within the mtime resolution still has to be seen
+        mtime = os.stat(model_path).st_mtime_ns + 10 ** 9
+        os.utime(model_path, ns=(mtime, mtime))
+
+    def classifier(self, feature_names, step='vect', constant=1):
+        from sklearn.dummy import DummyClassifier
+        from sklearn.pipeline import Pipeline
+
+        estimator = DummyClassifier(strategy='constant', constant=constant)
+        estimator.fit([[0] * len(feature_names)] * 2, [0, 1])
+        return Pipeline([(step, training.make_vectorizer(feature_names)), ('clf', estimator)])
+
+    def test_models_read_again_only_when_changed(self):
+        self.save('b_2_model.p', 'b (y)', None)
+        models = disease_models.get_disease_models(self.path)
+        self.assertEqual([model['disease'] for model in models], ['a (x)', 'b (y)'])
+        with mock.patch.object(disease_models.pickle, 'load', side_effect=AssertionError('model unpickled')):
+            self.assertIs(disease_models.get_disease_models(self.path), models)
+
+        self.save('b_2_model.p', 'b (z)', None)
+        with mock.patch.object(disease_models.pickle, 'load', wraps=pickle.load) as load:
+            reloaded = disease_models.get_disease_models(self.path)
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual([model['disease'] for model in reloaded], ['a (x)', 'b (z)'])
+
+        os.remove(os.path.join(self.path, 'b_2_model.p'))
+        self.assertEqual([model['disease'] for model in disease_models.get_disease_models(self.path)], ['a (x)'])
+
+    def test_predict_shares_vectorized_sample(self):
+        from sklearn.feature_extraction import DictVectorizer
+
+        self.save('a_1_model.p', 'a (x)', self.classifier(['r1', 'r2']))
+        self.save('b_2_model.p', 'b (y)', self.classifier(['r1', 'r2']))
+        self.save('c_3_model.p', 'c (z)', self.classifier(['r1', 'r2', 'r3'], constant=0))
+        self.save('d_4_model.p', 'd (w)', self.classifier(['r1'], step='dv'))
+        models = disease_models.get_disease_models(self.path)
+        self.assertEqual([model['vocabulary'] for model in models], [0, 0, 1, None])
+
+        with mock.patch.object(DictVectorizer, 'transform', autospec=True,
+                               side_effect=DictVectorizer.transform) as transform:
+            preds = disease_models.predict_diseases({'r1': 1.0, 'r2': 2.0}, self.path)
+        # once per vocabulary, the legacy pipeline vectorizes in both predict and predict_proba
+        self.assertEqual(transform.call_count, 2 + 2)
+        self.assertEqual(preds, [{'disease': 'a (x)', 'pred_score': 1.0}, {'disease': 'b (y)', 'pred_score': 1.0},
+                                 {'disease': 'd (w)', 'pred_score': 1.0}])
+
+    def test_scores_from_sidecars(self):
+        with mock.patch.object(disease_models.pickle, 'load', side_effect=AssertionError('model unpickled')):
+            self.assertEqual(disease_models.get_model_scores(self.path), {})
+        self.assertEqual(disease_models.backfill_sidecars(self.path), 1)
+        self.assertEqual(disease_models.backfill_sidecars(self.path), 0)
+        with mock.patch.object(disease_models.pickle, 'load', side_effect=AssertionError('model unpickled')):
+            self.assertEqual(disease_models.get_model_scores(self.path), {'a (x)': self.scores})
+
+
+class FakeRedis:
+    """In-memory stand-in for the redis commands ResultCache uses, with expiring keys"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self._alive(key):
+            return None
+        self.data[key] = str(value).encode('utf-8')
+        self.expires.pop(key, None)
+        if ex is not None:
+            self.expires[key] = time.time() + ex
+        return True
+
+    def incr(self, key, amount=1):
+        value = int(self.get(key) or 0) + amount
+        self.data[key] = str(value).encode('utf-8')
+        return value
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def execute_command(self, command, key, score, member):
+        assert command == 'ZADD'
+        self.data.setdefault(key, {})[member] = score
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zrange(self, key, start, end):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        return [member for member, _ in members][start:None if end == -1 else end + 1]
+
+    def zrem(self, key, *members):
+        return sum(self.data.get(key, {}).pop(member, None) is not None for member in members)
+
+    def hset(self, key, field, value):
+        fields = self.data.setdefault(key, {})
+        new = field not in fields
+        fields[field] = value
+        return int(new)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hdel(self, key, *fields):
+        return sum(self.data.get(key, {}).pop(field, None) is not None for field in fields)
+
+    def eval(self, script, numkeys, key, token, *args):
+        if self.get(key) != token.encode('utf-8'):
+            return 0
+        if script == result_cache.RELEASE_LOCK:
+            return self.delete(key)
+        assert script == result_cache.EXTEND_LOCK
+        self.expires[key] = time.time() + int(args[0])
+        return 1
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeRedis()
+        self.cache = result_cache.ResultCache(self.client, max_bytes=100, lock_timeout=1, poll_interval=0.01)
+
+    def test_get_set(self):
+        key = self.cache.key('dpm', 'v1', {'a': 1.0, 'b': 2.0})
+        self.assertEqual(key, self.cache.key('dpm', 'v1', {'b': 2.0, 'a': 1.0}))
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, {'p': 1.5})
+        self.assertEqual(self.cache.get(key), {'p': 1.5})
+        self.assertEqual(self.cache.get_many([key, 'missing']), {key: {'p': 1.5}})
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 1))
+        self.assertEqual(stats['bytes'], len('{"p": 1.5}'))
+
+    def test_evicts_by_size(self):
+        value = {'p': 'x' * 31}  # 40 bytes of json
+        for key in ('a', 'b'):
+            self.cache.set(key, value)
+        self.cache.get('a')  # b becomes the least recently used
+        self.cache.set('a', value)  # a rewrite does not count twice
+        self.cache.set('c', value)
+        self.assertIsNone(self.client.get('b'))
+        self.assertEqual(self.cache.get_many(['a', 'c']), {'a': value, 'c': value})
+        self.assertEqual(self.cache.stats()['bytes'], 80)
+
+    def test_new_version_new_key(self):
+        calls = []
+        compute = lambda: calls.append(1) or {'p': len(calls)}
+        for version in ('v1', 'v1', 'v2'):
+            self.cache.get_or_compute(self.cache.key('dpm', version, {'a': 1.0}), compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_waits_for_locked_key(self):
+        self.client.set('k:lock', 'other', ex=10)
+        threading.Timer(0.1, self.client.set, ('k', '{"p": 1}')).start()
+        self.assertEqual(self.cache.get_or_compute('k', lambda: self.fail('computed twice')), {'p': 1})
+        self.assertEqual(self.client.get('k:lock'), b'other')
+
+    def test_takes_over_expired_lock(self):
+        self.client.set('k:lock', 'other', ex=0.1)
+        self.assertEqual(self.cache.get_or_compute('k', lambda: {'p': 2}), {'p': 2})
+        self.assertIsNone(self.client.get('k:lock'))
+
+    def test_lock_kept_while_computing(self):
+        def compute():
+            time.sleep(1.5)  # longer than lock_timeout
+            self.assertIsNotNone(self.client.get('k:lock'))
+            return {'p': 3}
+        self.assertEqual(self.cache.get_or_compute('k', compute), {'p': 3})
+        self.assertIsNone(self.client.get('k:lock'))
+
+    def test_get_or_compute_many(self):
+        self.cache.set('a', {'p': 0})
+        computed = []
+        compute_many = lambda inputs: computed.extend(inputs) or [{'p': x} for x in inputs]
+        values = self.cache.get_or_compute_many(['a', 'b', 'c', 'b'], [0, 1, 2, 1], compute_many)
+        self.assertEqual(values, [{'p': 0}, {'p': 1}, {'p': 2}, {'p': 1}])
+        self.assertEqual(computed, [1, 2])
+        self.assertEqual(self.client.zrange('metabolitics:results:lru', 0, -1)[-2:], ['b', 'c'])
+
+    def test_cached_many_payloads(self):
+        computed = []
+        compute_many = lambda payloads: computed.extend(payloads) or [{'p': x} for _, x in payloads]
+        with mock.patch.object(result_cache, 'get_result_cache', return_value=self.cache):
+            values = result_cache.cached_many('m', 'v', compute_many, [({'a': 1.0},), ({'a': 1.0},)],
+                                              [(5, 1.0), (6, 1.0)])
+            self.assertEqual(values, [{'p': 1.0}, {'p': 1.0}])
+            # keyed by the input alone, so a case with other ids is found in the cache
+            self.assertEqual(result_cache.cached_many('m', 'v', compute_many, [({'a': 1.0},)], [(7, 2.0)]),
+                             [{'p': 1.0}])
+        self.assertEqual(computed, [(5, 1.0)])
+
+
+
+class BenchmarkTests(unittest.TestCase):
+    def record(self, samples, wall_time, **extra):
+        return dict(name='dpm', source='BC', samples=samples, metabolites=5, wall_time=wall_time, **extra)
+
+    def test_compare(self):
+        baseline = {'records': [self.record(10, 1.0), self.record(50, 1.0), self.record(200, 1.0, error='failed')]}
+        report = {'records': [self.record(10, 1.5), self.record(50, 1.1), self.record(200, 3.0),
+                              self.record(500, 9.0)]}
+        # only records timed in both reports are compared
+        self.assertEqual(benchmarks.compare(report, baseline, threshold=1.2), [(('dpm', 'BC', 10, 5), 1.0, 1.5, 1.5)])
+
+    def test_make_study_is_reproducible(self):
+        metabolites = ['m%d' % i for i in range(8)]
+        source = (metabolites, [('h', {m: 1.0 for m in metabolites}), ('bc', {m: 2.0 for m in metabolites})])
+        study, n_metabolites = benchmarks.make_study(source, 20, 0.5)
+        self.assertEqual(study, benchmarks.make_study(source, 20, 0.5)[0])
+        self.assertEqual(n_metabolites, 4)
+        self.assertEqual(len(study['analysis']), 20)
+        kept = {m for case in study['analysis'].values() for m in case['Metabolites']}
+        self.assertEqual(len(kept), 4)
+        self.assertEqual(study['group'], sorted({case['Label'] for case in study['analysis'].values()})[0])
+
+    def test_rank_agreement(self):
+        exact = {'a': 3.0, 'b': 2.0, 'c': 1.0}
+        self.assertEqual(benchmarks.rank_agreement(exact, exact, 2), (1.0, 1.0, 1.0))
+        top1, overlap, spearman = benchmarks.rank_agreement(exact, {'a': 1.0, 'b': 2.0, 'c': 3.0}, 2)
+        self.assertEqual((top1, overlap), (0.0, 0.5))
+        self.assertAlmostEqual(spearman, -1.0)
+
 if __name__ == "__main__":
     unittest.main()